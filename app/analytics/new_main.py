@@ -8,6 +8,8 @@ from sqlalchemy.orm import Session
 
 import app.analytics.utils.cmc_api as cmc_api
 import app.analytics.utils.birdeye_api as beye_api
+from app.analytics.utils.order_matching import execute_triggered_orders
+from app.api.portfolio_stats import revalue_portfolios
 from app.models.models import Base, Instrument
 
 from app.models.models import Base, \
@@ -145,19 +147,52 @@ def update_latest_price():
         .all()
     addresses = [instrument.token_address for instrument in instruments]
     latest_prices = beye_api.get_latest_crypto_price(addresses)
+    previous_prices = {
+        kpi.instrument_id: kpi.price
+        for kpi in session.query(InstrumentKPI_LatestPrice)
+            .filter(InstrumentKPI_LatestPrice.instrument_id.in_([instrument.id for instrument in instruments]))
+            .all()
+    }
+    updated_prices = {}
     for instrument in instruments:
         try:
+            price = latest_prices[instrument.token_address]['value'] if latest_prices[instrument.token_address]['value'] is not None else 0
             session.merge(InstrumentKPI_LatestPrice(
                 instrument_id=instrument.id,
                 date_as_of=datetime.utcfromtimestamp(latest_prices[instrument.token_address]['updateUnixTime']) if latest_prices[instrument.token_address]['updateUnixTime'] is not None else 0,
-                price=latest_prices[instrument.token_address]['value'] if latest_prices[instrument.token_address]['value'] is not None else 0,
+                price=price,
                 change_abs_1d=0,
                 change_perc_1d=latest_prices[instrument.token_address]['priceChange24h'] if latest_prices[instrument.token_address]['priceChange24h'] is not None else 0,
                 date_last_updated=func.now()
             ))
-            session.commit()
+            updated_prices[instrument.id] = price
         except Exception as e:
             print(f'Failed to update latest price for {instrument.symbol}: {instrument.token_address}. Error: {e}')
+
+    # write the prices and revalue the portfolios holding the instruments whose price changed in one transaction
+    try:
+        n_revalued = revalue_portfolios(
+            db=session,
+            instrument_ids=[
+                instrument_id
+                for instrument_id, price in updated_prices.items()
+                if price != previous_prices.get(instrument_id)
+            ]
+        )
+        session.commit()
+        print(f'Latest prices updated: {len(updated_prices)}, portfolios revalued: {n_revalued}')
+    except Exception as e:
+        session.rollback()
+        updated_prices = {}
+        print(f'Failed to update latest prices and revalue portfolios. Error: {e}')
+
+    # fill resting orders triggered by the new prices
+    try:
+        summary = execute_triggered_orders(session=session, latest_prices=updated_prices)
+        print(f'Orders triggered: {summary["triggered"]}, executed: {summary["executed"]}, failed: {summary["failed"]}')
+    except Exception as e:
+        session.rollback()
+        print(f'Failed to execute triggered orders. Error: {e}')
     session.close()
 
 @click.command()
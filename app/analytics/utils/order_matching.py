@@ -0,0 +1,219 @@
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from sqlalchemy import Float, Integer, column, select, tuple_, union_all, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import app.api.constants as c
+from app.api import xp_counters, portfolio_stats
+from app.models.models import \
+    Holding, \
+    Job, \
+    Portfolio, \
+    PortfolioOrder, \
+    PortfolioOrderTriggerDirection, \
+    PortfolioTransaction, \
+    PortfolioTransactionTypeUserScope
+
+
+def find_triggered_orders(session: Session, latest_prices: Dict[int, float]) -> List[PortfolioOrder]:
+    """
+    Find all open orders triggered by a batch of latest prices.
+
+    Open orders are indexed by (instrument_id, trigger_direction, trigger_price),
+    so each instrument's thresholds are kept sorted by the partial index and the
+    lookup is two range scans per instrument: the cost is proportional to the
+    number of triggered orders rather than the number of open orders.
+
+    Returned orders are locked, so that concurrent runs never fill the same order twice.
+    """
+    if not latest_prices:
+        return []
+
+    tick = values(
+        column('instrument_id', Integer),
+        column('price', Float),
+        name='tick'
+    ).data(list(latest_prices.items()))
+
+    triggered_below = select(PortfolioOrder.id) \
+        .join(tick, tick.c.instrument_id == PortfolioOrder.instrument_id) \
+        .where(
+            PortfolioOrder.status == 'open',
+            PortfolioOrder.trigger_direction == PortfolioOrderTriggerDirection.BELOW.value,
+            PortfolioOrder.trigger_price >= tick.c.price,
+        )
+
+    triggered_above = select(PortfolioOrder.id) \
+        .join(tick, tick.c.instrument_id == PortfolioOrder.instrument_id) \
+        .where(
+            PortfolioOrder.status == 'open',
+            PortfolioOrder.trigger_direction == PortfolioOrderTriggerDirection.ABOVE.value,
+            PortfolioOrder.trigger_price <= tick.c.price,
+        )
+
+    return session.query(PortfolioOrder) \
+        .filter(PortfolioOrder.id.in_(union_all(triggered_below, triggered_above))) \
+        .order_by(PortfolioOrder.id) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+
+def _fail_order(order: PortfolioOrder, reason: str, date_now: datetime):
+    order.status = 'failed'
+    order.detail = reason
+    order.date_last_updated = date_now
+
+
+def _fill_order(order: PortfolioOrder, portfolio: Portfolio, holding: Holding, price: float, date_now: datetime):
+    """
+    Apply a triggered order to the portfolio and holding in memory.
+    Mirrors crud.execute_portfolio_transaction, so that orders and market trades
+    result in the same cash balance, quantity and average price.
+    Returns the holding (a new one for a first purchase) or None if the order could not be filled
+    """
+    value = price * order.quantity
+    ex_avg_price = None
+
+    if order.side == PortfolioTransactionTypeUserScope.BUY.value:
+        if portfolio.cash_balance - value < 0:
+            _fail_order(order, 'Not enough funds to complete the transaction', date_now)
+            return None
+
+        portfolio.cash_balance -= value
+        if holding:
+            new_quantity = holding.quantity + order.quantity
+            holding.average_price = (holding.quantity * holding.average_price + value) / new_quantity
+            holding.quantity = new_quantity
+        else:
+            holding = Holding(
+                portfolio_id=order.portfolio_id,
+                instrument_id=order.instrument_id,
+                quantity=order.quantity,
+                average_price=price,
+            )
+    else:
+        if holding is None or holding.quantity < order.quantity:
+            _fail_order(order, 'You do not own enough of this instrument to sell it', date_now)
+            return None
+
+        ex_avg_price = holding.average_price
+        new_book_cost = holding.quantity * holding.average_price - value
+        new_quantity = holding.quantity - order.quantity
+        if new_quantity == 0:
+            holding.quantity = 0
+            holding.average_price = 0
+        else:
+            holding.average_price = new_book_cost / new_quantity
+            holding.quantity = new_quantity
+
+        portfolio.cash_balance += value
+
+    holding.date_last_updated = date_now
+    portfolio.date_last_updated = date_now
+
+    order.transaction = PortfolioTransaction(
+        portfolio_id=order.portfolio_id,
+        associated_instrument_id=order.instrument_id,
+        quantity=order.quantity,
+        value=value,
+        ex_avg_price=ex_avg_price,
+        transaction_type=order.side,
+        status='executed',
+        message=order.message,
+        date_executed=date_now,
+    )
+    order.status = 'executed'
+    order.execution_price = price
+    order.date_executed = date_now
+    order.date_last_updated = date_now
+    return holding
+
+
+def _enqueue_xp_jobs(session: Session, transactions: List[PortfolioTransaction]):
+    """
+    Queue the XP credit of filled orders in the caller's transaction, like the market trades do with
+    jobs.enqueue_job (app.api.jobs needs the API dependencies, which this image does not install)
+    """
+    stmt = insert(Job) \
+        .values([
+            {
+                'job_type': c.JOB_TYPE.XP_TRANSACTION_EXECUTED,
+                'payload': {'transaction_id': transaction.id},
+                'dedup_key': f'{c.JOB_TYPE.XP_TRANSACTION_EXECUTED}:{transaction.id}',
+                'max_attempts': c.JOB_MAX_ATTEMPTS,
+            }
+            for transaction in transactions
+        ]) \
+        .on_conflict_do_nothing(
+            index_elements=[Job.dedup_key],
+            index_where=(Job.status == 'queued'),
+        )
+    session.execute(stmt)
+
+
+def execute_triggered_orders(session: Session, latest_prices: Dict[int, float]) -> dict:
+    """
+    Fill every order triggered by a batch of latest prices in a single database transaction.
+
+    Portfolios and holdings touched by the triggered orders are loaded with one query each
+    and locked, the fills are applied in memory in order id sequence (so several orders on
+    the same portfolio see each other's cash and quantity changes), and the changes are
+    flushed as batched inserts/updates with a single commit, along with the jobs crediting their XP.
+    """
+    latest_prices = {instrument_id: price for instrument_id, price in latest_prices.items() if price and price > 0}
+    orders = find_triggered_orders(session=session, latest_prices=latest_prices)
+    if not orders:
+        session.commit()  # release the (empty) lock set
+        return {'triggered': 0, 'executed': 0, 'failed': 0}
+
+    portfolios = {
+        portfolio.id: portfolio
+        for portfolio in session.query(Portfolio)
+            .filter(Portfolio.id.in_(list({order.portfolio_id for order in orders})))
+            .order_by(Portfolio.id)
+            .with_for_update()
+            .all()
+    }
+    holdings = {
+        (holding.portfolio_id, holding.instrument_id): holding
+        for holding in session.query(Holding)
+            .filter(tuple_(Holding.portfolio_id, Holding.instrument_id).in_(
+                list({(order.portfolio_id, order.instrument_id) for order in orders})
+            ))
+            .with_for_update()
+            .all()
+    }
+
+    date_now = datetime.now(tz=timezone.utc)
+    n_executed = 0
+    for order in orders:
+        portfolio = portfolios.get(order.portfolio_id)
+        if portfolio is None or portfolio.status != 'active':
+            _fail_order(order, 'Portfolio is not active', date_now)
+            continue
+
+        key = (order.portfolio_id, order.instrument_id)
+        holding = _fill_order(
+            order=order,
+            portfolio=portfolio,
+            holding=holdings.get(key),
+            price=latest_prices[order.instrument_id],
+            date_now=date_now,
+        )
+        if holding is not None:
+            if key not in holdings:
+                session.add(holding)
+                holdings[key] = holding
+            # fills count towards the rolling XP limits like market trades
+            xp_counters.record_executed_transaction(db=session, transaction=order.transaction)
+            portfolio_stats.record_executed_transaction(db=session, transaction=order.transaction)
+            n_executed += 1
+
+    if n_executed:
+        # the transaction ids are needed by the XP jobs, committed with the fills
+        session.flush()
+        _enqueue_xp_jobs(session=session, transactions=[order.transaction for order in orders if order.status == 'executed'])
+    session.commit()
+    return {'triggered': len(orders), 'executed': n_executed, 'failed': len(orders) - n_executed}
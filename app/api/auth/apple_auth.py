@@ -1,10 +1,7 @@
 from typing import Optional
 import jwt
-from jwt.algorithms import RSAAlgorithm
-import requests
-from time import time
-import json
 import os
+from app.api.auth.jwks import JWKSCache
 from app.api.exceptions import SnipsInvalidExternalTokenError
 from app.api.constants import APPLE_BUNDLE_ID
 
@@ -27,36 +24,24 @@ class AppleAuth():
     def __init__(self):
 
         self.APPLE_PUBLIC_KEY_URL = "https://appleid.apple.com/auth/keys"
-        self.APPLE_PUBLIC_KEYS = {}
-        self.APPLE_KEY_CACHE_EXP = 60 * 60 * 24
-        self.APPLE_LAST_KEY_FETCH = 0
-
-    def _refresh_apple_public_keys(self):
-
-        if (self.APPLE_LAST_KEY_FETCH + self.APPLE_KEY_CACHE_EXP) < int(time()) or not self.APPLE_PUBLIC_KEYS:
-            key_payload = requests.get(self.APPLE_PUBLIC_KEY_URL).json()
-            
-            for key_dict in key_payload["keys"]:
-                kid = key_dict['kid']
-                self.APPLE_PUBLIC_KEYS[kid] = RSAAlgorithm.from_jwk(json.dumps(key_dict))
-            self.APPLE_LAST_KEY_FETCH = int(time())
+        self.APPLE_ISSUER = "https://appleid.apple.com"
+        self.jwks = JWKSCache(url=self.APPLE_PUBLIC_KEY_URL)
 
     def validate_jwt(self, apple_user_token):
-        
-        self._refresh_apple_public_keys()
 
         try:
 
             unverified_token = jwt.get_unverified_header(apple_user_token)
-            kid = unverified_token['kid']
-            if kid not in self.APPLE_PUBLIC_KEYS:
+            public_key = self.jwks.get_key(unverified_token['kid'])
+            if public_key is None:
                 raise KeyError("Invalid public key id")
 
             token = jwt.decode(
                 jwt=apple_user_token,
-                key=self.APPLE_PUBLIC_KEYS.get(kid, None),
+                key=public_key,
                 algorithms=["RS256"],
-                audience=APPLE_BUNDLE_ID # os.getenv("APPLE_APP_ID")
+                audience=APPLE_BUNDLE_ID, # os.getenv("APPLE_APP_ID")
+                issuer=self.APPLE_ISSUER
                 )
             
         except jwt.exceptions.InvalidSignatureError as e:
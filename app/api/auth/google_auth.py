@@ -1,7 +1,13 @@
 from typing import Optional
+import logging
+import os
+import jwt
 import requests
+from app.api.auth.jwks import JWKSCache
 from app.api.exceptions import SnipsInvalidExternalTokenError
 
+logger = logging.getLogger(__name__)
+
 
 class GoogleUser(object):
     def __init__(self, user_id: str, email: str, name: Optional[str] = None, raw: any = None):
@@ -17,8 +23,57 @@ class GoogleUser(object):
 class GoogleAuth():
     def __init__(self):
         self.userinfo_url = 'https://www.googleapis.com/userinfo/v2/me'
-    
+        self.GOOGLE_PUBLIC_KEY_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+        self.GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+        # OAuth client ids of the apps, comma separated
+        self.GOOGLE_CLIENT_IDS = [client_id for client_id in os.getenv('APP_GOOGLE_CLIENT_IDS', '').split(',') if client_id]
+        if not self.GOOGLE_CLIENT_IDS:
+            logger.error('APP_GOOGLE_CLIENT_IDS is not set, every login with a Google ID token will be rejected')
+        self.jwks = JWKSCache(url=self.GOOGLE_PUBLIC_KEY_URL)
+
     def validate_access_token(self, access_token: str):
+        """
+        Validate a Google ID token locally with Google's cached public keys.
+        Opaque access tokens, sent by app versions predating ID tokens, are validated with the userinfo endpoint
+        """
+        try:
+            jwt.get_unverified_header(access_token)
+        except jwt.exceptions.DecodeError:
+            return self._validate_with_userinfo(access_token)
+        return self.validate_id_token(access_token)
+
+    def validate_id_token(self, id_token: str):
+        if not self.GOOGLE_CLIENT_IDS:
+            logger.error('Rejected a Google ID token: APP_GOOGLE_CLIENT_IDS is not set')
+            raise SnipsInvalidExternalTokenError('Google ID tokens cannot be validated, no client id is configured')
+        try:
+            unverified_token = jwt.get_unverified_header(id_token)
+            public_key = self.jwks.get_key(unverified_token['kid'])
+            if public_key is None:
+                raise KeyError("Invalid public key id")
+
+            token = jwt.decode(
+                jwt=id_token,
+                key=public_key,
+                algorithms=["RS256"],
+                audience=self.GOOGLE_CLIENT_IDS
+                )
+            if token.get('iss') not in self.GOOGLE_ISSUERS:
+                raise jwt.exceptions.InvalidIssuerError("Invalid issuer")
+
+        except jwt.exceptions.ExpiredSignatureError as e:
+            raise SnipsInvalidExternalTokenError("That token has expired")
+        except (jwt.exceptions.PyJWTError, KeyError) as e:
+            raise SnipsInvalidExternalTokenError(f'Invalid Google ID token: {e}')
+
+        return GoogleUser(
+            user_id=token['sub'],
+            email=token.get('email'),
+            name=token.get('name'),
+            raw=token
+        )
+
+    def _validate_with_userinfo(self, access_token: str):
         response = requests.get(self.userinfo_url, headers={'Authorization': f'Bearer {access_token}'})
         if response.status_code == 200:
             return GoogleUser(
@@ -0,0 +1,95 @@
+import json
+import logging
+import re
+import threading
+from time import monotonic
+from typing import Optional
+
+import requests
+from jwt.algorithms import RSAAlgorithm
+
+import app.api.constants as c
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSCache():
+    """
+    Public keys of an identity provider by key id, so that its tokens are verified without a network call.
+
+    Keys older than their max age keep being served while a background thread refreshes them.
+    A token signed with an unknown key id (the provider rotated its keys) triggers a refetch,
+    at most once per JWKS_KID_MISS_REFETCH_SECONDS, with a single request in flight for all waiting logins
+    """
+
+    def __init__(self, url: str, max_age_seconds: int = c.JWKS_MAX_AGE_SECONDS):
+        self.url = url
+        self.default_max_age_seconds = max_age_seconds
+        self.max_age_seconds = max_age_seconds
+        self.keys = {}
+        self.date_fetched = None  # monotonic time of the last successful fetch
+        self.date_attempted = None  # monotonic time of the last fetch, successful or not
+        self._fetch_lock = threading.Lock()
+
+    def _fetch(self):
+        response = requests.get(self.url, timeout=c.JWKS_TIMEOUT_SECONDS)
+        response.raise_for_status()
+
+        keys = {}
+        for key_dict in response.json()['keys']:
+            keys[key_dict['kid']] = RSAAlgorithm.from_jwk(json.dumps(key_dict))
+
+        # Google publishes how long its keys can be cached, Apple does not
+        max_age = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        self.max_age_seconds = int(max_age.group(1)) if max_age else self.default_max_age_seconds
+        self.keys = keys
+        self.date_fetched = monotonic()
+
+    def refresh(self, min_interval_seconds: float = 0):
+        """
+        Fetch the keys, unless they were fetched less than min_interval_seconds ago.
+        Concurrent callers wait for the fetch in flight instead of starting their own
+        """
+        date_called = monotonic()
+        with self._fetch_lock:
+            if self.date_attempted is not None and (
+                self.date_attempted >= date_called or monotonic() - self.date_attempted < min_interval_seconds
+            ):
+                # fetched while waiting for the lock, or too recently
+                return
+            self.date_attempted = monotonic()
+            try:
+                self._fetch()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logger.warning(f'Could not fetch the public keys from {self.url}: {e}')
+
+    def refresh_in_background(self, min_interval_seconds: float = c.JWKS_KID_MISS_REFETCH_SECONDS):
+        if self._fetch_lock.locked() or (
+            self.date_attempted is not None and monotonic() - self.date_attempted < min_interval_seconds
+        ):
+            return
+        threading.Thread(
+            target=self.refresh,
+            kwargs={'min_interval_seconds': min_interval_seconds},
+            name='jwks-refresh',
+            daemon=True
+        ).start()
+
+    def is_stale(self):
+        return self.date_fetched is None or monotonic() - self.date_fetched > self.max_age_seconds
+
+    def get_key(self, kid: str) -> Optional[object]:
+        """
+        Public key of a key id, None if the provider does not know it
+        """
+        if self.date_fetched is None:
+            # the first login before the warm-up at startup completed
+            self.refresh(min_interval_seconds=c.JWKS_KID_MISS_REFETCH_SECONDS)
+        elif self.is_stale():
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None:
+            self.refresh(min_interval_seconds=c.JWKS_KID_MISS_REFETCH_SECONDS)
+            key = self.keys.get(kid)
+        return key
@@ -8,11 +8,37 @@ BOOTSTRAP_FILE_CHARACTERS = 'app/api/data/bootstrap/characters_v1.json'
 MAX_ELEMENTS_PER_PAGE = 100
 ANONYMOUS_USER_TOKEN_EXPIRATION_HOURS = 720
 VERIFIED_USER_TOKEN_EXPIRATION_HOURS = 2160
+LAST_ACTIVE_FLUSH_SECONDS = 60  # users' last active dates are written in batches at this interval
+FIRESTORE_NAMED_CONVERSATIONS_CACHE_SIZE = 50000  # conversations per API process known to have a display name
 
 PORTFOLIO_STATS_UPDATE_TIMEOUT_SECONDS = 60
+LEADERBOARD_SYNC_INTERVAL_SECONDS = 10  # reload users credited with XP since the last sync
+LEADERBOARD_SYNC_OVERLAP_SECONDS = 30  # look back further than the last sync, for credits committed late
+LEADERBOARD_REBUILD_INTERVAL_SECONDS = 300  # full rebuild, picks up XP resets and visibility changes
+LEADERBOARD_GAIN_LOOKBACK_DAYS = 10  # portfolios not updated for longer are left out of the gain leaderboard
+LEADERBOARD_MAX_NEIGHBOURS = 25
+PORTFOLIO_STATS_REFRESH_DEBOUNCE_SECONDS = 2  # refresh requests for a portfolio within this window are merged
+PORTFOLIO_STATS_REFRESH_MAX_WORKERS = 2
+PORTFOLIO_STATS_REFRESH_MAX_PENDING = 1000  # further refresh requests are dropped, the periodic full refresh catches up
+PORTFOLIO_VALUE_HISTORY_TIMEFRAMES = {'1H': 'hour', '1D': 'day'}  # bar interval -> date_trunc precision
+PORTFOLIO_VALUE_HISTORY_1H_RETENTION_DAYS = 30  # daily bars are kept forever
 STALE_ACCOUNT_DAYS = 90
 
 APPLE_BUNDLE_ID = 'app.snips'  # do not change
+# identity provider public keys (auth.jwks)
+JWKS_MAX_AGE_SECONDS = 60 * 60 * 24  # refreshed in the background after this, unless the provider sets a max-age
+JWKS_KID_MISS_REFETCH_SECONDS = 60  # tokens with an unknown key id refetch the keys at most this often
+JWKS_TIMEOUT_SECONDS = 5
+
+PREMIUM_ENTITLEMENT_ID = 'Premium'  # RevenueCat entitlement identifier
+PREMIUM_FREE_CACHE_SECONDS = 600  # a free plan is revalidated with RevenueCat at most this often, premium plans when they expire
+REVCAT_TIMEOUT_SECONDS = 5
+# premium status sync (tools.update_premium_status)
+PREMIUM_SYNC_CONCURRENCY = 10  # RevenueCat requests in flight
+PREMIUM_SYNC_REQUESTS_PER_MINUTE = 300  # share of the RevenueCat rate limit the sync may use
+PREMIUM_SYNC_EXPIRY_HORIZON_HOURS = 24  # premium users expiring within this window are synced first
+PREMIUM_SYNC_ACTIVE_DAYS = 7  # then users active within this window
+PREMIUM_SYNC_LAPSED_FREE_DAYS = 90  # free users inactive for longer are not synced
 
 MAX_PORTFOLIOS_FREE_PLAN = 1
 MAX_PORTFOLIOS_PREMIUM_PLAN = 5
@@ -23,6 +49,17 @@ REWARD_DAILY_FREE_PLAN = 100.0 # pre-game: 50.0
 REWARD_DAILY_PREMIUM_PLAN = 100.0
 REWARD_INTRADAY_FREE_PLAN = 50  # pre-game: 25.0
 REWARD_INTRADAY_PREMIUM_PLAN = 50.0
+REWARD_SCHEDULE = {
+    'REWARD_WEEKLY': {'FREE_PLAN': REWARD_WEEKLY_FREE_PLAN, 'PREMIUM_PLAN': REWARD_WEEKLY_PREMIUM_PLAN},
+    'REWARD_DAILY': {'FREE_PLAN': REWARD_DAILY_FREE_PLAN, 'PREMIUM_PLAN': REWARD_DAILY_PREMIUM_PLAN},
+    'REWARD_INTRADAY': {'FREE_PLAN': REWARD_INTRADAY_FREE_PLAN, 'PREMIUM_PLAN': REWARD_INTRADAY_PREMIUM_PLAN},
+}
+# time before a reward can be claimed again, shorter than its period to account for UX
+REWARD_COOLDOWN_MINUTES = {
+    'REWARD_WEEKLY': 160 * 60,  # 160 hours instead of 168
+    'REWARD_DAILY': 18 * 60,  # 18 hours instead of 24
+    'REWARD_INTRADAY': 115,  # 1h55m instead of 2 hours
+}
 
 MAX_REFERRER_LEVEL = 1
 
@@ -72,3 +109,34 @@ class XP_LIMIT:
     SELL_AT_PROFIT_COINS_PER_XP = 1
     # how many transactions do you get XP credited for when leaving a message/comment
     FEED_MESSAGE_UNIQUE_TRANSACTIONS = 10
+
+
+class XP_COUNTER:
+    """
+    Rolling 24h counters behind the XP_LIMIT checks (see app.api.xp_counters)
+    """
+    # portfolio scope: executed buys per instrument (member = instrument id)
+    BUY_INSTRUMENT = 'buy_instrument'
+    # portfolio scope: executed transactions with a message
+    MESSAGE_TRANSACTION = 'message_transaction'
+    # user scope: XP credited per reason (member = reason)
+    XP_CREDITED = 'xp_credited'
+
+XP_COUNTER_WINDOW_HOURS = 24
+XP_COUNTER_BUCKET_SECONDS = 300  # the window is rounded down to a bucket, so it may span up to 5 extra minutes
+XP_COUNTER_REBUILD_RANGE_SIZE = 10000  # user or portfolio ids rebuilt per transaction, only their writes wait meanwhile
+
+
+class JOB_TYPE:
+    """
+    Side effects processed by the job worker (see app.api.jobs)
+    """
+    XP_TRANSACTION_EXECUTED = 'xp.transaction_executed'
+    PORTFOLIO_STATS_REFRESH = 'portfolio.refresh_stats'
+
+
+JOB_MAX_ATTEMPTS = 5
+JOB_LEASE_SECONDS = 300  # a running job is reclaimed by another worker after its lease expires
+JOB_RETRY_BACKOFF_SECONDS = 10  # doubled after each failed attempt
+JOB_WORKER_POLL_INTERVAL_SECONDS = 1
+JOB_RETENTION_DAYS = 14  # done and failed jobs are deleted after this
@@ -3,3 +3,9 @@
 #. .env
 
 python -m app.api.tools.ai_credits_refill
+
+# rebuild the rolling XP counters from the ledgers
+python -m app.api.tools.xp_counters_reconcile
+
+# delete old done/failed jobs
+python -m app.api.tools.prune_jobs
@@ -1,15 +1,16 @@
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 import math
 
-from sqlalchemy import or_, and_, func
+from sqlalchemy import or_, and_, func, case
 import sqlalchemy
-from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm import Session, aliased, contains_eager, with_expression
 from sqlalchemy.exc import SQLAlchemyError
 
 import app.api.constants as c
 from app.models import models, api_schema, enums
 from app.api.exceptions import SnipsInsuficientFundsError, SnipsInsufficientInstrumentQuantityError, SnipsError
+from app.api import xp_counters, xp_rollup, xp_epochs, portfolio_stats
 
 def get_instruments(db: Session, q: Optional[str], sort: Optional[str], show_well_known_only: Optional[int], skip: int, limit: int):
 
@@ -88,6 +89,19 @@ def get_instrument_bars(db: Session, instrument_id: int, lookback_hours: int, ba
         .order_by(models.InstrumentKPI_PriceHistory.date_as_of) \
         .all()
 
+def get_portfolio_value_history(db: Session, portfolio_id: int, lookback_hours: int, bar_interval: str):
+
+    lookback_date = datetime.now(timezone.utc) - timedelta(hours=lookback_hours)
+
+    return db.query(models.PortfolioValueHistory) \
+        .filter(
+            models.PortfolioValueHistory.portfolio_id == portfolio_id,
+            models.PortfolioValueHistory.timeframe == bar_interval,
+            models.PortfolioValueHistory.date_as_of >= lookback_date
+        ) \
+        .order_by(models.PortfolioValueHistory.date_as_of) \
+        .all()
+
 def create_user(db: Session, user: models.User):
     db.add(user)
     db.commit()
@@ -106,13 +120,17 @@ def get_account_by_user_id(db: Session, user_id: int, provider: str):
         models.Account.provider == provider
     )).first()
 
-def update_user_last_active_date(db: Session, user_id: int):
-    user = get_user_by_id(db, user_id)
-    user.date_last_active = func.now()
-    db.merge(user)
-    db.commit()
-    db.refresh(user)
-    return user
+def update_users_last_active_date(db: Session, user_ids: set):
+    """
+    Does not commit. Returns the ids of the users updated, the others have been deleted
+    """
+    return set(db.execute(
+        sqlalchemy.update(models.User)
+            .where(models.User.id.in_(user_ids))
+            .values({models.User.date_last_active: func.now()})
+            .returning(models.User.id)
+            .execution_options(synchronize_session=False)
+    ).scalars())
 
 def set_user_last_seen_attributes(db: Session, user_id: int, app_version: Optional[str] = None, platform_name: Optional[str] = None):
     user = get_user_by_id(db, user_id)
@@ -217,10 +235,25 @@ def get_portfolios_by_user_id(db: Session, q: Optional[str], target_user_id: int
         ) \
         .offset(skip).limit(limit).all()
 
+def get_default_portfolio_by_user_id(db: Session, user_id: int):
+    return db.query(models.Portfolio) \
+        .filter(
+            models.Portfolio.user_id == user_id,
+            models.Portfolio.status != 'deleted',
+        ) \
+        .order_by(models.Portfolio.id) \
+        .first()
+
 def get_portfolios_leaderboard(db: Session, q: Optional[str], skip: int, limit: int):
 
-    lookback_days = 10
-    date_leaderboard_lookback = datetime.now(timezone.utc) - timedelta(days=lookback_days)
+    if not q:
+        # pages of the ranked table, recomputed after each bulk stats refresh
+        return [
+            entry.portfolio
+            for entry in get_gain_leaderboard_entries(db=db, first_rank=skip + 1, last_rank=skip + limit)
+        ]
+
+    date_leaderboard_lookback = datetime.now(timezone.utc) - timedelta(days=c.LEADERBOARD_GAIN_LOOKBACK_DAYS)
 
     return db.query(models.Portfolio) \
         .join(models.PortfolioStats) \
@@ -268,10 +301,77 @@ def create_transaction(
         raise
     return transaction
 
+def get_gain_leaderboard_entries(db: Session, first_rank: int, last_rank: int):
+    # portfolios made private or deleted since the table was ranked are left out, their ranks are skipped
+    return db.query(models.PortfolioGainLeaderboard) \
+        .join(models.PortfolioGainLeaderboard.portfolio) \
+        .options(contains_eager(models.PortfolioGainLeaderboard.portfolio)) \
+        .filter(
+            models.PortfolioGainLeaderboard.rank.between(first_rank, last_rank),
+            models.Portfolio.is_public == 1,
+            models.Portfolio.status == 'active',
+        ) \
+        .order_by(models.PortfolioGainLeaderboard.rank) \
+        .all()
+
+def get_gain_leaderboard_entry_by_portfolio_id(db: Session, portfolio_id: int):
+    return db.query(models.PortfolioGainLeaderboard) \
+        .filter(models.PortfolioGainLeaderboard.portfolio_id == portfolio_id) \
+        .first()
+
+def count_gain_leaderboard_entries(db: Session):
+    # ranks are contiguous from 1
+    return db.query(func.coalesce(func.max(models.PortfolioGainLeaderboard.rank), 0)).scalar()
+
+def get_xp_snapshot_dates(db: Session, timeframe: str, skip: int, limit: int):
+    return [
+        date_as_of for (date_as_of, ) in db
+            .query(models.XPSnapshot.date_as_of)
+            .filter(models.XPSnapshot.timeframe == xp_epochs.SNAPSHOT_TIMEFRAMES[timeframe])
+            .distinct()
+            .order_by(models.XPSnapshot.date_as_of.desc())
+            .offset(skip)
+            .limit(limit)
+            .all()
+    ]
+
+def get_xp_snapshot_leaderboard(db: Session, timeframe: str, date_as_of: datetime, skip: int, limit: int):
+    """
+    [(rank, xp_collected, portfolio)] of the public active portfolios in a snapshot, ranked by their user's XP
+    """
+    ranked = db \
+        .query(
+            func.row_number().over(
+                order_by=(models.XPSnapshot.xp_collected.desc(), models.Portfolio.id)
+            ).label('rank'),
+            models.XPSnapshot.xp_collected,
+            models.Portfolio.id.label('portfolio_id'),
+        ) \
+        .join(models.Portfolio, models.Portfolio.user_id == models.XPSnapshot.user_id) \
+        .filter(
+            models.XPSnapshot.timeframe == xp_epochs.SNAPSHOT_TIMEFRAMES[timeframe],
+            models.XPSnapshot.date_as_of == date_as_of,
+            models.Portfolio.is_public == 1,
+            models.Portfolio.status == 'active',
+        ) \
+        .subquery('ranked')
+
+    return db \
+        .query(ranked.c.rank, ranked.c.xp_collected, models.Portfolio) \
+        .join(models.Portfolio, models.Portfolio.id == ranked.c.portfolio_id) \
+        .order_by(ranked.c.rank) \
+        .offset(skip) \
+        .limit(limit) \
+        .all()
+
 def get_portfolio_transaction_by_id(db: Session, id: int):
     return db.query(models.PortfolioTransaction).filter(models.PortfolioTransaction.id == id).first()
 
-def execute_portfolio_transaction(db: Session, id: int):
+def execute_portfolio_transaction(db: Session, id: int, commit: bool = True):
+    """
+    Execute a transaction. With commit=False the changes are only flushed, so that the caller
+    can add to the same transaction (e.g. queue a job) before committing
+    """
     transaction = get_portfolio_transaction_by_id(db, id)
     portfolio = get_portfolio_by_id(db, transaction.portfolio_id)
     instrument = get_instrument_by_id(db, transaction.associated_instrument_id)
@@ -335,8 +435,13 @@ def execute_portfolio_transaction(db: Session, id: int):
         db.merge(holding)
         db.merge(portfolio)
         db.merge(transaction)
+        xp_counters.record_executed_transaction(db=db, transaction=transaction)
+        portfolio_stats.record_executed_transaction(db=db, transaction=transaction)
 
-        db.commit()
+        if commit:
+            db.commit()
+        else:
+            db.flush()
     except SQLAlchemyError as e:
         db.rollback()
         raise
@@ -345,23 +450,134 @@ def execute_portfolio_transaction(db: Session, id: int):
         raise
     return transaction
 
-def get_holdings_by_portfolio_id(db: Session, portfolio_id: int, skip: int, limit: int, sort_by: str, sort_order: str, ignore_sold_off: bool):
+def get_order_trigger_direction(order_type: str, side: str):
+    """
+    Limit buys and stop-losses wait for the price to fall to the trigger price,
+    limit sells and take-profits wait for the price to rise to it
+    """
+    if order_type == models.PortfolioOrderType.STOP_LOSS.value or (
+        order_type == models.PortfolioOrderType.LIMIT.value and side == models.PortfolioTransactionTypeUserScope.BUY.value
+    ):
+        return models.PortfolioOrderTriggerDirection.BELOW.value
+    return models.PortfolioOrderTriggerDirection.ABOVE.value
+
+def create_order(
+    db: Session,
+    portfolio_id: int,
+    instrument_id: int,
+    order_type: str,
+    side: str,
+    quantity: float,
+    trigger_price: float,
+    message: Optional[str],
+    ):
+    try:
+        order = models.PortfolioOrder(
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+            order_type=order_type,
+            side=side,
+            quantity=quantity,
+            trigger_price=trigger_price,
+            trigger_direction=get_order_trigger_direction(order_type=order_type, side=side),
+            status='open',
+            message=message,
+        )
+        db.add(order)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise
+    return order
+
+def get_order_by_id(db: Session, id: int):
+    return db.query(models.PortfolioOrder).filter(models.PortfolioOrder.id == id).first()
+
+def get_orders_by_portfolio_id(db: Session, portfolio_id: int, status: Optional[str], skip: int, limit: int):
+    return db.query(models.PortfolioOrder) \
+        .filter(models.PortfolioOrder.portfolio_id == portfolio_id) \
+        .filter(
+            models.PortfolioOrder.status == status if status else True
+        ) \
+        .order_by(models.PortfolioOrder.id.desc()) \
+        .offset(skip).limit(limit).all()
+
+def cancel_order(db: Session, id: int):
+    """
+    Cancel an open order. The status check is part of the update so that
+    an order filled by the matching engine in the meantime stays executed
+    """
+    try:
+        n_cancelled = db.query(models.PortfolioOrder) \
+            .filter(
+                models.PortfolioOrder.id == id,
+                models.PortfolioOrder.status == 'open',
+            ) \
+            .update({
+                models.PortfolioOrder.status: 'cancelled',
+                models.PortfolioOrder.date_last_updated: func.now(),
+            }, synchronize_session=False)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise
+    if n_cancelled == 0:
+        raise SnipsError('Only open orders can be cancelled')
+    return get_order_by_id(db, id)
+
+def get_holding_valuation():
+    """
+    Expressions of the Holding valuation attributes, for queries joining Instrument and InstrumentKPI_LatestPrice.
+    Valued at the latest price, holdings of instruments without a price have no value
+    """
+    current_price = models.InstrumentKPI_LatestPrice.price
+    return {
+        'current_price': current_price,
+        'market_value': models.Holding.quantity * current_price,
+        'unrealized_pnl': models.Holding.quantity * (current_price - models.Holding.average_price),
+        'unrealized_pnl_perc': case(
+            (models.Holding.average_price > 0, (current_price / models.Holding.average_price - 1) * 100),
+            else_=None
+        ),
+    }
+
+def query_valued_holdings(db: Session):
+    valuation = get_holding_valuation()
     return db \
         .query(models.Holding) \
         .join(models.Instrument, models.Holding.instrument_id == models.Instrument.id) \
+        .outerjoin(models.InstrumentKPI_LatestPrice, models.InstrumentKPI_LatestPrice.instrument_id == models.Instrument.id) \
+        .options(
+            contains_eager(models.Holding.instrument).contains_eager(models.Instrument.kpi_latest_price),
+            *(with_expression(getattr(models.Holding, name), expression) for name, expression in valuation.items()),
+        )
+
+def get_holdings_by_portfolio_id(db: Session, portfolio_id: int, skip: int, limit: int, sort_by: str, sort_order: str, ignore_sold_off: bool):
+    valuation = get_holding_valuation()
+    order_by_options = {
+        'date_last_updated': models.Holding.date_last_updated,
+        'market_value': valuation['market_value'],
+        'unrealized_pnl': valuation['unrealized_pnl'],
+        'unrealized_pnl_perc': valuation['unrealized_pnl_perc'],
+        'quantity': models.Holding.quantity,
+        'name': models.Instrument.name,
+    }
+    order_by_param = order_by_options.get(sort_by, models.Holding.date_last_updated)
+    order_by_param = order_by_param.asc() if sort_order and sort_order.lower() == 'asc' else order_by_param.desc()
+
+    return query_valued_holdings(db) \
         .filter(models.Instrument.status == 'active') \
         .filter(models.Holding.portfolio_id == portfolio_id) \
         .filter(
             models.Holding.quantity > 0 if ignore_sold_off else True
         ) \
-        .order_by(models.Holding.date_last_updated.desc()) \
+        .order_by(order_by_param.nulls_last(), models.Holding.instrument_id) \
         .offset(skip) \
         .limit(limit) \
         .all()
 
 def get_holding_by_id(db: Session, portfolio_id: int, instrument_id: int):
-    return db.query(models.Holding) \
-        .join(models.Instrument, models.Holding.instrument_id == models.Instrument.id) \
+    return query_valued_holdings(db) \
         .filter(models.Instrument.status == 'active') \
         .filter(and_(
             models.Holding.portfolio_id == portfolio_id,
@@ -416,48 +632,47 @@ def refresh_portfolio_stats(db: Session, portfolio_id: int, refresh_timeout: int
             ) \
             .scalar()
 
-        sales_value = db \
-            .query(func.sum(models.PortfolioTransaction.value)) \
-            .filter(
-                models.PortfolioTransaction.portfolio_id == portfolio_id,
-                models.PortfolioTransaction.status == 'executed',
-                models.PortfolioTransaction.transaction_type == 'sell') \
-            .scalar() or 0
-
-        book_cost = db \
-            .query(func.sum(models.PortfolioTransaction.value)) \
-            .filter(
-                models.PortfolioTransaction.portfolio_id == portfolio_id,
-                models.PortfolioTransaction.status == 'executed',
-                models.PortfolioTransaction.transaction_type == 'buy') \
-            .scalar() or 0
-
         current_value = db \
             .query(func.sum(models.Holding.quantity * models.InstrumentKPI_LatestPrice.price)) \
             .join(models.InstrumentKPI_LatestPrice, models.Holding.instrument_id == models.InstrumentKPI_LatestPrice.instrument_id) \
             .filter(models.Holding.portfolio_id == portfolio_id) \
             .scalar() or 0
 
-        net_worth = current_value + available_cash    
-        pnl = sales_value + current_value - book_cost
-
-        print('available cash: ', available_cash)
-        print('sales value', sales_value)
-        print('book cost', book_cost)
-        print('current value', current_value)
-        print('net worth', net_worth)
-        print('P&L', pnl)
-
-        stats = models.PortfolioStats(
-            portfolio_id=portfolio_id,
-            total_net_worth=net_worth,
-            total_book_value=book_cost,
-            total_gain=pnl,
-            date_last_updated=func.now()
-        )
+        net_worth = current_value + available_cash
+
+        if stats is None or stats.total_book_value is None or stats.total_sales_value is None:
+            # first refresh: the running totals are computed once from the transaction history
+            book_cost, sales_value = db \
+                .query(
+                    func.coalesce(func.sum(models.PortfolioTransaction.value).filter(models.PortfolioTransaction.transaction_type == 'buy'), 0),
+                    func.coalesce(func.sum(models.PortfolioTransaction.value).filter(models.PortfolioTransaction.transaction_type == 'sell'), 0),
+                ) \
+                .filter(
+                    models.PortfolioTransaction.portfolio_id == portfolio_id,
+                    models.PortfolioTransaction.status == 'executed') \
+                .one()
+
+            stats = models.PortfolioStats(
+                portfolio_id=portfolio_id,
+                total_net_worth=net_worth,
+                total_book_value=book_cost,
+                total_sales_value=sales_value,
+                total_gain=sales_value + current_value - book_cost,
+                date_last_updated=func.now()
+            )
+            db.merge(stats)
+        else:
+            # the totals are read in the UPDATE itself, so trades executed meanwhile are not overwritten
+            db.query(models.PortfolioStats) \
+                .filter(models.PortfolioStats.portfolio_id == portfolio_id) \
+                .update({
+                    models.PortfolioStats.total_net_worth: net_worth,
+                    models.PortfolioStats.total_gain: models.PortfolioStats.total_sales_value + current_value - models.PortfolioStats.total_book_value,
+                    models.PortfolioStats.date_last_updated: func.now(),
+                }, synchronize_session=False)
 
-        db.merge(stats)
         db.commit()
+        stats = get_portfolio_stats(db, portfolio_id)
     return stats
 
 
@@ -675,39 +890,81 @@ def count_user_portfolios(db: Session, user_id: int):
         .scalar()
 
 
-def claim_portfolio_reward(db: Session, portfolio_id: int, reward_type: str, reward_amount: float):
-    portfolio = get_portfolio_by_id(db=db, id=portfolio_id)
-    try:     
+REWARD_CLAIM_COLUMNS = {
+    'REWARD_WEEKLY': models.Portfolio.date_last_claimed_weekly_reward,
+    'REWARD_DAILY': models.Portfolio.date_last_claimed_daily_reward,
+    'REWARD_INTRADAY': models.Portfolio.date_last_claimed_intraday_reward,
+}
 
-        # deposit a reward to the portfolio and update last claimed date
-        portfolio.cash_balance = portfolio.cash_balance + reward_amount
-        portfolio.date_last_updated = func.now()
-        if reward_type == 'REWARD_WEEKLY':
-            portfolio.date_last_claimed_weekly_reward = func.now()
-        elif reward_type == 'REWARD_DAILY':
-            portfolio.date_last_claimed_daily_reward = func.now()
-        elif reward_type == 'REWARD_INTRADAY':
-            portfolio.date_last_claimed_intraday_reward = func.now()
-        else:
-            db.rollback()
-            raise SnipsError
-        
-        db.merge(portfolio)
+def claim_portfolio_rewards(db: Session, portfolio_id: int, user_id: int, rewards: dict):
+    """
+    Claim the eligible ones of the given {reward type: amount} for a portfolio of the user, in one transaction, and commit.
 
-        # add transaction to portfolio
-        transaction = models.PortfolioTransaction(
-            portfolio_id=portfolio_id,
-            associated_instrument_id=None,
-            transaction_type=reward_type,
-            quantity=reward_amount,
-            value=reward_amount,
-            status='executed',
-            date_executed=func.now()
+    A single conditional UPDATE ... RETURNING checks eligibility, deposits the cash and sets the claim dates:
+    the row lock serialises concurrent claims, and a claim waiting on it re-checks eligibility against
+    the claim dates just set, so a double tap claims nothing the second time. The reward transactions,
+    the net worth delta and the XP of the claimed rewards are written in the same transaction.
+
+    Returns the {reward type: amount} claimed, empty if none was eligible or the portfolio is not the user's
+    """
+    eligible = {
+        reward_type: or_(
+            REWARD_CLAIM_COLUMNS[reward_type] == None,
+            REWARD_CLAIM_COLUMNS[reward_type] <= func.now() - timedelta(minutes=c.REWARD_COOLDOWN_MINUTES[reward_type]),
         )
+        for reward_type in rewards
+    }
+    cash_credit = sum(
+        case((is_eligible, rewards[reward_type]), else_=0)
+        for reward_type, is_eligible in eligible.items()
+    )
+
+    try:
+        claimed_row = db.execute(
+            sqlalchemy.update(models.Portfolio)
+                .where(
+                    models.Portfolio.id == portfolio_id,
+                    models.Portfolio.user_id == user_id,
+                    or_(*eligible.values()),
+                )
+                .values({
+                    models.Portfolio.cash_balance: models.Portfolio.cash_balance + cash_credit,
+                    models.Portfolio.date_last_updated: func.now(),
+                    **{
+                        REWARD_CLAIM_COLUMNS[reward_type]: case((is_eligible, func.now()), else_=REWARD_CLAIM_COLUMNS[reward_type])
+                        for reward_type, is_eligible in eligible.items()
+                    },
+                })
+                # now() is the transaction start time, so the claim dates equal to it are the ones just set
+                .returning(*(REWARD_CLAIM_COLUMNS[reward_type] == func.now() for reward_type in rewards))
+                .execution_options(synchronize_session=False)
+        ).first()
+        if claimed_row is None:
+            db.rollback()
+            return {}
+
+        claimed = {reward_type: rewards[reward_type] for reward_type, is_claimed in zip(rewards, claimed_row) if is_claimed}
+        db.execute(sqlalchemy.insert(models.PortfolioTransaction).values(date_executed=func.now()), [
+            {
+                'portfolio_id': portfolio_id,
+                'associated_instrument_id': None,
+                'transaction_type': reward_type,
+                'quantity': reward_amount,
+                'value': reward_amount,
+                'status': 'executed',
+            }
+            for reward_type, reward_amount in claimed.items()
+        ])
+        portfolio_stats.record_cash_credit(db=db, portfolio_id=portfolio_id, amount=sum(claimed.values()))
+
+        # credit XP for claiming a bonus
+        credit_xp(db=db, credits=[
+            XPCredit(user_id=user_id, amount=c.XP_CREDIT.COLLECT_REWARD, reason=c.XP_REASON.COLLECT_REWARD, detail=reward_type)
+            for reward_type in claimed
+        ], commit=False)
 
-        db.add(transaction)
         db.commit()
-        return portfolio
+        return claimed
     except SQLAlchemyError as e:
         db.rollback()
         raise SnipsError
@@ -745,51 +1002,117 @@ def get_instruments_by_collection_id(db: Session, collection_id: int, q: Optiona
         .all()
 
 
-def credit_xp_by_user_id(db: Session, user_id: int, xp_amount: int, xp_reason: str, xp_detail: Optional[str]=None, referrer_level: Optional[int]=0):
-    """
-    To properly credit user's XP, it takes 3 steps:
+class XPCredit(NamedTuple):
+    user_id: int
+    amount: int
+    reason: str
+    detail: Optional[str] = None
 
-    1. Create an XP transaction
-    2. Increment user's total XP
-    3. Increment user's weekly XP
 
-    The latter two steps must be done carefully as to avoid race condition
+def credit_xp(db: Session, credits: List[XPCredit], commit: bool = True):
     """
+    Credit XP to one or many users in a single transaction, and commit (unless commit is False,
+    e.g. to credit XP in the transaction of the action it rewards).
 
-    if referrer_level > c.MAX_REFERRER_LEVEL:
-        return
-    
-    next_referrer_level = referrer_level + 1
+    1. Resolve the referrer yield chain of every credit, up to c.MAX_REFERRER_LEVEL, with a recursive query
+    2. Insert all XP transactions at once, with ids allocated upfront so that the referrer yields can
+       reference the transaction they derive from
+    3. Increment total, weekly and season XP with one UPDATE ... FROM (VALUES ...), which adds to the
+       current values, so that concurrent credits are not lost (weekly and season XP of a previous epoch are replaced)
+    4. Add the credits to the rolling XP counters and the daily rollup
 
-    # Create transaction
-    transaction = models.XPTransaction(
-        user_id=user_id,
-        amount=xp_amount,
-        reason=xp_reason,
-        detail=xp_detail,
+    Returns the ids of the XP transactions of the given credits, in order
+    """
+    credits = [XPCredit(*credit) for credit in credits]
+    if not credits:
+        return []
+
+    inputs = sqlalchemy.values(
+        sqlalchemy.column('idx', sqlalchemy.Integer),
+        sqlalchemy.column('user_id', sqlalchemy.Integer),
+        sqlalchemy.column('amount', sqlalchemy.Integer),
+        name='credits'
+    ).data([(idx, credit.user_id, credit.amount) for idx, credit in enumerate(credits)])
+
+    chain = sqlalchemy.select(
+            inputs.c.idx,
+            sqlalchemy.literal_column('0', sqlalchemy.Integer).label('level'),
+            inputs.c.user_id,
+            inputs.c.amount,
+        ) \
+        .cte('chain', recursive=True)
+    referrer_amount = sqlalchemy.cast(func.floor(chain.c.amount * c.XP_CREDIT.REFERRER_YIELD_FACTOR), sqlalchemy.Integer)
+    chain = chain.union_all(
+        sqlalchemy.select(
+                chain.c.idx,
+                chain.c.level + 1,
+                models.User.referrer_id,
+                referrer_amount,
+            ) \
+            .join(models.User, models.User.id == chain.c.user_id) \
+            .where(
+                models.User.referrer_id != None,
+                chain.c.level < c.MAX_REFERRER_LEVEL,
+                referrer_amount > 0,
+            )
     )
-    db.add(transaction)
+    chain_rows = db.execute(sqlalchemy.select(chain).order_by(chain.c.idx, chain.c.level)).all()
+
+    transaction_ids = db.execute(
+        sqlalchemy.select(func.nextval(func.pg_get_serial_sequence('xp_transactions', 'id')))
+            .select_from(func.generate_series(1, len(chain_rows)))
+    ).scalars().all()
+
+    transactions = []
+    increments = {}
+    for (idx, level, user_id, amount), transaction_id in zip(chain_rows, transaction_ids):
+        if level == 0:
+            reason, detail = credits[idx].reason, credits[idx].detail
+        else:
+            # the yield of a referrer derives from the credit one level down
+            parent = transactions[-1]
+            reason, detail = c.XP_REASON.REFERRER_YIELD, f"{parent['reason']},XPT={parent['id']}"
+        transactions.append({'id': transaction_id, 'user_id': user_id, 'amount': amount, 'reason': reason, 'detail': detail})
+        increments[user_id] = increments.get(user_id, 0) + amount
 
-    # Get user object + increment XP stats
-    user = get_user_by_id(db=db, id=user_id)
-    user.xp_total = models.User.xp_total + xp_amount
-    user.xp_current_week = models.User.xp_current_week + xp_amount
-    user.xp_current_season = models.User.xp_current_season + xp_amount
-    db.merge(user)
+    try:
+        db.execute(sqlalchemy.insert(models.XPTransaction), transactions)
+
+        user_increments = sqlalchemy.values(
+            sqlalchemy.column('user_id', sqlalchemy.Integer),
+            sqlalchemy.column('amount', sqlalchemy.Integer),
+            name='increments'
+        ).data(sorted(increments.items()))
+        xp_epochs.lock_current_epochs(db=db)
+        db.execute(
+            sqlalchemy.update(models.User)
+                .where(models.User.id == user_increments.c.user_id)
+                .values({
+                    models.User.xp_total: models.User.xp_total + user_increments.c.amount,
+                    **xp_epochs.get_increment_values(user_increments.c.amount),
+                })
+                .execution_options(synchronize_session=False)
+        )
 
-    # Commit the changes
-    db.commit()
+        for transaction in transactions:
+            xp_counters.record_xp_credit(db=db, user_id=transaction['user_id'], xp_reason=transaction['reason'], xp_amount=transaction['amount'])
+        xp_rollup.record_xp_credits(db=db, transactions=transactions)
+
+        if commit:
+            db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise
+
+    return [transaction['id'] for transaction, (idx, level, *_) in zip(transactions, chain_rows) if level == 0]
 
-    referrer_xp_amount = int(c.XP_CREDIT.REFERRER_YIELD_FACTOR * xp_amount)
-    if referrer_xp_amount > 0 and user.referrer is not None:
-        credit_xp_by_user_id(
-            db=db,
-            user_id=user.referrer_id,
-            xp_amount=int(c.XP_CREDIT.REFERRER_YIELD_FACTOR * xp_amount),
-            xp_reason=c.XP_REASON.REFERRER_YIELD,
-            xp_detail=f"{xp_reason},XPT={transaction.id}",
-            referrer_level=next_referrer_level
-        )
+
+def credit_xp_by_user_id(db: Session, user_id: int, xp_amount: int, xp_reason: str, xp_detail: Optional[str]=None):
+    """
+    Credit XP to a user, and the referrer yields up the referrer chain, in one transaction.
+    See credit_xp
+    """
+    credit_xp(db=db, credits=[XPCredit(user_id=user_id, amount=xp_amount, reason=xp_reason, detail=xp_detail)])
 
 
 def get_xp_leaderboard(db: Session, q: Optional[str], skip: int, limit: int, timeframe: str='weekly'):
@@ -803,9 +1126,14 @@ def get_xp_leaderboard(db: Session, q: Optional[str], skip: int, limit: int, tim
         .filter( # filter by portfolio name
             models.Portfolio.name.ilike(f"%{q}%") if q else True
         ) \
+        .filter( # weekly and season leaderboards only rank users with XP in the current epoch, as leaderboard.XPLeaderboard
+            and_(xp_epochs.get_current_epoch_filter(xp_epochs.SEASON), models.User.xp_current_season_value > 0) if timeframe == 'season' else
+            and_(xp_epochs.get_current_epoch_filter(xp_epochs.WEEKLY), models.User.xp_current_week_value > 0) if timeframe == 'weekly' else
+            True
+        ) \
         .order_by(
-            models.User.xp_current_season.desc() if timeframe == 'season' else
-            models.User.xp_current_week.desc() if timeframe == 'weekly' else
+            models.User.xp_current_season_value.desc() if timeframe == 'season' else
+            models.User.xp_current_week_value.desc() if timeframe == 'weekly' else
             models.User.xp_total.desc()
         ) \
         .offset(skip) \
@@ -819,19 +1147,13 @@ def credit_xp_on_transaction_execute_if_eligible(db: Session, transaction_id: in
         return False
     # c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS
 
-    date_24_hours_ago = datetime.now(tz=timezone.utc) - timedelta(hours=24)
-
-    n_transactions_with_messages = db \
-        .query(models.PortfolioTransaction) \
-        .filter (
-            models.PortfolioTransaction.portfolio_id == transaction.portfolio_id,
-            models.PortfolioTransaction.status == 'executed',
-            models.PortfolioTransaction.date_executed != None,
-            models.PortfolioTransaction.message != None,
-            models.PortfolioTransaction.associated_instrument_id != None,
-            models.PortfolioTransaction.date_executed > date_24_hours_ago,
-        ) \
-        .count()
+    # executed transactions with a message in the last 24 hours
+    n_transactions_with_messages = xp_counters.get_counter_sum(
+        db=db,
+        scope=xp_counters.SCOPE_PORTFOLIO,
+        scope_id=transaction.portfolio_id,
+        counter=c.XP_COUNTER.MESSAGE_TRANSACTION,
+    )
     
     # if this is the first purchase of the asset in 24 hours and there are 5 or less unique assets purchased in total
     if n_transactions_with_messages <= c.XP_LIMIT.FEED_MESSAGE_UNIQUE_TRANSACTIONS:
@@ -853,35 +1175,21 @@ def credit_xp_on_buy_if_eligible(db: Session, transaction_id: int):
         return False
     # c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS
 
-    date_24_hours_ago = datetime.now(tz=timezone.utc) - timedelta(hours=24)
-
-    n_transactions_with_instrument = db \
-        .query(models.PortfolioTransaction) \
-        .filter (
-            models.PortfolioTransaction.portfolio_id == transaction.portfolio_id,
-            models.PortfolioTransaction.status == 'executed',
-            models.PortfolioTransaction.date_executed != None,
-            models.PortfolioTransaction.associated_instrument_id == transaction.associated_instrument_id,
-            models.PortfolioTransaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value,
-            models.PortfolioTransaction.date_executed > date_24_hours_ago,
-        ) \
-        .count()
-    
-    n_unique_instruments = db \
-        .query(models.PortfolioTransaction) \
-        .distinct(models.PortfolioTransaction.associated_instrument_id) \
-        .filter (
-            models.PortfolioTransaction.portfolio_id == transaction.portfolio_id,
-            models.PortfolioTransaction.status == 'executed',
-            models.PortfolioTransaction.date_executed != None,
-            models.PortfolioTransaction.associated_instrument_id != None,
-            models.PortfolioTransaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value,
-            models.PortfolioTransaction.date_executed > date_24_hours_ago,
-        ) \
-        .count()
-
+    # buys of this instrument and unique instruments bought in the last 24 hours
+    n_transactions_with_instrument = xp_counters.get_counter_sum(
+        db=db,
+        scope=xp_counters.SCOPE_PORTFOLIO,
+        scope_id=transaction.portfolio_id,
+        counter=c.XP_COUNTER.BUY_INSTRUMENT,
+        member=str(transaction.associated_instrument_id),
+    )
+    n_unique_instruments = xp_counters.count_counter_members(
+        db=db,
+        scope=xp_counters.SCOPE_PORTFOLIO,
+        scope_id=transaction.portfolio_id,
+        counter=c.XP_COUNTER.BUY_INSTRUMENT,
+    )
 
-    
     # if this is the first purchase of the asset in 24 hours and there are 5 or less unique assets purchased in total
     if n_transactions_with_instrument == 1 and n_unique_instruments <= c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS:
         user_id = transaction.portfolio.user_id
@@ -907,16 +1215,13 @@ def credit_xp_on_sell_if_eligible(db: Session, transaction_id: int):
     gain = math.floor((sale_price - ex_avg_price) * transaction.quantity)
     if gain > 0:
         # print('gain > 0')
-        date_24_hours_ago = datetime.now(tz=timezone.utc) - timedelta(hours=24)
-
-        xp_credited_in_24_hrs = db \
-            .query(func.sum(models.XPTransaction.amount)) \
-            .filter (
-                models.XPTransaction.user_id == transaction.portfolio.user_id,
-                models.XPTransaction.reason == c.XP_REASON.SELL_ASSET_AT_PROFIT,
-                models.XPTransaction.date_credited > date_24_hours_ago,
-            ) \
-            .scalar() or 0
+        xp_credited_in_24_hrs = xp_counters.get_counter_sum(
+            db=db,
+            scope=xp_counters.SCOPE_USER,
+            scope_id=transaction.portfolio.user_id,
+            counter=c.XP_COUNTER.XP_CREDITED,
+            member=c.XP_REASON.SELL_ASSET_AT_PROFIT,
+        )
         
         if xp_credited_in_24_hrs >= c.XP_LIMIT.SELL_AT_PROFIT_MAX_DAILY_XP:
             return False
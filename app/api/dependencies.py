@@ -1,6 +1,14 @@
 import os
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from fastapi import Depends
 from fastapi_login import LoginManager
+from sqlalchemy.orm import Session
+
+from app.api import crud, last_active
 from app.api.database import SessionLocal
+from app.models import models
 
 
 def get_db():
@@ -11,5 +19,73 @@ def get_db():
         db.close()
 
 
+class Principal(NamedTuple):
+    """
+    Authenticated user as stated by the access token claims. Only the id is carried: anything that can change
+    during the token's lifetime (e.g. the premium status) is read from the user row, see get_db_user
+    """
+    id: int
+    date_issued: Optional[datetime]
+
+
+class PrincipalLoginManager(LoginManager):
+    """
+    LoginManager whose dependency returns the Principal decoded from the access token,
+    without a database round trip. Handlers which need the user row depend on get_db_user
+    """
+
+    def create_user_access_token(self, user: models.User, expires: timedelta):
+        return self.create_access_token(
+            data={
+                'sub': str(user.id),
+                'iat': int(datetime.now(tz=timezone.utc).timestamp()),
+            },
+            expires=expires
+        )
+
+    async def get_current_user(self, token: str):
+        payload = self._get_payload(token)
+        user_id = payload.get('sub')
+        if user_id is None:
+            raise self.not_authenticated_exception
+
+        if 'iat' in payload:
+            principal = Principal(id=int(user_id), date_issued=datetime.fromtimestamp(payload['iat'], tz=timezone.utc))
+        else:
+            # tokens issued before the claims were added: the user is loaded once per request until they are refreshed
+            user = await self._load_user(user_id)
+            if user is None:
+                raise self.not_authenticated_exception
+            principal = Principal(id=user.id, date_issued=None)
+
+        # the account was deleted after the token was issued
+        if last_active.tracker.is_deleted(principal.id):
+            raise self.not_authenticated_exception
+
+        last_active.tracker.touch(principal.id)
+        return principal
+
+
 auth_secret = os.getenv("APP_AUTH_SECRET", None)
-manager = LoginManager(auth_secret, '/users')
+manager = PrincipalLoginManager(auth_secret, '/users')
+
+
+@manager.user_loader()
+def load_principal_user(user_id: str):
+    db = SessionLocal()
+    try:
+        return crud.get_user_by_id(db=db, id=user_id)
+    finally:
+        db.close()
+
+
+def get_db_user(
+        principal: Principal = Depends(manager),
+        db: Session = Depends(get_db)) -> models.User:
+    """
+    The authenticated user, loaded with the request session
+    """
+    user = crud.get_user_by_id(db=db, id=principal.id)
+    if user is None:
+        raise manager.not_authenticated_exception
+    return user
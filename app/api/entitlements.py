@@ -0,0 +1,242 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, NamedTuple, Optional, Tuple
+
+import requests
+from dateutil import parser
+from sqlalchemy import DateTime, Integer, and_, case, cast, column, or_, update, values
+from sqlalchemy.orm import Session
+
+import app.api.constants as c
+from app.models import api_schema, models
+
+logger = logging.getLogger(__name__)
+
+REVCAT_SUBSCRIBERS_URL = 'https://api.revenuecat.com/v1/subscribers'
+
+
+class Entitlement(NamedTuple):
+    is_premium: bool
+    expires_date: Optional[datetime]  # including the grace period, None for a lifetime entitlement
+
+
+def get_revcat_user_id(user_id: int, secret_id: str):
+    return f"{user_id}_{secret_id}"
+
+
+def parse_revcat_user_id(revcat_user_id: str) -> Optional[Tuple[int, str]]:
+    """
+    (user id, secret id) of a RevenueCat app user id, None for anonymous ids
+    """
+    user_id, separator, secret_id = revcat_user_id.partition('_')
+    if not separator or not user_id.isdigit():
+        return None
+    return int(user_id), secret_id
+
+
+def get_entitlement(expires_date: Optional[datetime], grace_period_expires_date: Optional[datetime]):
+    """
+    Entitlement active until the later of its expiry and grace period expiry
+    """
+    if expires_date is None:
+        return Entitlement(is_premium=True, expires_date=None)
+    expires_date = max(expires_date, grace_period_expires_date or expires_date)
+    return Entitlement(is_premium=expires_date >= datetime.now(tz=timezone.utc), expires_date=expires_date)
+
+
+def get_revcat_headers(revcat_public_api_key: str):
+    return {
+        "accept": "application/json",
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {revcat_public_api_key}"
+    }
+
+
+def fetch_entitlement(user_id: int, secret_id: str, revcat_public_api_key: str) -> Optional[Entitlement]:
+    """
+    Premium entitlement of a user from the RevenueCat API, None if it could not be fetched
+    """
+    try:
+        response = requests.get(
+            f"{REVCAT_SUBSCRIBERS_URL}/{get_revcat_user_id(user_id, secret_id)}",
+            headers=get_revcat_headers(revcat_public_api_key),
+            timeout=c.REVCAT_TIMEOUT_SECONDS
+        )
+        response.raise_for_status()
+        return parse_subscriber(response.json())
+    except (requests.RequestException, ValueError, KeyError, AttributeError) as e:
+        logger.warning(f'Could not fetch the entitlements of user {user_id}: {e}')
+        return None
+
+
+def parse_subscriber(subscriber_response: dict) -> Entitlement:
+    """
+    Premium entitlement of a RevenueCat GET /subscribers response
+    """
+    premium_data = subscriber_response['subscriber']['entitlements'].get(c.PREMIUM_ENTITLEMENT_ID)
+    if premium_data is None:
+        return Entitlement(is_premium=False, expires_date=None)
+    return get_entitlement(
+        expires_date=parser.isoparse(premium_data['expires_date']) if premium_data.get('expires_date') else None,
+        grace_period_expires_date=parser.isoparse(premium_data['grace_period_expires_date']) if premium_data.get('grace_period_expires_date') else None,
+    )
+
+
+def save_entitlement(db: Session, user_id: int, entitlement: Entitlement, date_validated: datetime, secret_id: Optional[str] = None):
+    """
+    Store the premium entitlement of a user as of date_validated, unless a more recent one is stored,
+    e.g. when webhook events arrive out of order. An upgrade from the free plan credits the premium AI credits.
+    Does not commit. Returns True if the entitlement was stored
+    """
+    user_values = {
+        models.User.is_premium: int(entitlement.is_premium),
+        models.User.premium_expires_date: entitlement.expires_date,
+        models.User.premium_date_validated: date_validated,
+    }
+    if entitlement.is_premium:
+        user_values[models.User.credit_balance] = case(
+            (models.User.is_premium == 0, models.User.credit_balance + c.AI_CREDIT.PREMIUM_USER_ADD),
+            else_=models.User.credit_balance
+        )
+
+    query = db \
+        .query(models.User) \
+        .filter(
+            models.User.id == user_id,
+            or_(
+                models.User.premium_date_validated == None,
+                models.User.premium_date_validated <= date_validated,
+            )
+        )
+    if secret_id is not None:
+        query = query.filter(models.User.secret_id == secret_id)
+    return query.update(user_values, synchronize_session=False) > 0
+
+
+def save_entitlements(db: Session, entitlements: List[Tuple[int, Entitlement]], date_validated: datetime):
+    """
+    Store the premium entitlements of many users as of date_validated with one UPDATE ... FROM (VALUES ...),
+    with the same rules as save_entitlement. Does not commit. Returns the number of users updated
+    """
+    if not entitlements:
+        return 0
+    validated = values(
+        column('user_id', Integer),
+        column('is_premium', Integer),
+        column('expires_date', DateTime(timezone=True)),
+        name='validated'
+    ).data([(user_id, int(entitlement.is_premium), entitlement.expires_date) for user_id, entitlement in entitlements])
+
+    return db.execute(
+        update(models.User)
+            .where(
+                models.User.id == validated.c.user_id,
+                or_(
+                    models.User.premium_date_validated == None,
+                    models.User.premium_date_validated <= date_validated,
+                )
+            )
+            .values({
+                models.User.is_premium: validated.c.is_premium,
+                # NULL (lifetime or free) is untyped in VALUES
+                models.User.premium_expires_date: cast(validated.c.expires_date, DateTime(timezone=True)),
+                models.User.premium_date_validated: date_validated,
+                models.User.credit_balance: case(
+                    (and_(models.User.is_premium == 0, validated.c.is_premium == 1), models.User.credit_balance + c.AI_CREDIT.PREMIUM_USER_ADD),
+                    else_=models.User.credit_balance
+                ),
+            })
+            .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def invalidate_entitlement(db: Session, user_id: int, secret_id: str, date_event: datetime):
+    """
+    Mark the cached entitlement as stale, so that it is revalidated with RevenueCat on the next request with a key.
+    Does not commit
+    """
+    db \
+        .query(models.User) \
+        .filter(
+            models.User.id == user_id,
+            models.User.secret_id == secret_id,
+            models.User.premium_date_validated <= date_event,
+        ) \
+        .update({models.User.premium_date_validated: None}, synchronize_session=False)
+
+
+def is_cached_premium(user: models.User, date_now: datetime):
+    return bool(user.is_premium) and (user.premium_expires_date is None or user.premium_expires_date >= date_now)
+
+
+def is_cache_fresh(user: models.User, date_now: datetime):
+    """
+    A premium entitlement is valid until it expires, a free plan for PREMIUM_FREE_CACHE_SECONDS,
+    as the webhook may not have been delivered yet right after a purchase
+    """
+    if user.premium_date_validated is None:
+        return False
+    if user.is_premium:
+        return user.premium_expires_date is None or user.premium_expires_date >= date_now
+    return user.premium_date_validated >= date_now - timedelta(seconds=c.PREMIUM_FREE_CACHE_SECONDS)
+
+
+def get_premium_status(db: Session, user: models.User, revcat_public_api_key: Optional[str] = None):
+    """
+    Whether a user is premium, read from the entitlement cache kept up to date by the RevenueCat webhook.
+    RevenueCat is only called if the client passed a key and the cache is stale; the refreshed
+    entitlement is then committed
+    """
+    date_now = datetime.now(tz=timezone.utc)
+    if revcat_public_api_key is None or is_cache_fresh(user=user, date_now=date_now):
+        return is_cached_premium(user=user, date_now=date_now)
+
+    entitlement = fetch_entitlement(user_id=user.id, secret_id=user.secret_id, revcat_public_api_key=revcat_public_api_key)
+    if entitlement is None:
+        return is_cached_premium(user=user, date_now=date_now)
+
+    save_entitlement(db=db, user_id=user.id, entitlement=entitlement, date_validated=date_now)
+    db.commit()
+    return entitlement.is_premium
+
+
+def _from_ms(timestamp_ms: Optional[int]):
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc) if timestamp_ms is not None else None
+
+
+def apply_revcat_event(db: Session, event: api_schema.RevenueCatEvent):
+    """
+    Update the entitlement cache from a RevenueCat webhook event. Does not commit.
+    Returns the number of users updated
+    """
+    date_event = _from_ms(event.event_timestamp_ms)
+
+    if event.type == 'TRANSFER':
+        # the event does not tell the resulting entitlements, so both sides are revalidated
+        for revcat_user_id in event.transferred_from + event.transferred_to:
+            user = parse_revcat_user_id(revcat_user_id)
+            if user is not None:
+                invalidate_entitlement(db=db, user_id=user[0], secret_id=user[1], date_event=date_event)
+        return 0
+
+    if c.PREMIUM_ENTITLEMENT_ID not in (event.entitlement_ids or []):
+        return 0
+
+    if event.type == 'EXPIRATION':
+        entitlement = Entitlement(is_premium=False, expires_date=_from_ms(event.expiration_at_ms))
+    else:
+        # purchases, renewals, cancellations and billing issues keep the entitlement until it expires
+        entitlement = get_entitlement(
+            expires_date=_from_ms(event.expiration_at_ms),
+            grace_period_expires_date=_from_ms(event.grace_period_expiration_at_ms),
+        )
+
+    n_users = 0
+    for revcat_user_id in {event.app_user_id, *event.aliases} - {None}:
+        user = parse_revcat_user_id(revcat_user_id)
+        if user is not None:
+            n_users += save_entitlement(
+                db=db, user_id=user[0], secret_id=user[1],
+                entitlement=entitlement, date_validated=date_event
+            )
+    return n_users
@@ -18,6 +18,10 @@ service cron restart
 # echo "entrypoint: run tools.xp_onrestart_recalc"
 # python -m app.api.tools.xp_onrestart_recalc
 
+# process side effects (XP credits, stats refresh) queued by the API
+echo "entrypoint: start job worker"
+python -m app.api.tools.job_worker &
+
 # run the web server
 echo "entrypoint: start webserver"
 uvicorn app.api.main:app --root-path /api --host 0.0.0.0 --port 80
@@ -1,25 +1,38 @@
 import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
 import requests
 import firebase_admin
-from datetime import datetime
 from firebase_admin import firestore, credentials
 from google.cloud.firestore_v1.base_query import FieldFilter
 from fastapi import HTTPException
+import app.api.constants as c
 from app.api.tools.utils import encoded_var_to_creds
 
 class FirebaseAdminClient:
     def __init__(self, service_account_path):
-        self.creds = credentials.Certificate(service_account_path)
-        self.app = firebase_admin.initialize_app(self.creds)
-        self.db = firestore.client()
+        if os.getenv('FIRESTORE_EMULATOR_HOST'):
+            # the local emulator takes no credentials, e.g. for tools.firestore_latency_benchmark
+            self.app = None
+            self.db = firestore.Client(project=os.getenv('FIRESTORE_EMULATOR_PROJECT', 'demo-ocada'))
+        else:
+            self.creds = credentials.Certificate(service_account_path)
+            self.app = firebase_admin.initialize_app(self.creds)
+            self.db = firestore.client()
+        # (user_id, conversation_id) of conversations known to have a display name, least recently used first
+        self._named_conversations = OrderedDict()
+        self._named_conversations_lock = threading.Lock()
     
     def get_firestore_client(self):
         return self.db
     
     def conversation_seen(self, conversation_id, user_id):
         conversations_doc_ref = self.db.collection(f'conversations/user_{user_id}/user_conversations').document(conversation_id)
-        if not conversations_doc_ref.get().exists:
-            conversations_doc_ref.set({})
+        # set with merge creates the document if needed
         conversations_doc_ref.set({'unseen': False}, merge=True)
         print(f'[user_{user_id}] marked {conversation_id} conversation as seen')
 
@@ -120,37 +133,74 @@ class FirebaseAdminClient:
         #     user_id
         # )
 
-    def save_message(self, message, conversation_id, user_id, sender):
+    def _has_display_name(self, conversations_doc_ref, user_id, conversation_id):
+        """
+        Whether the conversation has a display name. Named conversations are remembered,
+        so that only the first message of a conversation seen by this process reads it
+        """
+        with self._named_conversations_lock:
+            if (user_id, conversation_id) in self._named_conversations:
+                self._named_conversations.move_to_end((user_id, conversation_id))
+                return True
+        snapshot = conversations_doc_ref.get(field_paths=['display_name'])
+        return snapshot.exists and 'display_name' in (snapshot.to_dict() or {})
+
+    def _remember_display_name(self, user_id, conversation_id):
+        with self._named_conversations_lock:
+            self._named_conversations[(user_id, conversation_id)] = True
+            self._named_conversations.move_to_end((user_id, conversation_id))
+            while len(self._named_conversations) > c.FIRESTORE_NAMED_CONVERSATIONS_CACHE_SIZE:
+                self._named_conversations.popitem(last=False)
+
+    def save_message(self, message, conversation_id, user_id, sender, feed_collection: Optional[str] = None, release_user: bool = False):
+        """
+        Save a message and the conversation metadata with one batched write, optionally copying the message
+        to a feed collection and releasing the user lock in the same batch
+        """
         current_ts = datetime.now().timestamp()
-        # We have to init full hierarchy of parent documents explicitly
         conversations_doc_ref = self.db.collection(f'conversations/user_{user_id}/user_conversations').document(conversation_id)
-        if not conversations_doc_ref.get().exists:
-            conversations_doc_ref.set({})
 
         # Add conversation metadata
-        # Check if "display_name" is already set in the conversation document
-        conversation_data = conversations_doc_ref.get().to_dict()
-        if 'display_name' not in conversation_data:
+        # the first message names the conversation
+        conversation_data = {}
+        if not self._has_display_name(conversations_doc_ref, user_id, conversation_id):
             conversation_data['display_name'] = message
         if conversation_id not in ['feedback', 'announcements', 'news']:
             conversation_data['last_update'] = current_ts
         # mark conversation as unseen
         if sender == 'system': conversation_data['unseen'] = True
-        conversations_doc_ref.set(conversation_data, merge=True)
 
+        batch = self.db.batch()
+        if conversation_data:
+            # set with merge creates the parent document if needed and keeps its other fields
+            batch.set(conversations_doc_ref, conversation_data, merge=True)
         message_data = self._create_message_doc(
             conversation_id,
             message,
             sender,
             user_id,
-            current_ts
+            current_ts,
+            batch=batch
         )
+        if feed_collection is not None:
+            self.save_to_feed(feed_collection, message_data, batch=batch)
+        if release_user:
+            batch.set(
+                self.db.collection("conversations").document(f'user_{user_id}'),
+                {'started_generating': firestore.DELETE_FIELD},
+                merge=True
+            )
+        batch.commit()
+        self._remember_display_name(user_id, conversation_id)
         print(f'[user_{user_id}] finshed saving message.')
         return message_data
 
-    def save_to_feed(self, collection_name, message_doc):
+    def save_to_feed(self, collection_name, message_doc, batch=None):
         conversations_doc_ref = self.db.collection(f'{collection_name}').document(str(message_doc['ts']))
-        conversations_doc_ref.set(message_doc)
+        if batch is not None:
+            batch.set(conversations_doc_ref, message_doc)
+        else:
+            conversations_doc_ref.set(message_doc)
         print(f'[user_{message_doc["sender"]}] saved to feed under "{message_doc["ts"]}" doc in "{collection_name}" collection')
         return str(message_doc['ts'])
 
@@ -161,7 +211,7 @@ class FirebaseAdminClient:
         result = [rec.to_dict() for rec in latest_records]
         return result
     
-    def _create_message_doc(self, collection, content, sender, user_id='system', ts=datetime.now().timestamp()):
+    def _create_message_doc(self, collection, content, sender, user_id='system', ts=datetime.now().timestamp(), batch=None):
         # if there is a doc exists it will be replaced with a new one
         message_data = {
             'ts': ts,
@@ -171,7 +221,11 @@ class FirebaseAdminClient:
             'user': user_id,
             'conversation_id': collection
         }
-        self.db.document(f'conversations/user_{user_id}/user_conversations/{collection}/messages/{ts}').set(message_data)
+        message_doc_ref = self.db.document(f'conversations/user_{user_id}/user_conversations/{collection}/messages/{ts}')
+        if batch is not None:
+            batch.set(message_doc_ref, message_data)
+        else:
+            message_doc_ref.set(message_data)
         print(f'[user_{user_id}] created document "{ts}" under: {collection}')
         return message_data
 
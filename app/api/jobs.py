@@ -0,0 +1,278 @@
+import logging
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import func, or_, and_, exists, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, aliased
+
+import app.api.constants as c
+from app.api import crud
+from app.models import models
+
+logger = logging.getLogger(__name__)
+
+# job_type -> {'func': handler, 'concurrency': max jobs of this type running at once, 'max_attempts': ...}
+JOB_HANDLERS = {}
+
+
+def job_handler(job_type: str, concurrency: int = 1, max_attempts: int = c.JOB_MAX_ATTEMPTS):
+    """
+    Register a function as the handler of a job type.
+    The handler is called as func(db=db, **payload) and must be safe to run more than once
+    """
+    def decorator(func):
+        JOB_HANDLERS[job_type] = {
+            'func': func,
+            'concurrency': concurrency,
+            'max_attempts': max_attempts,
+        }
+        return func
+    return decorator
+
+
+def enqueue_job(db: Session, job_type: str, payload: dict, dedup_key: Optional[str] = None, delay_seconds: int = 0, commit: bool = True):
+    """
+    Add a job to the queue and commit.
+    With commit=False the job is added to the caller's transaction, so that it is queued if and only if
+    the change that triggers it is committed.
+    If a queued job with the same dedup_key already exists, nothing is added and None is returned
+    """
+    handler = JOB_HANDLERS.get(job_type)
+    if handler is None:
+        raise ValueError(f'Unknown job type: {job_type}')
+
+    stmt = insert(models.Job) \
+        .values(
+            job_type=job_type,
+            payload=payload,
+            dedup_key=dedup_key,
+            max_attempts=handler['max_attempts'],
+            run_after=func.now() + timedelta(seconds=delay_seconds),
+        ) \
+        .on_conflict_do_nothing(
+            index_elements=[models.Job.dedup_key],
+            index_where=(models.Job.status == 'queued'),
+        ) \
+        .returning(models.Job.id)
+
+    job_id = db.execute(stmt).scalar()
+    if commit:
+        db.commit()
+    return job_id
+
+
+def claim_jobs(db: Session, job_type: str, worker_id: str, limit: int):
+    """
+    Claim up to `limit` jobs of a given type and mark them as running.
+
+    Claims of the same job type are serialised with a transaction-level advisory lock,
+    so the number of running jobs never exceeds the handler concurrency across all workers.
+    Jobs whose lease expired (the worker died mid-job) are claimed again.
+    Returns a list of dicts, as the ORM objects are expired by the commit
+    """
+    handler = JOB_HANDLERS[job_type]
+    date_now = datetime.now(tz=timezone.utc)
+
+    db.execute(func.pg_advisory_xact_lock(func.hashtext(f'jobs:{job_type}')).select())
+
+    n_running = db \
+        .query(func.count(models.Job.id)) \
+        .filter(
+            models.Job.job_type == job_type,
+            models.Job.status == 'running',
+            models.Job.locked_until > date_now,
+        ) \
+        .scalar()
+
+    limit = min(limit, handler['concurrency'] - n_running)
+    if limit <= 0:
+        db.commit()
+        return []
+
+    jobs = db \
+        .query(models.Job) \
+        .filter(
+            models.Job.job_type == job_type,
+            or_(
+                and_(models.Job.status == 'queued', models.Job.run_after <= date_now),
+                and_(models.Job.status == 'running', models.Job.locked_until <= date_now),
+            )
+        ) \
+        .order_by(models.Job.run_after, models.Job.id) \
+        .limit(limit) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+    claimed = []
+    for job in jobs:
+        if job.attempts >= job.max_attempts:
+            # the lease expired on the last attempt
+            job.status = 'failed'
+            job.last_error = 'Lease expired'
+            job.locked_until = None
+            continue
+
+        job.status = 'running'
+        job.attempts = job.attempts + 1
+        job.locked_by = worker_id
+        job.locked_until = date_now + timedelta(seconds=c.JOB_LEASE_SECONDS)
+        claimed.append({
+            'id': job.id,
+            'job_type': job.job_type,
+            'payload': dict(job.payload or {}),
+            'attempts': job.attempts,
+        })
+
+    db.commit()
+    return claimed
+
+
+def complete_job(db: Session, job_id: int):
+    db.query(models.Job) \
+        .filter(models.Job.id == job_id, models.Job.status == 'running') \
+        .update({
+            models.Job.status: 'done',
+            models.Job.locked_until: None,
+            models.Job.date_completed: func.now(),
+        }, synchronize_session=False)
+    db.commit()
+
+
+def fail_job(db: Session, job_id: int, error: str):
+    """
+    Put a failed job back in the queue with exponential backoff, or mark it as failed
+    once it ran out of attempts
+    """
+    job = db.query(models.Job).filter(models.Job.id == job_id).with_for_update().one_or_none()
+    if job is None or job.status != 'running':
+        db.commit()
+        return
+
+    if job.attempts >= job.max_attempts:
+        job.status = 'failed'
+        job.last_error = error
+        job.locked_until = None
+        job.date_completed = func.now()
+        db.commit()
+        return
+
+    # requeue unless a job with the same key is already queued: the check and the requeue are one statement,
+    # and a job queued concurrently with the same key still fails it on the unique index
+    queued_duplicate = aliased(models.Job)
+    try:
+        with db.begin_nested():
+            n_requeued = db \
+                .query(models.Job) \
+                .filter(
+                    models.Job.id == job_id,
+                    ~exists().where(
+                        queued_duplicate.dedup_key == models.Job.dedup_key,
+                        queued_duplicate.status == 'queued',
+                    )
+                ) \
+                .update({
+                    models.Job.status: 'queued',
+                    models.Job.last_error: error,
+                    models.Job.locked_until: None,
+                    models.Job.run_after: func.now() + timedelta(seconds=c.JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)),
+                }, synchronize_session=False)
+    except IntegrityError:
+        n_requeued = 0
+
+    if n_requeued == 0:
+        # a newer job with the same key is already queued and will do the work
+        db.query(models.Job) \
+            .filter(models.Job.id == job_id) \
+            .update({
+                models.Job.status: 'done',
+                models.Job.last_error: error,
+                models.Job.locked_until: None,
+                models.Job.date_completed: func.now(),
+            }, synchronize_session=False)
+    db.commit()
+
+
+def prune_jobs(db: Session, retention_days: int = c.JOB_RETENTION_DAYS, batch_size: int = 10000):
+    """
+    Delete done and failed jobs completed more than retention_days ago, in batches committed one by one.
+    Returns the number of jobs deleted
+    """
+    date_cutoff = datetime.now(tz=timezone.utc) - timedelta(days=retention_days)
+    n_deleted = 0
+    while True:
+        batch = db \
+            .query(models.Job.id) \
+            .filter(
+                models.Job.status.in_(['done', 'failed']),
+                models.Job.date_completed < date_cutoff,
+            ) \
+            .limit(batch_size) \
+            .subquery()
+        n_batch = db \
+            .query(models.Job) \
+            .filter(models.Job.id.in_(select(batch.c.id))) \
+            .delete(synchronize_session=False)
+        db.commit()
+        n_deleted += n_batch
+        if n_batch < batch_size:
+            return n_deleted
+
+
+def run_job(db: Session, job: dict):
+    """
+    Run a claimed job and record the outcome
+    """
+    handler = JOB_HANDLERS.get(job['job_type'])
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job type: {job['job_type']}")
+        handler['func'](db=db, **job['payload'])
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Job {job['id']} ({job['job_type']}) failed on attempt {job['attempts']}: {e}")
+        fail_job(db=db, job_id=job['id'], error=traceback.format_exc(limit=5))
+        return False
+
+    complete_job(db=db, job_id=job['id'])
+    return True
+
+
+# -------------- Handlers --------------
+
+@job_handler(c.JOB_TYPE.XP_TRANSACTION_EXECUTED, concurrency=4)
+def credit_xp_on_transaction_executed(db: Session, transaction_id: int):
+    """
+    Credit XP for an executed buy/sell transaction.
+    Credits already recorded for the transaction are skipped, so that a retried job does not double-credit
+    """
+    transaction = crud.get_portfolio_transaction_by_id(db=db, id=transaction_id)
+    if transaction is None or transaction.status != 'executed':
+        return
+
+    credited_reasons = {
+        reason for (reason, ) in db
+            .query(models.XPTransaction.reason)
+            .filter(
+                models.XPTransaction.user_id == transaction.portfolio.user_id,
+                models.XPTransaction.detail == f"TX={transaction.id}",
+            )
+            .all()
+    }
+
+    if transaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value:
+        if c.XP_REASON.BUY_TRANSACTION not in credited_reasons:
+            crud.credit_xp_on_buy_if_eligible(db=db, transaction_id=transaction.id)
+    elif transaction.transaction_type == models.PortfolioTransactionTypeUserScope.SELL.value:
+        if c.XP_REASON.SELL_ASSET_AT_PROFIT not in credited_reasons:
+            crud.credit_xp_on_sell_if_eligible(db=db, transaction_id=transaction.id)
+
+    if c.XP_REASON.FEED_MESSAGE not in credited_reasons:
+        crud.credit_xp_on_transaction_execute_if_eligible(db=db, transaction_id=transaction.id)
+
+
+@job_handler(c.JOB_TYPE.PORTFOLIO_STATS_REFRESH, concurrency=2)
+def refresh_portfolio_stats(db: Session, portfolio_id: int):
+    crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id, refresh_timeout=0)
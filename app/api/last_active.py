@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import threading
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import SQLAlchemyError
+
+import app.api.constants as c
+from app.api import crud
+from app.api.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class LastActiveTracker:
+    """
+    Collects the users seen by the API and writes their last active date with one UPDATE
+    every LAST_ACTIVE_FLUSH_SECONDS, instead of one UPDATE and commit per authenticated request.
+    The users the UPDATE no longer finds have been deleted: their ids are kept so that the access tokens
+    still issued to them are rejected, see is_deleted
+    """
+
+    def __init__(self):
+        self._user_ids = set()
+        # user ids are never reused, so the set only grows with the deletions seen by this process
+        self._deleted_user_ids = set()
+        self._lock = threading.Lock()
+
+    def touch(self, user_id: int):
+        with self._lock:
+            self._user_ids.add(user_id)
+
+    def mark_deleted(self, user_id: int):
+        with self._lock:
+            self._deleted_user_ids.add(user_id)
+            self._user_ids.discard(user_id)
+
+    def is_deleted(self, user_id: int):
+        return user_id in self._deleted_user_ids
+
+    def flush(self):
+        with self._lock:
+            user_ids, self._user_ids = self._user_ids, set()
+        if not user_ids:
+            return 0
+
+        db = SessionLocal()
+        try:
+            updated_user_ids = crud.update_users_last_active_date(db=db, user_ids=user_ids)
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.warning(f'Could not update the last active date of {len(user_ids)} users: {e}')
+            # retried with the next flush
+            with self._lock:
+                self._user_ids |= user_ids
+            return 0
+        finally:
+            db.close()
+
+        deleted_user_ids = user_ids - updated_user_ids
+        if deleted_user_ids:
+            with self._lock:
+                self._deleted_user_ids |= deleted_user_ids
+        return len(updated_user_ids)
+
+    async def run(self):
+        """
+        Flush periodically until cancelled, then flush what is left
+        """
+        try:
+            while True:
+                await asyncio.sleep(c.LAST_ACTIVE_FLUSH_SECONDS)
+                await run_in_threadpool(self.flush)
+        finally:
+            await run_in_threadpool(self.flush)
+
+
+tracker = LastActiveTracker()
@@ -0,0 +1,282 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sortedcontainers import SortedList
+from sqlalchemy.orm import Session
+
+import app.api.constants as c
+from app.api import crud, xp_epochs
+from app.models import models
+
+TIMEFRAME_COLUMNS = {
+    'weekly': models.User.xp_current_week,
+    'season': models.User.xp_current_season,
+    'total': models.User.xp_total,
+}
+# portfolios whose user has no XP in the current week/season are not ranked on these leaderboards, as in crud.get_xp_leaderboard
+EARNED_XP_TIMEFRAMES = ('weekly', 'season')
+
+
+class SortedSetLeaderboard:
+    """
+    Leaderboards of public portfolios held in process, one sorted set per timeframe.
+
+    Each set holds (-score, portfolio_id) keys, so that the index of a key is the rank of the portfolio
+    and top-N pages, rank lookups and neighbourhoods are O(log n) bisections instead of sorts.
+    """
+    timeframes = ()
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._sets = {timeframe: SortedList() for timeframe in self.timeframes}
+        self._scores = {}  # portfolio_id -> {timeframe: score}
+
+    def is_ranked(self, timeframe: str, score):
+        # whether a portfolio with this score is part of the timeframe's leaderboard
+        return True
+
+    def count(self, timeframe: str):
+        return len(self._sets[timeframe])
+
+    def get_page(self, timeframe: str, skip: int, limit: int):
+        """
+        Portfolio ids ranked skip+1 to skip+limit
+        """
+        with self._lock:
+            return [portfolio_id for _, portfolio_id in self._sets[timeframe].islice(skip, skip + limit)]
+
+    def get_rank(self, timeframe: str, portfolio_id: int):
+        """
+        1-based rank of a portfolio, None if it is not on the leaderboard
+        """
+        with self._lock:
+            scores = self._scores.get(portfolio_id)
+            if scores is None or not self.is_ranked(timeframe=timeframe, score=scores[timeframe]):
+                return None
+            return self._sets[timeframe].index((-scores[timeframe], portfolio_id)) + 1
+
+    def get_neighbours(self, timeframe: str, portfolio_id: int, k: int):
+        """
+        Rank of a portfolio and the (rank, portfolio id) of the portfolios ranked up to k places
+        above and below it, itself included, or (None, []) if it is not on the leaderboard
+        """
+        with self._lock:
+            rank = self.get_rank(timeframe=timeframe, portfolio_id=portfolio_id)
+            if rank is None:
+                return None, []
+            skip = max(rank - 1 - k, 0)
+            portfolio_ids = self.get_page(timeframe=timeframe, skip=skip, limit=rank + k - skip)
+            return rank, [(skip + 1 + i, neighbour_id) for i, neighbour_id in enumerate(portfolio_ids)]
+
+
+class XPLeaderboard(SortedSetLeaderboard):
+    """
+    XP leaderboards of public active portfolios, ranked by their user's XP.
+
+    Every API worker holds its own copy and keeps it in sync with the database:
+    users credited since the last sync are reloaded every LEADERBOARD_SYNC_INTERVAL_SECONDS,
+    and the sets are rebuilt when a new week/season epoch starts and every LEADERBOARD_REBUILD_INTERVAL_SECONDS,
+    which picks up portfolio visibility changes made by other processes.
+    """
+    timeframes = tuple(TIMEFRAME_COLUMNS)
+
+    def __init__(self):
+        super().__init__()
+        self._user_portfolios = {}  # user_id -> set of portfolio ids
+        self._epochs = None  # (weekly, season) XP epochs the sets were built in
+        self._date_last_synced = None
+        self._time_last_rebuilt = None
+
+    def is_ranked(self, timeframe: str, score):
+        return score > 0 or timeframe not in EARNED_XP_TIMEFRAMES
+
+    def _query_epochs(self, db: Session):
+        return tuple(xp_epochs.get_current_epoch(db=db, timeframe=timeframe) for timeframe in (xp_epochs.WEEKLY, xp_epochs.SEASON))
+
+    def _query_entries(self, db: Session, user_ids: Optional[List[int]] = None):
+        query = db \
+            .query(models.Portfolio.id, models.Portfolio.user_id, *TIMEFRAME_COLUMNS.values()) \
+            .join(models.User, models.Portfolio.user_id == models.User.id) \
+            .filter(
+                models.Portfolio.is_public == 1,
+                models.User.status == 'active',
+                models.Portfolio.status == 'active'
+            )
+        if user_ids is not None:
+            query = query.filter(models.User.id.in_(user_ids))
+        return query.all()
+
+    def _remove(self, portfolio_id: int):
+        xp = self._scores.pop(portfolio_id, None)
+        if xp is None:
+            return
+        for timeframe, sorted_set in self._sets.items():
+            if self.is_ranked(timeframe=timeframe, score=xp[timeframe]):
+                sorted_set.remove((-xp[timeframe], portfolio_id))
+
+    def _add(self, portfolio_id: int, user_id: int, xp: Dict[str, int]):
+        self._scores[portfolio_id] = xp
+        self._user_portfolios.setdefault(user_id, set()).add(portfolio_id)
+        for timeframe, sorted_set in self._sets.items():
+            if self.is_ranked(timeframe=timeframe, score=xp[timeframe]):
+                sorted_set.add((-xp[timeframe], portfolio_id))
+
+    def rebuild(self, db: Session):
+        """
+        Load all leaderboard entries from the database
+        """
+        date_sync = datetime.now(tz=timezone.utc)
+        epochs = self._query_epochs(db=db)
+        entries = self._query_entries(db=db)
+
+        sets = {
+            timeframe: SortedList(
+                (-entry[2 + i], entry[0]) for entry in entries
+                if self.is_ranked(timeframe=timeframe, score=entry[2 + i])
+            )
+            for i, timeframe in enumerate(TIMEFRAME_COLUMNS)
+        }
+        xp = {
+            entry[0]: {timeframe: entry[2 + i] for i, timeframe in enumerate(TIMEFRAME_COLUMNS)}
+            for entry in entries
+        }
+        user_portfolios = {}
+        for entry in entries:
+            user_portfolios.setdefault(entry[1], set()).add(entry[0])
+
+        with self._lock:
+            self._sets, self._scores, self._user_portfolios = sets, xp, user_portfolios
+            self._epochs = epochs
+            self._date_last_synced = date_sync
+            self._time_last_rebuilt = time.monotonic()
+
+    def update_users(self, db: Session, user_ids: List[int]):
+        """
+        Reload the entries of the given users, e.g. after their XP was credited
+        """
+        if not user_ids:
+            return
+        entries = self._query_entries(db=db, user_ids=user_ids)
+        with self._lock:
+            for user_id in user_ids:
+                for portfolio_id in self._user_portfolios.pop(user_id, set()):
+                    self._remove(portfolio_id)
+            for entry in entries:
+                self._add(
+                    portfolio_id=entry[0],
+                    user_id=entry[1],
+                    xp={timeframe: entry[2 + i] for i, timeframe in enumerate(TIMEFRAME_COLUMNS)},
+                )
+
+    def sync(self, db: Session):
+        """
+        Reload the users credited with XP since the last sync, or rebuild if a new week/season started.
+        Credits are looked up with an overlap, so that transactions committed late are not missed
+        """
+        if self._query_epochs(db=db) != self._epochs:
+            self.rebuild(db=db)
+            return
+
+        date_sync = datetime.now(tz=timezone.utc)
+        date_from = self._date_last_synced - timedelta(seconds=c.LEADERBOARD_SYNC_OVERLAP_SECONDS)
+        user_ids = [
+            user_id for (user_id, ) in db
+                .query(models.XPTransaction.user_id)
+                .filter(
+                    models.XPTransaction.date_credited >= date_from,
+                    models.XPTransaction.user_id != None,
+                )
+                .distinct()
+                .all()
+        ]
+        self.update_users(db=db, user_ids=user_ids)
+        with self._lock:
+            self._date_last_synced = date_sync
+
+    def ensure_fresh(self, db: Session):
+        """
+        Rebuild or sync the leaderboard if it is due.
+        Only one thread refreshes at a time, the others keep reading the current sets,
+        except before the first rebuild, which they wait for
+        """
+        is_built = self._time_last_rebuilt is not None
+        is_rebuild_due = not is_built or time.monotonic() - self._time_last_rebuilt > c.LEADERBOARD_REBUILD_INTERVAL_SECONDS
+        is_sync_due = is_built and datetime.now(tz=timezone.utc) - self._date_last_synced > timedelta(seconds=c.LEADERBOARD_SYNC_INTERVAL_SECONDS)
+        if not (is_rebuild_due or is_sync_due):
+            return
+
+        if not self._refresh_lock.acquire(blocking=not is_built):
+            return
+        try:
+            if self._time_last_rebuilt is None \
+                    or time.monotonic() - self._time_last_rebuilt > c.LEADERBOARD_REBUILD_INTERVAL_SECONDS:
+                self.rebuild(db=db)
+            elif datetime.now(tz=timezone.utc) - self._date_last_synced > timedelta(seconds=c.LEADERBOARD_SYNC_INTERVAL_SECONDS):
+                self.sync(db=db)
+        finally:
+            self._refresh_lock.release()
+
+xp_leaderboard = XPLeaderboard()
+
+# the gain leaderboard is a ranked table, see portfolio_stats.refresh_gain_leaderboard
+TIMEFRAMES = xp_leaderboard.timeframes + ('gain', )
+
+
+def get_xp_leaderboard_page(db: Session, timeframe: str, skip: int, limit: int):
+    """
+    Portfolios of a leaderboard page, in rank order.
+    Portfolios made private or deleted since the last rebuild are left out
+    """
+    xp_leaderboard.ensure_fresh(db=db)
+    portfolio_ids = xp_leaderboard.get_page(timeframe=timeframe, skip=skip, limit=limit)
+    return get_portfolios_in_order(db=db, portfolio_ids=portfolio_ids)
+
+
+def get_portfolios_in_order(db: Session, portfolio_ids: List[int]):
+    if not portfolio_ids:
+        return []
+    portfolios = {
+        portfolio.id: portfolio
+        for portfolio in db
+            .query(models.Portfolio)
+            .filter(
+                models.Portfolio.id.in_(portfolio_ids),
+                models.Portfolio.is_public == 1,
+                models.Portfolio.status == 'active',
+            )
+            .all()
+    }
+    return [portfolios[portfolio_id] for portfolio_id in portfolio_ids if portfolio_id in portfolios]
+
+
+def get_neighbourhood(db: Session, timeframe: str, portfolio_id: int, k: int):
+    """
+    Rank of a portfolio, the number of ranked portfolios and the [(rank, portfolio)] of the
+    portfolios ranked up to k places above and below it
+    """
+    if timeframe == 'gain':
+        return _get_gain_neighbourhood(db=db, portfolio_id=portfolio_id, k=k)
+
+    xp_leaderboard.ensure_fresh(db=db)
+    rank, neighbours = xp_leaderboard.get_neighbours(timeframe=timeframe, portfolio_id=portfolio_id, k=k)
+    portfolios = get_portfolios_in_order(db=db, portfolio_ids=[neighbour_id for _, neighbour_id in neighbours])
+    portfolios = {portfolio.id: portfolio for portfolio in portfolios}
+    entries = [
+        (neighbour_rank, portfolios[neighbour_id])
+        for neighbour_rank, neighbour_id in neighbours
+        if neighbour_id in portfolios
+    ]
+    return rank, xp_leaderboard.count(timeframe), entries
+
+
+def _get_gain_neighbourhood(db: Session, portfolio_id: int, k: int):
+    # a lookup on the portfolio_id unique index and a range scan on the rank primary key
+    n_ranked = crud.count_gain_leaderboard_entries(db=db)
+    entry = crud.get_gain_leaderboard_entry_by_portfolio_id(db=db, portfolio_id=portfolio_id)
+    if entry is None:
+        return None, n_ranked, []
+    neighbours = crud.get_gain_leaderboard_entries(db=db, first_rank=entry.rank - k, last_rank=entry.rank + k)
+    return entry.rank, n_ranked, [(neighbour.rank, neighbour.portfolio) for neighbour in neighbours]
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import logging.config
 import os
@@ -11,7 +12,7 @@ from sqlalchemy.orm import Session
 
 from app.api.exceptions import SnipsError
 from app.api.database import engine, SessionLocal
-from app.api import crud
+from app.api import crud, last_active
 from app.models import api_schema, models
 import app.api.constants as c
 
@@ -23,7 +24,8 @@ from app.api.routers import \
     skills as r_skills, \
     social as r_social, \
     learn as r_learn, \
-    conversations as r_conversations 
+    conversations as r_conversations, \
+    webhooks as r_webhooks
 
 # set up logging
 logging.config.fileConfig(fname='app/api/data/logging.conf',
@@ -64,6 +66,27 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def start_last_active_tracker():
+    app.state.last_active_task = asyncio.create_task(last_active.tracker.run())
+
+
+@app.on_event("startup")
+async def warm_up_identity_provider_keys():
+    # logins verify tokens against the cached keys, without waiting for Apple or Google
+    r_users.apple_auth.jwks.refresh_in_background()
+    r_users.google_auth.jwks.refresh_in_background()
+
+
+@app.on_event("shutdown")
+async def stop_last_active_tracker():
+    app.state.last_active_task.cancel()
+    try:
+        await app.state.last_active_task
+    except asyncio.CancelledError:
+        pass
+
+
 @app.get("/")
 async def root():
     return {
@@ -78,3 +101,4 @@ app.include_router(r_skills.router)
 app.include_router(r_social.router)
 app.include_router(r_learn.router)
 app.include_router(r_conversations.router)
+app.include_router(r_webhooks.router)
@@ -17,6 +17,7 @@ from app.api.notifications.utils.push import send_push
 def get_user_tokens_with_old_holdings(db: Session):
     return db \
     .query(models.UserPushToken) \
+    .join(models.User, models.User.id == models.UserPushToken.user_id) \
     .join(models.Portfolio, models.Portfolio.user_id == models.UserPushToken.user_id) \
     .join(models.Holding, models.Portfolio.id == models.Holding.portfolio_id) \
     .filter(
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from sqlalchemy import func, literal, select, case
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import app.api.constants as c
+from app.models import models
+
+
+def record_executed_transaction(db: Session, transaction: models.PortfolioTransaction):
+    """
+    Add an executed trade to the portfolio's running totals.
+    Does not commit: the totals are updated in the same transaction as the trade.
+
+    Stats rows without totals yet are left alone, their first refresh computes the totals from the ledger.
+    A trade does not change net worth or gain at the execution price, so only the totals move
+    """
+    if transaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value:
+        values = {models.PortfolioStats.total_book_value: models.PortfolioStats.total_book_value + transaction.value}
+    elif transaction.transaction_type == models.PortfolioTransactionTypeUserScope.SELL.value:
+        values = {models.PortfolioStats.total_sales_value: models.PortfolioStats.total_sales_value + transaction.value}
+    else:
+        return
+
+    db.query(models.PortfolioStats) \
+        .filter(
+            models.PortfolioStats.portfolio_id == transaction.portfolio_id,
+            models.PortfolioStats.total_book_value != None,
+            models.PortfolioStats.total_sales_value != None,
+        ) \
+        .update(values, synchronize_session=False)
+
+
+def record_cash_credit(db: Session, portfolio_id: int, amount: float):
+    """
+    Add a cash credit (e.g. a claimed reward) to the portfolio's net worth.
+    Does not commit
+    """
+    db.query(models.PortfolioStats) \
+        .filter(
+            models.PortfolioStats.portfolio_id == portfolio_id,
+            models.PortfolioStats.total_net_worth != None,
+        ) \
+        .update({
+            models.PortfolioStats.total_net_worth: models.PortfolioStats.total_net_worth + amount,
+            models.PortfolioStats.date_last_updated: func.now(),
+        }, synchronize_session=False)
+
+
+def get_stats_upsert(portfolio_ids=None):
+    """
+    INSERT ... SELECT ... ON CONFLICT statement recomputing net worth and gain of the portfolios
+    (all of them when portfolio_ids, a list or a subquery of ids, is None) from their cash and
+    holdings valued at the latest prices.
+
+    The running totals are taken from portfolio_stats, the transaction history is only aggregated
+    for portfolios that have no totals yet. Net worth and gain are computed from one snapshot, and as a trade
+    does not change them at the execution price, a trade committed meanwhile is not lost:
+    its totals are kept by the ON CONFLICT clause
+    """
+    current_values = select(
+            models.Holding.portfolio_id,
+            func.sum(models.Holding.quantity * models.InstrumentKPI_LatestPrice.price).label('current_value'),
+        ) \
+        .join(models.InstrumentKPI_LatestPrice, models.Holding.instrument_id == models.InstrumentKPI_LatestPrice.instrument_id) \
+        .group_by(models.Holding.portfolio_id)
+
+    with_totals = select(models.PortfolioStats.portfolio_id) \
+        .where(
+            models.PortfolioStats.total_book_value != None,
+            models.PortfolioStats.total_sales_value != None,
+        )
+    if portfolio_ids is not None:
+        with_totals = with_totals.where(models.PortfolioStats.portfolio_id.in_(portfolio_ids))
+    ledger_totals = select(
+            models.PortfolioTransaction.portfolio_id,
+            func.sum(models.PortfolioTransaction.value).filter(models.PortfolioTransaction.transaction_type == 'buy').label('book_cost'),
+            func.sum(models.PortfolioTransaction.value).filter(models.PortfolioTransaction.transaction_type == 'sell').label('sales_value'),
+        ) \
+        .where(
+            models.PortfolioTransaction.status == 'executed',
+            models.PortfolioTransaction.portfolio_id.not_in(with_totals),
+        ) \
+        .group_by(models.PortfolioTransaction.portfolio_id)
+
+    portfolios = select(models.Portfolio.id, models.Portfolio.cash_balance) \
+        .where(models.Portfolio.status != 'deleted')
+
+    if portfolio_ids is not None:
+        # the aggregates are restricted too, the planner does not push the filter into grouped subqueries
+        current_values = current_values.where(models.Holding.portfolio_id.in_(portfolio_ids))
+        ledger_totals = ledger_totals.where(models.PortfolioTransaction.portfolio_id.in_(portfolio_ids))
+        portfolios = portfolios.where(models.Portfolio.id.in_(portfolio_ids))
+
+    current_values = current_values.subquery('current_values')
+    ledger_totals = ledger_totals.subquery('ledger_totals')
+    portfolios = portfolios.subquery('portfolios_refreshed')
+
+    current_value = func.coalesce(current_values.c.current_value, 0)
+    book_cost = func.coalesce(models.PortfolioStats.total_book_value, ledger_totals.c.book_cost, 0)
+    sales_value = func.coalesce(models.PortfolioStats.total_sales_value, ledger_totals.c.sales_value, 0)
+
+    stats = select(
+            portfolios.c.id,
+            portfolios.c.cash_balance + current_value,
+            book_cost,
+            sales_value,
+            sales_value + current_value - book_cost,
+            func.now(),
+        ) \
+        .outerjoin(models.PortfolioStats, models.PortfolioStats.portfolio_id == portfolios.c.id) \
+        .outerjoin(current_values, current_values.c.portfolio_id == portfolios.c.id) \
+        .outerjoin(ledger_totals, ledger_totals.c.portfolio_id == portfolios.c.id)
+
+    stmt = insert(models.PortfolioStats).from_select(
+        ['portfolio_id', 'total_net_worth', 'total_book_value', 'total_sales_value', 'total_gain', 'date_last_updated'],
+        stats
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[models.PortfolioStats.portfolio_id],
+        set_={
+            'total_net_worth': stmt.excluded.total_net_worth,
+            'total_gain': stmt.excluded.total_gain,
+            'total_book_value': func.coalesce(models.PortfolioStats.total_book_value, stmt.excluded.total_book_value),
+            'total_sales_value': func.coalesce(models.PortfolioStats.total_sales_value, stmt.excluded.total_sales_value),
+            'date_last_updated': stmt.excluded.date_last_updated,
+        }
+    )
+
+
+def refresh_all_portfolio_stats(db: Session):
+    """
+    Recompute net worth and gain of every portfolio with one INSERT ... SELECT ... ON CONFLICT statement,
+    see get_stats_upsert. Holdings are valued with a single grouped join on the latest prices.
+    Returns the number of portfolios refreshed
+    """
+    n_refreshed = db.execute(get_stats_upsert()).rowcount
+    db.commit()
+    return n_refreshed
+
+
+def revalue_portfolios(db: Session, instrument_ids: List[int]):
+    """
+    Recompute net worth and gain of the portfolios holding the given instruments, after their latest prices changed.
+    Does not commit: the prices are written and the portfolios revalued in one transaction.
+
+    Holdings are found through the holdings(instrument_id) index, so the cost is proportional to the holdings
+    of the changed instruments rather than to all portfolios. Their stats rows are locked first (in id order,
+    as any concurrent revaluation) and then recomputed as absolute values (cash + holdings x latest price),
+    so a concurrent refresh or a rerun of the same prices cannot count a price change twice.
+    Portfolios without stats yet are left to the periodic full refresh.
+    Returns the number of portfolios revalued
+    """
+    if not instrument_ids:
+        return 0
+
+    holder_ids = select(models.Holding.portfolio_id) \
+        .where(
+            models.Holding.instrument_id.in_(instrument_ids),
+            models.Holding.quantity > 0,
+        ) \
+        .distinct()
+
+    portfolio_ids = db.execute(
+        select(models.PortfolioStats.portfolio_id)
+        .where(models.PortfolioStats.portfolio_id.in_(holder_ids))
+        .order_by(models.PortfolioStats.portfolio_id)
+        .with_for_update()
+    ).scalars().all()
+    if not portfolio_ids:
+        return 0
+    return db.execute(get_stats_upsert(portfolio_ids=portfolio_ids)).rowcount
+
+
+def record_value_history(db: Session):
+    """
+    Append the current net worth and gain of every portfolio to the value history, and commit.
+
+    One INSERT ... SELECT per timeframe writes a row per portfolio for the current hour/day.
+    Rows already written for the period are kept (ON CONFLICT DO NOTHING), so each bar holds
+    the value as of the first refresh of its period and reruns are harmless.
+    Hourly rows older than the retention period are dropped, daily rows are kept.
+    Returns the number of rows written
+    """
+    n_written = 0
+    for timeframe, precision in c.PORTFOLIO_VALUE_HISTORY_TIMEFRAMES.items():
+        snapshot = select(
+                models.PortfolioStats.portfolio_id,
+                literal(timeframe),
+                func.date_trunc(precision, func.now()),
+                models.PortfolioStats.total_net_worth,
+                models.PortfolioStats.total_gain,
+            ) \
+            .join(models.Portfolio, models.Portfolio.id == models.PortfolioStats.portfolio_id) \
+            .where(
+                models.Portfolio.status != 'deleted',
+                models.PortfolioStats.total_net_worth != None,
+                models.PortfolioStats.total_gain != None,
+            )
+        stmt = insert(models.PortfolioValueHistory) \
+            .from_select(['portfolio_id', 'timeframe', 'date_as_of', 'total_net_worth', 'total_gain'], snapshot) \
+            .on_conflict_do_nothing()
+        n_written += db.execute(stmt).rowcount
+
+    retention_date = datetime.now(tz=timezone.utc) - timedelta(days=c.PORTFOLIO_VALUE_HISTORY_1H_RETENTION_DAYS)
+    db.query(models.PortfolioValueHistory) \
+        .filter(
+            models.PortfolioValueHistory.timeframe == '1H',
+            models.PortfolioValueHistory.date_as_of < retention_date,
+        ) \
+        .delete(synchronize_session=False)
+
+    db.commit()
+    return n_written
+
+
+def refresh_gain_leaderboard(db: Session):
+    """
+    Recompute the ranked gain leaderboard from portfolio_stats, and commit.
+
+    The table is replaced in one transaction (DELETE + INSERT ... SELECT with row_number()),
+    so readers see either the previous or the new ranking, and the sort of all public
+    portfolios is done once per refresh instead of once per page.
+    Returns the number of ranked portfolios
+    """
+    date_leaderboard_lookback = datetime.now(timezone.utc) - timedelta(days=c.LEADERBOARD_GAIN_LOOKBACK_DAYS)
+
+    ranking = select(
+            func.row_number().over(order_by=(models.PortfolioStats.total_gain.desc(), models.Portfolio.id)),
+            models.Portfolio.id,
+            models.PortfolioStats.total_gain,
+            case(
+                (models.PortfolioStats.total_book_value > 0, models.PortfolioStats.total_gain / models.PortfolioStats.total_book_value * 100),
+                else_=None
+            ),
+            func.now(),
+        ) \
+        .join(models.PortfolioStats, models.PortfolioStats.portfolio_id == models.Portfolio.id) \
+        .where(
+            models.Portfolio.is_public == 1,
+            models.Portfolio.status == 'active',
+            models.Portfolio.date_last_updated >= date_leaderboard_lookback,
+            models.PortfolioStats.total_gain != None,
+        )
+
+    db.query(models.PortfolioGainLeaderboard).delete(synchronize_session=False)
+    n_ranked = db.execute(
+        insert(models.PortfolioGainLeaderboard).from_select(
+            ['rank', 'portfolio_id', 'total_gain', 'gain_perc', 'date_as_of'],
+            ranking
+        )
+    ).rowcount
+    db.commit()
+    return n_ranked
@@ -12,9 +12,8 @@ from datetime import datetime
 
 import app.api.constants as c
 from app.models import api_schema, enums
-from app.api.dependencies import manager, get_db
-from app.api import crud
-from app.api.tools.premium import validate_premium
+from app.api.dependencies import manager, get_db, get_db_user
+from app.api import crud, entitlements
 from app.api.firebase_custom_client import client_instance as fcc
 from app.api.tools.utils import encoded_var_to_creds
 
@@ -93,27 +92,25 @@ def send_message(
         embed=True
     ),
     db: Session = Depends(get_db),
-    user=Depends(manager)
+    user=Depends(get_db_user)
 ):
     # this takes quite a while, so let's track the time
     start_time = datetime.now()
-    user = crud.get_user_by_id(db=db, id=user.id)
 
     print(f'[user_{user.id}] received a new message from user at {conversation_id}')
 
     if (conversation_id in ['announcements', 'news']):
         print(f'[user_{user.id}] tried to send a message to {conversation_id}: {message}')
-        doc = fcc.save_message(message, conversation_id, user_id=user.id, sender=user.id)
-        fcc.save_to_feed('feedback', doc)
+        fcc.save_message(message, conversation_id, user_id=user.id, sender=user.id, feed_collection='feedback')
         return {
             "response": "Alright 😀",
             "credits_remaining": user.credit_balance,
             "send_message_fee": 0
         }
 
-    message_doc = fcc.save_message(message, conversation_id, user_id=user.id, sender=user.id)
+    feed_collection = 'feedback' if conversation_id in ['feedback'] else 'message_feed'
+    fcc.save_message(message, conversation_id, user_id=user.id, sender=user.id, feed_collection=feed_collection)
     if conversation_id in ['feedback']:
-        fcc.save_to_feed('feedback', message_doc)
         response = 'Thank you for the feedback 🙏 We will get back to you ASAP 🙂'
         fcc.save_message(response, conversation_id, user_id=user.id, sender='system')
         return {
@@ -121,8 +118,6 @@ def send_message(
             "credits_remaining": user.credit_balance,
             "send_message_fee": 0
         }
-    else:
-        fcc.save_to_feed('message_feed', message_doc)
 
     if not user.portfolios:
         response = 'You must set up your profile before using AI. Please complete your onboarding first.'
@@ -147,12 +142,8 @@ def send_message(
     # purchase transfer could be exploited though:
     # https://www.revenuecat.com/docs/restoring-purchases#transferring-purchases-seen-on-multiple-app-user-ids
     if revcat_public_api_key is not None:
-        validate_premium(
-            user_id=user.id,
-            secret_id=user.secret_id,
-            revcat_public_api_key=revcat_public_api_key,
-            should_update_user=True
-        )
+        entitlements.get_premium_status(
+            db=db, user=user, revcat_public_api_key=revcat_public_api_key)
         db.refresh(user)
 
     # verify if the user has sufficient credit balance
@@ -256,9 +247,10 @@ def send_message(
         xp_detail=f"ID={conversation_id}",
     )
 
-    doc = fcc.save_message(ai_response.replace('**', '').replace('* ', '- ').replace('###', '#'), conversation_id, user_id=user.id, sender='system')
-    fcc.save_to_feed('message_feed', doc)
-    fcc.release_user(user.id)
+    fcc.save_message(
+        ai_response.replace('**', '').replace('* ', '- ').replace('###', '#'), conversation_id,
+        user_id=user.id, sender='system', feed_collection='message_feed', release_user=True
+    )
     
     end_time = datetime.now()
     elapsed_time = end_time - start_time
@@ -296,7 +288,7 @@ def get_user_conversation(
         le=c.MAX_ELEMENTS_PER_PAGE,
     ),
     db: Session = Depends(get_db),
-    user=Depends(manager)
+    user=Depends(get_db_user)
 ):
     instrument = crud.get_instrument_by_id(db=db, id=instrument_id) if instrument_id else None
 
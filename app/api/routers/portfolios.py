@@ -1,25 +1,19 @@
 from typing import List, Optional
 from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi import Query, Path, Body
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
 import app.api.constants as c
 from app.models import api_schema, models
-from app.api.dependencies import manager, SessionLocal, get_db
-from app.api import crud
+from app.api.dependencies import manager, SessionLocal, get_db, get_db_user
+from app.api import crud, entitlements, jobs, stats_refresh
 from app.api.exceptions import SnipsError
-from app.api.tools.premium import validate_premium
 
 router = APIRouter()
 
 
-def calculate_portfolio_stats(db: Session, portfolio_id: int):
-    crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id,
-                                 refresh_timeout=c.PORTFOLIO_STATS_UPDATE_TIMEOUT_SECONDS)
-
-
 @router.post("/portfolios", response_model=api_schema.PortfolioView, tags=["portfolios"])
 def create_portfolio(
     db: Session = Depends(get_db),
@@ -108,7 +102,6 @@ def get_portfolios_leaderboard(
 
 @router.get("/portfolios/{portfolio_id}", response_model=api_schema.PortfolioUserView, tags=["portfolios"])
 def get_portfolio(
-    background_tasks: BackgroundTasks,
     portfolio_id: int = Path(...,
                              title="The portfolio unique identifier", ge=1),
     db: Session = Depends(get_db),
@@ -122,7 +115,9 @@ def get_portfolio(
         raise HTTPException(status_code=404, detail="Portfolio not found")
     elif db_portfolio.user_id != user.id and db_portfolio.is_public == 0:
         raise HTTPException(status_code=403, detail="Not authorized")
-    background_tasks.add_task(calculate_portfolio_stats, db, portfolio_id)
+    stats_refresh.request_refresh(
+        portfolio_id=portfolio_id,
+        date_last_updated=db_portfolio.stats.date_last_updated if db_portfolio.stats else None)
     return db_portfolio
 
 
@@ -238,7 +233,6 @@ def delete_portfolio(
 
 @router.get("/portfolios/{portfolio_id}/holdings", response_model=List[api_schema.Holding], tags=["portfolios"])
 def get_portfolio_holdings(
-    background_tasks: BackgroundTasks,
     portfolio_id: int = Path(...,
                              title="The portfolio unique identifier", ge=1),
     skip: int = 0,
@@ -249,12 +243,12 @@ def get_portfolio_holdings(
     sort_by: str = Query(
         "date_last_updated",
         title="The field to sort by",
-        description="The field to sort by",
+        description="The field to sort by: date_last_updated, market_value, unrealized_pnl, unrealized_pnl_perc, quantity or name",
     ),
     sort_order: str = Query(
         "desc",
         title="The sort order",
-        description="The sort order",
+        description="The sort order: asc or desc",
     ),
     ignore_sold_off: bool = Query(
         True,
@@ -274,7 +268,9 @@ def get_portfolio_holdings(
         raise HTTPException(status_code=403, detail="Not authorized")
     db_holdings = crud.get_holdings_by_portfolio_id(
         db=db, portfolio_id=portfolio_id, skip=skip, limit=limit, sort_by=sort_by, sort_order=sort_order, ignore_sold_off=ignore_sold_off)
-    background_tasks.add_task(calculate_portfolio_stats, db, portfolio_id)
+    stats_refresh.request_refresh(
+        portfolio_id=portfolio_id,
+        date_last_updated=db_portfolio.stats.date_last_updated if db_portfolio.stats else None)
     return db_holdings
 
 
@@ -302,6 +298,50 @@ def get_portfolio_holding(
     return db_holding
 
 
+@router.get("/portfolios/{portfolio_id}/history", response_model=List[api_schema.PortfolioValueHistoryBar], tags=["portfolios"])
+def get_portfolio_value_history(
+    portfolio_id: int = Path(...,
+                             title="The portfolio unique identifier", ge=1),
+    lookback_days: Optional[int] = Query(
+        None,
+        ge=1,
+        title="How many days to look back",
+        description="How many days to look back",
+    ),
+    lookback_hours: Optional[int] = Query(
+        24,
+        ge=1,
+        title="How many hours to look back",
+        description="How many hours to look back",
+    ),
+    bar_interval: Optional[str] = Query(
+        '1H',
+        title="Bar interval",
+        description="1H = 1 hour, 1D = 1 day",
+    ),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Get portfolio net worth history by portfolio ID
+    """
+    if bar_interval not in c.PORTFOLIO_VALUE_HISTORY_TIMEFRAMES:
+        raise HTTPException(status_code=400, detail="Unsupported bar interval")
+
+    db_portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+    if db_portfolio is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    elif db_portfolio.user_id != user.id and db_portfolio.is_public == 0:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    if lookback_days:
+        lookback_hours = lookback_days * 24
+    db_bars = crud.get_portfolio_value_history(
+        db=db, portfolio_id=portfolio_id,
+        lookback_hours=lookback_hours, bar_interval=bar_interval)
+    return db_bars
+
+
 @router.get("/portfolios/{portfolio_id}/transactions", response_model=List[api_schema.PortfolioTransaction], tags=["portfolios"])
 def get_portfolio_transactions(
     portfolio_id: int = Path(...,
@@ -437,8 +477,20 @@ def execute_portfolio_transaction(
         portfolio_transaction = crud.execute_portfolio_transaction(
             db=db,
             id=portfolio_transaction_id,
+            commit=False,
         )
+        # XP is credited by the job worker, off the request path.
+        # The job is committed with the trade, so an executed trade always has its job
+        jobs.enqueue_job(
+            db=db,
+            job_type=c.JOB_TYPE.XP_TRANSACTION_EXECUTED,
+            payload={'transaction_id': portfolio_transaction.id},
+            dedup_key=f'{c.JOB_TYPE.XP_TRANSACTION_EXECUTED}:{portfolio_transaction.id}',
+            commit=False,
+        )
+        db.commit()
     except SQLAlchemyError as e:
+        db.rollback()
         print(e)
         raise HTTPException(
             status_code=400, detail="Could not execute the transaction due to a database error")
@@ -447,19 +499,131 @@ def execute_portfolio_transaction(
         raise HTTPException(
             status_code=400, detail="Could not execute the transaction due to a Snips error")
 
-    if portfolio_transaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value:
-        crud.credit_xp_on_buy_if_eligible(
-            db=db,
-            transaction_id=portfolio_transaction.id
-        )
-    elif portfolio_transaction.transaction_type == models.PortfolioTransactionTypeUserScope.SELL.value:
-        crud.credit_xp_on_sell_if_eligible(
+    return portfolio_transaction
+
+@router.post("/portfolios/{portfolio_id}/orders", response_model=api_schema.PortfolioOrder, tags=["portfolios"])
+def create_portfolio_order(
+    portfolio_id: int = Path(...,
+                             title="The portfolio unique identifier", ge=1),
+    instrument_id: int = Body(...,
+                              title="The instrument unique identifier", ge=1),
+    order_type: models.PortfolioOrderType = Body(
+        ..., title="The order type"),
+    side: models.PortfolioTransactionTypeUserScope = Body(
+        ..., title="Buy or sell once the order is triggered"),
+    quantity: float = Body(...,
+                           title="The quantity of the instrument to buy or sell", ge=0.0001),
+    trigger_price: float = Body(...,
+                                title="The price at which the order is executed", gt=0),
+    message: str = Body(None,
+                        title="User-generated message/comment associated with the order"),
+    db: Session = Depends(get_db),
+    user=Depends(manager),
+):
+    """
+    Place a resting limit, stop-loss or take-profit order.
+    The order is executed at the latest price once the price crosses the trigger price
+    """
+    portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+    if portfolio is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    elif portfolio.user_id != user.id:
+        raise HTTPException(
+            status_code=403, detail="You do not own this portfolio")
+
+    if order_type != models.PortfolioOrderType.LIMIT and side != models.PortfolioTransactionTypeUserScope.SELL:
+        raise HTTPException(
+            status_code=400, detail="Stop-loss and take-profit orders can only sell")
+
+    instrument = crud.get_instrument_by_id(db=db, id=instrument_id)
+    if instrument is None:
+        raise HTTPException(status_code=404, detail="Instrument not found")
+    elif instrument.kpi_latest_price is None:
+        raise HTTPException(
+            status_code=403, detail="Instrument has no price data")
+
+    if side == models.PortfolioTransactionTypeUserScope.SELL:
+        holding = crud.get_holding_by_id(db=db, portfolio_id=portfolio_id, instrument_id=instrument_id)
+        if holding is None or holding.quantity < quantity:
+            raise HTTPException(
+                status_code=403, detail="You do not own enough of this instrument to sell it")
+
+    try:
+        order = crud.create_order(
             db=db,
-            transaction_id=portfolio_transaction.id
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+            order_type=order_type.value,  # unpack enum
+            side=side.value,  # unpack enum
+            quantity=quantity,
+            trigger_price=trigger_price,
+            message=message,
         )
-    crud.credit_xp_on_transaction_execute_if_eligible(db=db, transaction_id=portfolio_transaction.id)
-    
-    return portfolio_transaction
+    except SQLAlchemyError as e:
+        print(e)
+        raise HTTPException(
+            status_code=400, detail="Could not create an order")
+    return order
+
+
+@router.get("/portfolios/{portfolio_id}/orders", response_model=List[api_schema.PortfolioOrder], tags=["portfolios"])
+def get_portfolio_orders(
+    portfolio_id: int = Path(...,
+                             title="The portfolio unique identifier", ge=1),
+    status: Optional[str] = Query(
+        None,
+        title="Filter orders by status",
+        enum=["open", "executed", "cancelled", "failed"]
+    ),
+    skip: int = 0,
+    limit: int = Query(
+        c.MAX_ELEMENTS_PER_PAGE,
+        le=c.MAX_ELEMENTS_PER_PAGE,
+    ),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Get portfolio orders by ID
+    """
+    db_portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+    if db_portfolio is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    elif db_portfolio.user_id != user.id:
+        raise HTTPException(status_code=403, detail="You do not own this portfolio")
+
+    db_orders = crud.get_orders_by_portfolio_id(
+        db=db, portfolio_id=portfolio_id, status=status, skip=skip, limit=limit)
+    return db_orders
+
+
+@router.delete("/orders/{order_id}", response_model=api_schema.PortfolioOrder, tags=["portfolios"])
+def cancel_portfolio_order(
+    order_id: int = Path(..., title="The order unique identifier", ge=1),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Cancel an open order
+    """
+    db_order = crud.get_order_by_id(db=db, id=order_id)
+    if db_order is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    elif db_order.portfolio.user_id != user.id:
+        raise HTTPException(
+            status_code=403, detail="You do not own this portfolio")
+
+    try:
+        db_order = crud.cancel_order(db=db, id=order_id)
+    except SQLAlchemyError as e:
+        print(e)
+        raise HTTPException(
+            status_code=400, detail="Could not cancel the order due to a database error")
+    except SnipsError as e:
+        raise HTTPException(
+            status_code=403, detail="Only open orders can be cancelled")
+    return db_order
+
 
 @router.get("/transactions", response_model=List[api_schema.PortfolioTransactionDetailed], tags=["portfolios"])
 def get_transactions(
@@ -491,6 +655,16 @@ def get_transactions(
 
 
 
+def check_claim_portfolio(db: Session, portfolio_id: int, user_id: int):
+    portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+    if portfolio is None:
+        raise HTTPException(
+            status_code=404, detail="Portfolio not found")
+    elif portfolio.user_id != user_id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorised to claim on behalf of this portfolio/character")
+
+
 @router.post(
     "/portfolios/{portfolio_id}/claims/all",
     response_model=api_schema.RewardClaimResponse,
@@ -506,86 +680,30 @@ def claim_all_rewards(
         embed=True
     ),
 
-    user=Depends(manager),
+    user=Depends(get_db_user),
 ):
-    is_premium = False
-    portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
-    if portfolio is None:
-        raise HTTPException(
-            status_code=404, detail="Portfolio not found")
-    elif portfolio.user_id != user.id:
-        raise HTTPException(
-            status_code=403, detail="You are not authorised to claim on behalf of this portfolio/character")
-    
-    datetime_now = datetime.now(tz=timezone.utc)
-
-    delta_intraday_reward = timedelta(hours=1, minutes=55)  # 1h45m instead of 2 hours to account for UX
-    delta_daily_reward = timedelta(hours=18)  # 18 hours instead of 24 to account for UX
-    delta_weekly_reward = timedelta(hours=160)  # 160 hours instead of 168 to account for UX
-
-    reward_schedule = {
-        'REWARD_WEEKLY': {
-            'FREE_PLAN': c.REWARD_WEEKLY_FREE_PLAN,
-            'PREMIUM_PLAN': c.REWARD_WEEKLY_PREMIUM_PLAN,
-            'is_eligible': portfolio.date_last_claimed_weekly_reward is None or portfolio.date_last_claimed_weekly_reward <= (datetime_now - delta_weekly_reward)
-        },
-        'REWARD_DAILY': {
-            'FREE_PLAN': c.REWARD_DAILY_FREE_PLAN,
-            'PREMIUM_PLAN': c.REWARD_DAILY_PREMIUM_PLAN,
-            'is_eligible': portfolio.date_last_claimed_daily_reward is None or portfolio.date_last_claimed_daily_reward <= (datetime_now - delta_daily_reward)
-
-        },
-        'REWARD_INTRADAY': {
-            'FREE_PLAN': c.REWARD_INTRADAY_FREE_PLAN,
-            'PREMIUM_PLAN': c.REWARD_INTRADAY_PREMIUM_PLAN,
-            'is_eligible': portfolio.date_last_claimed_intraday_reward is None or portfolio.date_last_claimed_intraday_reward <= (datetime_now - delta_intraday_reward)
-        }
-    }
+    is_premium = entitlements.get_premium_status(
+        db=db, user=user, revcat_public_api_key=revcat_public_api_key)
 
-    if revcat_public_api_key is not None:
-        is_premium = validate_premium(
-            user_id=user.id,
-            secret_id=user.secret_id,
-            revcat_public_api_key=revcat_public_api_key,
-            should_update_user=True
+    plan_type = 'PREMIUM_PLAN' if is_premium else 'FREE_PLAN'
+    try:
+        claimed = crud.claim_portfolio_rewards(
+            db=db, portfolio_id=portfolio_id, user_id=user.id,
+            rewards={reward_type: amounts[plan_type] for reward_type, amounts in c.REWARD_SCHEDULE.items()}
         )
+    except SnipsError as e:
+        raise HTTPException(
+            status_code=400, detail="Could not claim a bonus")
+
+    if not claimed:
+        # nothing was claimed: find out why
+        check_claim_portfolio(db=db, portfolio_id=portfolio_id, user_id=user.id)
 
-    plan_type = 'PREMIUM_PLAN' if is_premium else 'FREE_PLAN'
-    total_claimed = 0
-    xp_earned = 0
-
-    for reward_type, reward_item in reward_schedule.items():
-        if reward_item['is_eligible']:
-            reward_amount = reward_item.get(plan_type, 0)
-            try:
-                crud.claim_portfolio_reward(
-                    db=db, portfolio_id=portfolio_id, reward_type=reward_type, reward_amount=reward_amount
-                )
-                total_claimed = total_claimed + reward_amount
-            except SnipsError as e:
-                raise HTTPException(
-                    status_code=400, detail="Could not claim a bonus")
-
-            # credit XP for claiming a bonus
-            try:
-                crud.credit_xp_by_user_id(
-                    db=db,
-                    user_id=portfolio.user_id,
-                    xp_amount=c.XP_CREDIT.COLLECT_REWARD,
-                    xp_reason=c.XP_REASON.COLLECT_REWARD,
-                    xp_detail=reward_type
-                )
-                xp_earned = xp_earned + c.XP_CREDIT.COLLECT_REWARD
-            except Exception as e:
-                db.rollback()
-
-    crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id, refresh_timeout=0)
-    # portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
     return {
-        'total_claimed': total_claimed,
-        'xp_earned': xp_earned
+        'total_claimed': sum(claimed.values()),
+        'xp_earned': c.XP_CREDIT.COLLECT_REWARD * len(claimed)
     }
-  
+
 
 @router.post(
     "/portfolios/{portfolio_id}/claims/{claim_type}",
@@ -606,81 +724,33 @@ def claim_bonus(
         embed=True
     ),
 
-    user=Depends(manager),
+    user=Depends(get_db_user),
 ):
     """
     Claim a bonus
     """
 
-    is_premium = False
-    portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
     if claim_type not in ['REWARD_DAILY', 'REWARD_WEEKLY']:
         raise HTTPException(
             status_code=400, detail="claim_type invalid")
-    elif portfolio is None:
-        raise HTTPException(
-            status_code=404, detail="Portfolio not found")
-    elif portfolio.user_id != user.id:
-        raise HTTPException(
-            status_code=403, detail="You are not authorised to claim on behalf of this portfolio/character")
-
 
-    datetime_now = datetime.now(tz=timezone.utc)
-    delta_daily_reward = timedelta(hours=18)  # 18 hours instead of 24 to account for UX
-    delta_weekly_reward = timedelta(hours=160)  # 160 hours instead of 168 to account for UX
-    
-    reward_schedule = {
-        'REWARD_WEEKLY': {
-            'FREE_PLAN': c.REWARD_WEEKLY_FREE_PLAN,
-            'PREMIUM_PLAN': c.REWARD_WEEKLY_PREMIUM_PLAN
-        },
-        'REWARD_DAILY': {
-            'FREE_PLAN': c.REWARD_DAILY_FREE_PLAN,
-            'PREMIUM_PLAN': c.REWARD_DAILY_PREMIUM_PLAN
-        }
-    }
-
-    is_eligible_for_weekly_reward = claim_type == 'REWARD_WEEKLY' and \
-        (portfolio.date_last_claimed_weekly_reward is None or portfolio.date_last_claimed_weekly_reward <= (datetime_now - delta_weekly_reward))
-    is_eligible_for_daily_reward = claim_type == 'REWARD_DAILY' and \
-        (portfolio.date_last_claimed_daily_reward is None or portfolio.date_last_claimed_daily_reward <= (datetime_now - delta_daily_reward))
+    is_premium = entitlements.get_premium_status(
+        db=db, user=user, revcat_public_api_key=revcat_public_api_key)
 
-    if revcat_public_api_key is not None:
-        is_premium = validate_premium(
-            user_id=user.id,
-            secret_id=user.secret_id,
-            revcat_public_api_key=revcat_public_api_key,
-            should_update_user=True
+    plan_type = 'PREMIUM_PLAN' if is_premium else 'FREE_PLAN'
+    try:
+        claimed = crud.claim_portfolio_rewards(
+            db=db, portfolio_id=portfolio_id, user_id=user.id,
+            rewards={claim_type: c.REWARD_SCHEDULE[claim_type][plan_type]}
         )
+    except SnipsError as e:
+        raise HTTPException(
+            status_code=400, detail="Could not claim a bonus")
 
-    if is_eligible_for_weekly_reward or is_eligible_for_daily_reward:
-        plan_type = 'PREMIUM_PLAN' if is_premium else 'FREE_PLAN'
-        reward_amount = reward_schedule.get(claim_type, {}).get(plan_type, 0)
-        try:
-            crud.claim_portfolio_reward(
-                db=db, portfolio_id=portfolio_id, reward_type=claim_type, reward_amount=reward_amount
-            )
-        except SnipsError as e:
-            raise HTTPException(
-                status_code=400, detail="Could not claim a bonus")
-
-        # credit XP for claiming a bonus
-        try:
-            crud.credit_xp_by_user_id(
-                db=db,
-                user_id=portfolio.user_id,
-                xp_amount=c.XP_CREDIT.COLLECT_REWARD,
-                xp_reason=c.XP_REASON.COLLECT_REWARD,
-                xp_detail=claim_type
-            )
-        except Exception as e:
-            db.rollback()
-
-        crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id, refresh_timeout=0)
-        portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
-        return portfolio
-
-    else:
+    if not claimed:
+        check_claim_portfolio(db=db, portfolio_id=portfolio_id, user_id=user.id)
         raise HTTPException(
             status_code=403, detail="You can't claim a reward at this time, please wait")
 
+    return crud.get_portfolio_by_id(db=db, id=portfolio_id)
+
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException
@@ -8,7 +9,7 @@ from sqlalchemy.exc import SQLAlchemyError
 import app.api.constants as c
 from app.models import api_schema, enums
 from app.api.dependencies import manager, SessionLocal, get_db
-from app.api import crud
+from app.api import crud, leaderboard, xp_epochs
 
 router = APIRouter()
 
@@ -34,7 +35,131 @@ def get_xp_leaderboard(
     Get leaderboard of users' portfolios sorted by users' XP
     """
     q_clean = q if q is None else q.strip()
-    db_leaders = crud.get_xp_leaderboard(
-        db=db, q=q_clean, timeframe='weekly',
-        skip=skip, limit=limit)
+    if q_clean:
+        # name search is served by the database
+        db_leaders = crud.get_xp_leaderboard(
+            db=db, q=q_clean, timeframe='weekly',
+            skip=skip, limit=limit)
+    else:
+        db_leaders = leaderboard.get_xp_leaderboard_page(
+            db=db, timeframe='weekly',
+            skip=skip, limit=limit)
     return db_leaders
+
+
+@router.get("/leaderboard/me",
+    response_model=api_schema.LeaderboardNeighbourhood,
+    tags=["social"])
+def get_my_leaderboard_rank(
+    timeframe: str = Query(
+        'weekly',
+        title="Leaderboard",
+        description="weekly, season or total XP, or gain"),
+    portfolio_id: Optional[int] = Query(
+        None,
+        ge=1,
+        title="The portfolio unique identifier",
+        description="One of the requester's portfolios, the oldest one by default"),
+    k: int = Query(
+        5,
+        ge=0,
+        le=c.LEADERBOARD_MAX_NEIGHBOURS,
+        title="How many players above and below to return"),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Get the requester's rank and the players ranked around them
+    """
+    if timeframe not in leaderboard.TIMEFRAMES:
+        raise HTTPException(status_code=400, detail="Unsupported leaderboard")
+
+    if portfolio_id is None:
+        db_portfolio = crud.get_default_portfolio_by_user_id(db=db, user_id=user.id)
+        if db_portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        portfolio_id = db_portfolio.id
+    else:
+        db_portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+        if db_portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        elif db_portfolio.user_id != user.id:
+            raise HTTPException(status_code=403, detail="Not authorized")
+
+    rank, n_ranked, entries = leaderboard.get_neighbourhood(
+        db=db, timeframe=timeframe, portfolio_id=portfolio_id, k=k)
+    return {
+        'timeframe': timeframe,
+        'rank': rank,
+        'n_ranked': n_ranked,
+        'entries': [{'rank': entry_rank, 'portfolio': portfolio} for entry_rank, portfolio in entries],
+    }
+
+
+@router.get("/leaderboard/history/dates",
+    response_model=List[datetime],
+    tags=["social"])
+def get_xp_leaderboard_history_dates(
+    timeframe: str = Query(
+        'season',
+        title="Leaderboard",
+        description="weekly or season XP"),
+    skip: int = 0,
+    limit: int = Query(
+        c.MAX_ELEMENTS_PER_PAGE,
+        le=c.MAX_ELEMENTS_PER_PAGE,
+    ),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Get the dates of the archived leaderboards, most recent first
+    """
+    if timeframe not in xp_epochs.SNAPSHOT_TIMEFRAMES:
+        raise HTTPException(status_code=400, detail="Unsupported leaderboard")
+    return crud.get_xp_snapshot_dates(db=db, timeframe=timeframe, skip=skip, limit=limit)
+
+
+@router.get("/leaderboard/history",
+    response_model=api_schema.XPSnapshotLeaderboard,
+    tags=["social"])
+def get_xp_leaderboard_history(
+    timeframe: str = Query(
+        'season',
+        title="Leaderboard",
+        description="weekly or season XP"),
+    date_as_of: Optional[datetime] = Query(
+        None,
+        title="Snapshot date",
+        description="One of /leaderboard/history/dates, the most recent by default"),
+    skip: int = 0,
+    limit: int = Query(
+        c.MAX_ELEMENTS_PER_PAGE,
+        le=c.MAX_ELEMENTS_PER_PAGE,
+    ),
+    db: Session = Depends(get_db),
+    user=Depends(manager)
+):
+    """
+    Get an archived leaderboard of a past week or season
+    """
+    if timeframe not in xp_epochs.SNAPSHOT_TIMEFRAMES:
+        raise HTTPException(status_code=400, detail="Unsupported leaderboard")
+
+    if date_as_of is None:
+        dates = crud.get_xp_snapshot_dates(db=db, timeframe=timeframe, skip=0, limit=1)
+        if not dates:
+            raise HTTPException(status_code=404, detail="Leaderboard not found")
+        date_as_of = dates[0]
+
+    entries = crud.get_xp_snapshot_leaderboard(
+        db=db, timeframe=timeframe, date_as_of=date_as_of,
+        skip=skip, limit=limit)
+    return {
+        'timeframe': timeframe,
+        'date_as_of': date_as_of,
+        'entries': [
+            {'rank': rank, 'xp_collected': xp_collected, 'portfolio': portfolio}
+            for rank, xp_collected, portfolio in entries
+        ],
+    }
@@ -18,8 +18,8 @@ import nacl
 
 import app.api.constants as c
 from app.models import api_schema, models
-from app.api.dependencies import manager, SessionLocal, get_db
-from app.api import crud
+from app.api.dependencies import manager, SessionLocal, get_db, get_db_user
+from app.api import crud, last_active
 from app.api.exceptions import SnipsError
 from app.api.auth.apple_auth import AppleAuth
 from app.api.auth.google_auth import GoogleAuth
@@ -45,21 +45,6 @@ class PushTokenProviderEnum(str, Enum):
     #APNS = 'APNS'  # apple push notifications service
     #FCM = 'FCM'  # firebase cloud messaging
 
-@manager.user_loader()
-def get_user(
-        user_id: str,
-        db: Session = Depends(get_db)):
-    db = SessionLocal()
-    try:
-        user = crud.get_user_by_id(db=db, id=user_id)
-        if user:
-            # return user
-            return crud.update_user_last_active_date(db=db, user_id=user_id)
-    finally:
-        # pass
-        db.close()
-
-
 @router.post("/auth/solana",
             response_model=api_schema.LoggedInUser,
             tags=["users"])
@@ -137,8 +122,8 @@ def auth_with_public_key(
         except Exception as e:
             db.rollback()
 
-        access_token = manager.create_access_token(
-            data={'sub': new_user.id},
+        access_token = manager.create_user_access_token(
+            user=new_user,
             expires=timedelta(hours=c.VERIFIED_USER_TOKEN_EXPIRATION_HOURS)
         )
 
@@ -148,8 +133,8 @@ def auth_with_public_key(
             'user': new_user
         }
 
-    access_token = manager.create_access_token(
-        data={'sub': db_user.id},
+    access_token = manager.create_user_access_token(
+        user=db_user,
         expires=timedelta(hours=c.VERIFIED_USER_TOKEN_EXPIRATION_HOURS)
     )
 
@@ -180,7 +165,7 @@ def auth_with_ext_account(
             ext_user = google_auth.validate_access_token(token)
         elif provider == AuthProvider.apple:
             ext_user = apple_auth.validate_jwt(token)
-    except jwt.exceptions.PyJWTError as e:
+    except (jwt.exceptions.PyJWTError, SnipsError) as e:
         raise HTTPException(status_code=400, detail="Invalid identity token")
 
     db_user = crud.get_user_by_ext_user_id(
@@ -221,8 +206,8 @@ def auth_with_ext_account(
         except Exception as e:
             db.rollback()
 
-        access_token = manager.create_access_token(
-            data={'sub': new_user.id},
+        access_token = manager.create_user_access_token(
+            user=new_user,
             expires=timedelta(hours=c.VERIFIED_USER_TOKEN_EXPIRATION_HOURS)
         )
 
@@ -232,8 +217,8 @@ def auth_with_ext_account(
             'user': new_user
         }
 
-    access_token = manager.create_access_token(
-        data={'sub': db_user.id},
+    access_token = manager.create_user_access_token(
+        user=db_user,
         expires=timedelta(hours=c.VERIFIED_USER_TOKEN_EXPIRATION_HOURS)
     )
 
@@ -278,8 +263,8 @@ def create_anonymous_user(
     except Exception as e:
         db.rollback()
 
-    access_token = manager.create_access_token(
-        data={'sub': user.id},
+    access_token = manager.create_user_access_token(
+        user=user,
         expires=timedelta(hours=c.ANONYMOUS_USER_TOKEN_EXPIRATION_HOURS)
     )
 
@@ -323,7 +308,7 @@ def set_investing_experience(
 @router.put("/users/me/referrer", response_model=api_schema.CurrentUser, tags=["users"])
 def set_referrer(
     db: Session = Depends(get_db),
-    user=Depends(manager),
+    user=Depends(get_db_user),
     referrer_id: int = Body(
         ...,
         title="The user's referrer",
@@ -536,7 +521,7 @@ def connect_public_key(
 @router.post("/users/me/accounts/{provider}", response_model=api_schema.ConnectedExternalUserAccount, tags=["users"])
 def connect_ext_account(
     db: Session = Depends(get_db),
-    user=Depends(manager),
+    user=Depends(get_db_user),
     provider: AuthProvider = Path(..., title="External identity provider"),
     token: str = Body(
         ...,
@@ -548,8 +533,6 @@ def connect_ext_account(
     """
     Connect an external account (Google, Apple, etc.)
     """
-    db = SessionLocal()
-
     ext_user = None
     try:
         if provider == AuthProvider.google:
@@ -607,21 +590,17 @@ def refresh_token(
         max_length=50,
         embed=True
     ),
-    user=Depends(manager)
+    db_user=Depends(get_db_user)
 ):
-
-    db = SessionLocal()
-    db_user = crud.get_user_by_id(db=db, id=user.id)
-
     crud.set_user_last_seen_attributes(
         db=db,
-        user_id=user.id,
+        user_id=db_user.id,
         platform_name=last_seen_platform,
         app_version=last_seen_app_version
     )
 
-    access_token = manager.create_access_token(
-        data={'sub': db_user.id},
+    access_token = manager.create_user_access_token(
+        user=db_user,
         expires=timedelta(hours=c.ANONYMOUS_USER_TOKEN_EXPIRATION_HOURS)
     )
 
@@ -652,6 +631,9 @@ def delete_user(
         db.rollback()
         raise HTTPException(status_code=500, detail="Cannot delete the user")
 
+    # the other API processes find out at their next last active flush
+    last_active.tracker.mark_deleted(user.id)
+
     return {
         "user": db_user,
         "deleted": True,
@@ -0,0 +1,39 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Header
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import api_schema
+from app.api.dependencies import get_db
+from app.api import entitlements
+
+router = APIRouter()
+
+# value of the Authorization header configured for the RevenueCat webhook
+revcat_webhook_auth = os.getenv("APP_REVCAT_WEBHOOK_AUTH", None)
+
+
+@router.post("/webhooks/revenuecat", tags=["webhooks"])
+def receive_revenuecat_event(
+    payload: api_schema.RevenueCatWebhook,
+    authorization: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """
+    Update the premium entitlement cache of the users of a RevenueCat event
+    """
+    if revcat_webhook_auth is None or not hmac.compare_digest(authorization or '', revcat_webhook_auth):
+        raise HTTPException(status_code=401, detail="Not authorized")
+
+    try:
+        n_users = entitlements.apply_revcat_event(db=db, event=payload.event)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        # RevenueCat retries the delivery
+        raise HTTPException(status_code=500, detail="Could not process the event")
+
+    return {'users_updated': n_users}
@@ -0,0 +1,104 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import app.api.constants as c
+from app.api import crud
+from app.api.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class StatsRefreshCoordinator:
+    """
+    Coalesce portfolio stats refresh requests made while serving API calls.
+
+    A refresh requested for a portfolio is delayed by the debounce window, and further requests
+    for the same portfolio made meanwhile are merged into it, so a popular portfolio is refreshed
+    at most once per window whatever the number of views. Due refreshes run on a bounded thread
+    pool, each with its own session, and are skipped when the stats are already fresh.
+    A portfolio stays scheduled until its refresh completes, and at most max_pending refreshes are
+    waiting or running: requests beyond that are dropped rather than queued without bound.
+    """
+
+    def __init__(self, debounce_seconds: float, max_workers: int, max_pending: int, refresh_timeout: int):
+        self.debounce_seconds = debounce_seconds
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.refresh_timeout = refresh_timeout
+
+        self._condition = threading.Condition()
+        self._scheduled = set()  # portfolio ids from the request until their refresh completes
+        self._due = []  # heap of (due time, portfolio id)
+        self._executor = None
+        self._dispatcher = None
+
+    def is_fresh(self, date_last_updated: Optional[datetime]):
+        return date_last_updated is not None \
+            and date_last_updated + timedelta(seconds=self.refresh_timeout) >= datetime.now(tz=timezone.utc)
+
+    def request_refresh(self, portfolio_id: int, date_last_updated: Optional[datetime] = None):
+        """
+        Schedule a refresh of the portfolio stats, unless they are fresh, a refresh is already
+        scheduled or running, or too many refreshes are pending.
+        Returns True if a new refresh was scheduled
+        """
+        if self.is_fresh(date_last_updated):
+            return False
+
+        with self._condition:
+            if portfolio_id in self._scheduled:
+                return False
+            if len(self._scheduled) >= self.max_pending:
+                logger.warning(f'Dropped the stats refresh of portfolio {portfolio_id}, {len(self._scheduled)} refreshes pending')
+                return False
+            self._start()
+            self._scheduled.add(portfolio_id)
+            heapq.heappush(self._due, (time.monotonic() + self.debounce_seconds, portfolio_id))
+            self._condition.notify()
+        return True
+
+    def _start(self):
+        # started on first use, so that no threads are created at import time (e.g. before the server forks)
+        if self._dispatcher is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stats-refresh')
+        self._dispatcher = threading.Thread(target=self._dispatch, name='stats-refresh-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(timeout=self._due[0][0] - time.monotonic() if self._due else None)
+                _, portfolio_id = heapq.heappop(self._due)
+            self._executor.submit(self._refresh, portfolio_id)
+
+    def _refresh(self, portfolio_id: int):
+        db = SessionLocal()
+        try:
+            crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id, refresh_timeout=self.refresh_timeout)
+        except Exception as e:
+            db.rollback()
+            logger.error(f'Failed to refresh the stats of portfolio {portfolio_id}: {e}')
+        finally:
+            db.close()
+            # requests made from now on schedule a new refresh
+            with self._condition:
+                self._scheduled.discard(portfolio_id)
+
+
+coordinator = StatsRefreshCoordinator(
+    debounce_seconds=c.PORTFOLIO_STATS_REFRESH_DEBOUNCE_SECONDS,
+    max_workers=c.PORTFOLIO_STATS_REFRESH_MAX_WORKERS,
+    max_pending=c.PORTFOLIO_STATS_REFRESH_MAX_PENDING,
+    refresh_timeout=c.PORTFOLIO_STATS_UPDATE_TIMEOUT_SECONDS,
+)
+
+
+def request_refresh(portfolio_id: int, date_last_updated: Optional[datetime] = None):
+    return coordinator.request_refresh(portfolio_id=portfolio_id, date_last_updated=date_last_updated)
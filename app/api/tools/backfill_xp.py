@@ -1,320 +1,362 @@
-import logging
-import json
+import csv
+import io
 import math
-from datetime import datetime, timedelta, timezone
-from typing import List, Optional
-
-from sqlalchemy.exc import IntegrityError
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+import click
+from sqlalchemy import Float, Integer, cast, column, func, insert, literal, null, select, update, values
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 
-from app.api import crud
+from app.api import xp_counters, xp_rollup
 from app.api.database import engine, SessionLocal
+from app.api.tools.xp_onrestart_recalc import recalc_xp
 from app.models import models
 import app.api.constants as c
 
+XP_WINDOW = timedelta(hours=c.XP_COUNTER_WINDOW_HOURS)
 
-def get_weekly_reset_cutover() -> datetime:
-    now_utc = datetime.now(timezone.utc)
-    last_monday = now_utc - timedelta(days=now_utc.weekday())
-    cutover_date = last_monday.replace(hour=0, minute=0, second=0, microsecond=0)
-    return cutover_date
-
-
-def backdate_xp_by_user_id(db: Session, user_id: int, backfill_date: datetime, xp_amount: int, xp_reason: str, xp_detail: Optional[str]=None):
-    # Create transaction
-    transaction = models.XPTransaction(
-        user_id=user_id,
-        amount=xp_amount,
-        reason=xp_reason,
-        detail=xp_detail,
-        date_credited=backfill_date,
-    )
-    db.add(transaction)
 
-    # Get user object + increment XP stats
-    user = crud.get_user_by_id(db=db, id=user_id)
-    user.xp_total = models.User.xp_total + xp_amount
-    if backfill_date >= get_weekly_reset_cutover():
-        user.xp_current_week = models.User.xp_current_week + xp_amount
-    db.merge(user)
+class ReplayedCredit(NamedTuple):
+    user_id: int
+    amount: int
+    reason: str
+    detail: Optional[str]
+    date_credited: datetime
 
-    # Commit the changes
-    db.commit()
 
+class XPRules:
+    """
+    XP rules of executed portfolio transactions, evaluated over in-memory state while the
+    transaction log is replayed in id order.
 
-def backdate_xp_on_buy_if_eligible(db: Session, transaction_id: int, backfill_date: datetime):
-    transaction = crud.get_portfolio_transaction_by_id(db=db, id=transaction_id)
-    if transaction is None:
-        return False
-    # c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS
+    Mirrors crud.credit_xp_on_transaction_execute_if_eligible: holdings give the average price
+    a sale is made at, and rolling 24 hour windows replace the xp_counters lookups
+    (buys per instrument of a portfolio, XP from sales at profit per user).
+    The windows are exact, where the live counters are rounded to XP_COUNTER_BUCKET_SECONDS
+    """
 
-    date_24_hours_ago = backfill_date - timedelta(hours=24)
-    n_unique_instruments = db \
-        .query(models.PortfolioTransaction) \
-        .distinct(models.PortfolioTransaction.associated_instrument_id) \
-        .filter (
-            # transactions executed that belong to the requester
-            models.PortfolioTransaction.portfolio_id == transaction.portfolio_id,
-            models.PortfolioTransaction.status == 'executed',
-            models.PortfolioTransaction.date_executed != None,
-            models.PortfolioTransaction.associated_instrument_id != None,
-            models.PortfolioTransaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value,
-            models.PortfolioTransaction.date_executed > date_24_hours_ago,
-        ) \
-        .count()
-
-    if n_unique_instruments <= c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS:
-        user_id = transaction.portfolio.user_id
-        backdate_xp_by_user_id(
-            db=db,
-            user_id=user_id,
-            backfill_date=transaction.date_executed,
-            xp_amount=c.XP_CREDIT.BUY_TRANSACTION,
-            xp_reason=c.XP_REASON.BUY_TRANSACTION,
-            xp_detail=f"TX={transaction.id}",
+    def __init__(self):
+        self.holdings = {}  # (portfolio_id, instrument_id) -> [shares, book value]
+        self.buys = {}  # portfolio_id -> deque of (date, instrument_id)
+        self.buy_counts = {}  # portfolio_id -> Counter of instrument_id
+        self.sell_credits = {}  # user_id -> deque of (date, amount)
+        self.sell_totals = Counter()  # user_id -> XP in sell_credits
+
+    def _expire(self, window: deque, date_now: datetime):
+        while window and window[0][0] <= date_now - XP_WINDOW:
+            yield window.popleft()
+
+    def _buy(self, transaction) -> Optional[ReplayedCredit]:
+        holding = self.holdings.setdefault((transaction.portfolio_id, transaction.associated_instrument_id), [0, 0])
+        holding[0] += transaction.quantity
+        holding[1] += transaction.value
+
+        window = self.buys.setdefault(transaction.portfolio_id, deque())
+        counts = self.buy_counts.setdefault(transaction.portfolio_id, Counter())
+        for _, instrument_id in self._expire(window, transaction.date_executed):
+            counts[instrument_id] -= 1
+            if counts[instrument_id] == 0:
+                del counts[instrument_id]
+        window.append((transaction.date_executed, transaction.associated_instrument_id))
+        counts[transaction.associated_instrument_id] += 1
+
+        # first purchase of the instrument in 24 hours, and few enough unique instruments
+        if counts[transaction.associated_instrument_id] == 1 \
+                and len(counts) <= c.XP_LIMIT.BUY_TRANSACTION_UNIQUE_ELIGIBLE_INSTRUMENTS:
+            return ReplayedCredit(
+                user_id=transaction.user_id,
+                amount=c.XP_CREDIT.BUY_TRANSACTION,
+                reason=c.XP_REASON.BUY_TRANSACTION,
+                detail=f"TX={transaction.id}",
+                date_credited=transaction.date_executed,
+            )
+        return None
+
+    def ex_avg_price(self, transaction) -> Optional[float]:
+        shares, book_value = self.holdings.get((transaction.portfolio_id, transaction.associated_instrument_id), [0, 0])
+        return book_value / shares if shares > 0 else None
+
+    def _sell(self, transaction, ex_avg_price: Optional[float]) -> Optional[ReplayedCredit]:
+        key = (transaction.portfolio_id, transaction.associated_instrument_id)
+        shares, book_value = self.holdings.get(key, [0, 0])
+        shares, book_value = shares - transaction.quantity, book_value - transaction.value
+        self.holdings[key] = [shares, book_value] if shares >= 0 else [0, 0]
+
+        if ex_avg_price is None or not transaction.quantity:
+            return None
+        sale_price = transaction.value / transaction.quantity
+        gain = math.floor((sale_price - ex_avg_price) * transaction.quantity)
+        if gain <= 0:
+            return None
+
+        window = self.sell_credits.setdefault(transaction.user_id, deque())
+        for _, amount in self._expire(window, transaction.date_executed):
+            self.sell_totals[transaction.user_id] -= amount
+        xp_credited_in_24_hrs = self.sell_totals[transaction.user_id]
+        if xp_credited_in_24_hrs >= c.XP_LIMIT.SELL_AT_PROFIT_MAX_DAILY_XP:
+            return None
+
+        xp_amount = int(math.floor(c.XP_CREDIT.COLLECT_PROFIT * (gain / c.XP_LIMIT.SELL_AT_PROFIT_COINS_PER_XP)))
+        xp_amount = min(xp_amount, c.XP_LIMIT.SELL_AT_PROFIT_MAX_DAILY_XP - xp_credited_in_24_hrs)
+        window.append((transaction.date_executed, xp_amount))
+        self.sell_totals[transaction.user_id] += xp_amount
+        return ReplayedCredit(
+            user_id=transaction.user_id,
+            amount=xp_amount,
+            reason=c.XP_REASON.SELL_ASSET_AT_PROFIT,
+            detail=f"TX={transaction.id}",
+            date_credited=transaction.date_executed,
         )
-        return True
-
-    return False
-
-
-def backdate_xp_on_sell_if_eligible(db: Session, transaction_id: int, backfill_date: datetime):
-    transaction = crud.get_portfolio_transaction_by_id(db=db, id=transaction_id)
-    if transaction is None:
-        return False
- 
-    ex_avg_price = transaction.ex_avg_price
-    sale_price = transaction.value / transaction.quantity
-    gain = math.floor((sale_price - ex_avg_price) * transaction.quantity)
-    if gain > 0:
-        user_id = transaction.portfolio.user_id
-        xp_amount = c.XP_CREDIT.COLLECT_PROFIT * gain
-        backdate_xp_by_user_id(
-            db=db,
-            user_id=user_id,
-            backfill_date=transaction.date_executed,
-            xp_amount=xp_amount,
-            xp_reason=c.XP_REASON.SELL_ASSET_AT_PROFIT,
-            xp_detail=f"TX={transaction.id}"
-        )
-
-    return False
 
-
-def get_all_users(db: Session) -> list:
+    def apply(self, transaction):
+        """
+        Replay one executed transaction.
+        Returns the XP credit it earns (or None) and, for sales, the recalculated ex_avg_price
+        """
+        if transaction.transaction_type == models.PortfolioTransactionTypeAppScope.BUY.value:
+            return self._buy(transaction), None
+        if transaction.transaction_type == models.PortfolioTransactionTypeAppScope.SELL.value:
+            ex_avg_price = self.ex_avg_price(transaction)
+            return self._sell(transaction, ex_avg_price), ex_avg_price
+        return ReplayedCredit(
+            user_id=transaction.user_id,
+            amount=c.XP_CREDIT.COLLECT_REWARD,
+            reason=c.XP_REASON.COLLECT_REWARD,
+            detail=f"TX={transaction.id}",
+            date_credited=transaction.date_executed,
+        ), None
+
+
+def copy_xp_transactions(db: Session, credits: List[ReplayedCredit]):
     """
-    Find all users 
+    Write XP transactions with COPY, in the session's transaction
     """
-    return db \
-        .query(models.User) \
-        .order_by(models.User.id) \
-        .all()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for credit in credits:
+        # None is written as an unquoted empty field, which COPY reads as NULL
+        writer.writerow((credit.user_id, credit.amount, credit.reason, credit.detail, credit.date_credited.isoformat()))
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY xp_transactions (user_id, amount, reason, detail, date_credited) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
 
 
-def get_all_users_sorted_by_xp(db: Session) -> list:
+def update_ex_avg_prices(db: Session, ex_avg_prices: dict):
     """
-    Find all users 
+    Write the recalculated ex_avg_price of sales, in the session's transaction
     """
-    return db \
-        .query(models.User) \
-        .order_by(models.User.xp_total.asc()) \
-        .all()
-
-def get_portfolio_holdings(db: Session, portfolio_id: int) -> list:
-    """
-    Find all holdings for a user
-    """
-    return db \
-        .query(models.Holding) \
-        .filter(models.Holding.portfolio_id == portfolio_id) \
-        .order_by(models.Holding.id) \
-        .all()
+    if not ex_avg_prices:
+        return
+    recalculated = values(
+        column('id', Integer),
+        column('ex_avg_price', Float),
+        name='recalculated'
+    ).data(list(ex_avg_prices.items()))
+    db.execute(
+        update(models.PortfolioTransaction)
+            .where(models.PortfolioTransaction.id == recalculated.c.id)
+            # NULL (no shares held) is untyped in VALUES
+            .values(ex_avg_price=cast(recalculated.c.ex_avg_price, Float))
+            .execution_options(synchronize_session=False)
+    )
 
 
-def get_all_executed_transactions(db: Session) -> list:
-    """
-    Find all transactions for a user
-    """
-    return db \
-        .query(models.PortfolioTransaction) \
-        .filter(models.PortfolioTransaction.status == "executed") \
-        .order_by(models.PortfolioTransaction.id) \
-        .all()
+def save_checkpoint(db: Session, shard: int, last_transaction_id: int, n_credits: int):
+    db \
+        .query(models.XPReplayCheckpoint) \
+        .filter(models.XPReplayCheckpoint.shard == shard) \
+        .update({
+            models.XPReplayCheckpoint.last_transaction_id: last_transaction_id,
+            models.XPReplayCheckpoint.n_credits: models.XPReplayCheckpoint.n_credits + n_credits,
+        }, synchronize_session=False)
 
 
-def get_executed_transactions(db: Session, portfolio_id: int) -> list:
+def stream_executed_transactions(db: Session, shard: int, n_shards: int, batch_size: int):
     """
-    Find all transactions for a user
+    Executed transactions in id order, fetched batch_size rows at a time from a server-side cursor
     """
-    return db \
-        .query(models.PortfolioTransaction) \
-        .filter(models.PortfolioTransaction.portfolio_id == portfolio_id) \
-        .filter(models.PortfolioTransaction.status == "executed") \
+    query = select(
+            models.PortfolioTransaction.id,
+            models.PortfolioTransaction.portfolio_id,
+            models.Portfolio.user_id,
+            models.PortfolioTransaction.associated_instrument_id,
+            models.PortfolioTransaction.transaction_type,
+            models.PortfolioTransaction.quantity,
+            models.PortfolioTransaction.value,
+            models.PortfolioTransaction.date_executed,
+        ) \
+        .join(models.Portfolio, models.Portfolio.id == models.PortfolioTransaction.portfolio_id) \
+        .where(
+            models.PortfolioTransaction.status == 'executed',
+            models.PortfolioTransaction.date_executed != None,
+        ) \
         .order_by(models.PortfolioTransaction.id) \
-        .all()
+        .execution_options(yield_per=batch_size)
+    if n_shards > 1:
+        # a user's portfolios are in one shard, so the per-user windows are complete
+        query = query.where(models.Portfolio.user_id % n_shards == shard)
+    return db.execute(query).partitions()
 
 
-def get_portfolios(db: Session) -> list:
-    """
-    Get all portfolios
+def replay_shard(shard: int, n_shards: int, batch_size: int):
     """
-    return db \
-        .query(models.Portfolio) \
-        .all()
-
-
-def process_signup(db: Session, user_id: int):
-    print(f"XP/Signup: user {user_id}")
-    user = crud.get_user_by_id(db=db, id=user_id)
-    backdate_xp_by_user_id(
-        db=db,
-        user_id=user.id,
-        backfill_date=user.date_created,
-        xp_amount=c.XP_CREDIT.SIGNUP,
-        xp_reason=c.XP_REASON.SIGNUP,
-        xp_detail=None
-    )
+    Replay the executed transactions of a shard and write the XP they earn.
 
-
-def process_skills(db: Session, user_id: int):
-    print(f"XP/Skills: user {user_id}")
-    unlocked_skills = db \
-        .query(models.UserSkill) \
-        .filter(
-            models.UserSkill.date_last_unlocked != None,
-            models.UserSkill.user_id == user_id,
-        ) \
-        .all()
-
-    for user_skill in unlocked_skills:
-        print(f"XP/Skills: User={user_id}, Skill={user_skill.skill_id}")
-        backdate_xp_by_user_id(
-            db=db,
-            user_id=user_id,
-            backfill_date=user_skill.date_last_unlocked,
-            xp_amount=c.XP_CREDIT.UNLOCK_SKILL,
-            xp_reason=c.XP_REASON.UNLOCK_SKILL,
-            xp_detail=f"SKL={user_skill.skill_id}"
-        )
-
-
-def process_transaction(db: Session, transaction_id: int):
-    transaction = crud.get_portfolio_transaction_by_id(db=db, id=transaction_id)
-    
-    if transaction.transaction_type == models.PortfolioTransactionTypeAppScope.BUY.value:
-        print(f"XP/Transaction/Buy: Transaction={transaction.id}")
-        backdate_xp_on_buy_if_eligible(
-            db=db,
-            transaction_id=transaction.id,
-            backfill_date=transaction.date_executed
-        )
-    elif transaction.transaction_type == models.PortfolioTransactionTypeAppScope.SELL.value:
-        print(f"XP/Transaction/Sell: Transaction={transaction.id}")
-        backdate_xp_on_sell_if_eligible(
-            db=db,
-            transaction_id=transaction.id,
-            backfill_date=transaction.date_executed
-        )
-    else:
-        print(f"XP/Transaction/Reward: Transaction={transaction.id}")
-        backdate_xp_by_user_id(
-            db=db,
-            user_id=transaction.portfolio.user_id,
-            backfill_date=transaction.date_executed,
-            xp_amount=c.XP_CREDIT.COLLECT_REWARD,
-            xp_reason=c.XP_REASON.COLLECT_REWARD,
-            xp_detail=f"TX={transaction.id}"
-        )
-
-
-def recalc_ex_avg_price_by_portfolio_id(db: Session, portfolio_id: int):
-    print(f"XP/RecalcExAvgPrice: Portfolio={portfolio_id}")
-    holdings = {}
-
-    for transaction in get_executed_transactions(db=db, portfolio_id=portfolio_id):
-
-        if transaction.transaction_type == 'buy':
-            print(f"XP/RecalcExAvgPrice: BUY: Portfolio={portfolio_id}, Transaction={transaction.id}")
-            current_holding = holdings.get(transaction.associated_instrument_id, {"book_value": 0, "shares": 0})
-            holdings[transaction.associated_instrument_id] = {
-                "shares": current_holding["shares"] + transaction.quantity,
-                "book_value": current_holding["book_value"] + transaction.value
-            }
-        elif transaction.transaction_type == 'sell':
-            print(f"XP/RecalcExAvgPrice: SELL: Portfolio={portfolio_id}, Transaction={transaction.id}")
-            current_holding = holdings.get(transaction.associated_instrument_id, {"book_value": 0, "shares": 0})
-            ex_avg_price = (current_holding["book_value"] / current_holding["shares"]) if current_holding["shares"] > 0 else None
-            post_sale_holding = {
-                "shares": current_holding["shares"] - transaction.quantity,
-                "book_value": current_holding["book_value"] - transaction.value
-            }
-            if post_sale_holding["shares"] < 0:
-                post_sale_holding = {"book_value": 0, "shares": 0}
-            holdings[transaction.associated_instrument_id] = {
-                "shares": post_sale_holding["shares"],
-                "book_value": post_sale_holding["book_value"]
-            }
-            transaction.ex_avg_price = ex_avg_price
-            db.merge(transaction)
+    The transaction log is streamed from the start, since the holdings and windows depend on
+    the whole history, but transactions up to the shard's checkpoint only update the in-memory
+    state. Each batch after it is written with its checkpoint in one database transaction,
+    so an interrupted replay resumes after the last committed batch.
+    Returns the number of XP transactions written
+    """
+    stream_db = SessionLocal()
+    db = SessionLocal()
+    try:
+        checkpoint = db.get(models.XPReplayCheckpoint, shard)
+        last_transaction_id, n_written = checkpoint.last_transaction_id, 0
+        db.commit()
+
+        rules = XPRules()
+        for batch in stream_executed_transactions(db=stream_db, shard=shard, n_shards=n_shards, batch_size=batch_size):
+            credits, ex_avg_prices = [], {}
+            for transaction in batch:
+                credit, ex_avg_price = rules.apply(transaction)
+                if transaction.id <= last_transaction_id:
+                    continue
+                if credit is not None and credit.user_id is not None:
+                    credits.append(credit)
+                if transaction.transaction_type == models.PortfolioTransactionTypeAppScope.SELL.value:
+                    ex_avg_prices[transaction.id] = ex_avg_price
+
+            if batch[-1].id <= last_transaction_id:
+                continue
+            if credits:
+                copy_xp_transactions(db=db, credits=credits)
+            update_ex_avg_prices(db=db, ex_avg_prices=ex_avg_prices)
+            save_checkpoint(db=db, shard=shard, last_transaction_id=batch[-1].id, n_credits=len(credits))
             db.commit()
+            n_written += len(credits)
+            print(f"XP/Replay: Shard={shard}, Transaction={batch[-1].id}, Credits={n_written}")
 
+        return n_written
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        stream_db.close()
+        db.close()
 
-def reset_users_xp(db: Session):
+
+def start_replay(db: Session, n_shards: int):
+    """
+    Reset the XP ledger and user XP, credit sign-ups and create the shard checkpoints
+    """
     db \
         .query(models.User) \
         .update({
-            models.User.xp_current_week: 0,
+            models.User.xp_current_week_value: 0,
             models.User.xp_total: 0
-        })
+        }, synchronize_session=False)
+    db.query(models.XPTransaction).delete(synchronize_session=False)
+
+    columns = ['user_id', 'amount', 'reason', 'detail', 'date_credited']
+    db.execute(insert(models.XPTransaction).from_select(columns, select(
+        models.User.id,
+        literal(c.XP_CREDIT.SIGNUP),
+        literal(c.XP_REASON.SIGNUP),
+        null(),
+        models.User.date_created,
+    )))
+
+    db.add_all([
+        models.XPReplayCheckpoint(shard=shard, n_shards=n_shards, last_transaction_id=0, n_credits=0)
+        for shard in range(n_shards)
+    ])
     db.commit()
 
 
-def reset_xp_transactions(db: Session):
-    db.query(models.XPTransaction).delete()
+def finish_replay(db: Session):
+    """
+    Derive the users' total and weekly XP, the daily rollup and the rolling counters from the
+    replayed ledger, and drop the checkpoints, so that the next run starts a new replay
+    """
+    totals = select(
+            models.XPTransaction.user_id,
+            func.sum(models.XPTransaction.amount).label('xp'),
+        ) \
+        .where(models.XPTransaction.user_id != None) \
+        .group_by(models.XPTransaction.user_id) \
+        .subquery('totals')
+    db.execute(
+        update(models.User)
+            .where(models.User.id == totals.c.user_id)
+            .values({models.User.xp_total: totals.c.xp})
+            .execution_options(synchronize_session=False)
+    )
     db.commit()
 
-if __name__ == "__main__":
-    
-    db = SessionLocal()
+    # backdated credits are rolled up by their own day
+    xp_rollup.rebuild_rollup(db=db)
+    recalc_xp(db=db)
+    xp_counters.rebuild_counters(db=db)
 
-    """
-    prep:
-    step 1: reset user's weekly and total xp
-    step 2: clean the XP transactions
-    step 3: recalculate ex_avg_price for sell portfolio_transaction (use audit code)
-    """
+    db.query(models.XPReplayCheckpoint).delete(synchronize_session=False)
+    db.commit()
 
-    print(f"XP/ResetUserXP")
-    reset_users_xp(db=db)
 
-    print(f"XP/ResetTransactions")
-    reset_xp_transactions(db=db)
+def _init_worker():
+    # connections inherited from the parent process must not be used by the workers
+    engine.dispose(close=False)
 
-    print(f"XP/CalculateExAvgPrice")
-    for portfolio in get_portfolios(db=db):
-        recalc_ex_avg_price_by_portfolio_id(db=db, portfolio_id=portfolio.id)
 
+@click.command()
+@click.option('--shards', default=1, help='Number of processes replaying the transaction log, sharded by user id')
+@click.option('--batch-size', default=10000, help='Transactions per batch, committed with a checkpoint')
+@click.option('--restart', is_flag=True, help='Discard the checkpoints of an interrupted replay and start over')
+def backfill_xp(shards: int, batch_size: int, restart: bool):
     """
-    then, for each use
-    step 4: credit XP for sign-ups
-    step 5: credit XP for skills
-    step 6: credit XP for transactions
-      a. buy
-      b. sell at profit
-      c. bonus
+    Rebuild the XP ledger by replaying sign-ups and executed transactions.
+    Resumes an interrupted replay from its checkpoints
     """
-    users = get_all_users(db=db)
-    for user in users:
-        process_signup(db=db, user_id=user.id)
-        process_skills(db=db, user_id=user.id)
-        
-    transactions = get_all_executed_transactions(db=db)
-    for transaction in transactions:
-        process_transaction(db=db, transaction_id=transaction.id)
-
-    print("Completed!")
-    users = get_all_users_sorted_by_xp(db=db)
-    for user in users:
-        if user.xp_total > 0:
-            print(f"User={user.id}, XP_Total={user.xp_total}, XP_Current_Week={user.xp_current_week}")
+    db = SessionLocal()
+    try:
+        if restart:
+            db.query(models.XPReplayCheckpoint).delete(synchronize_session=False)
+            db.commit()
+
+        checkpoints = db.query(models.XPReplayCheckpoint).all()
+        if not checkpoints:
+            print(f"XP/StartReplay: Shards={shards}")
+            start_replay(db=db, n_shards=shards)
+        elif checkpoints[0].n_shards != shards:
+            raise click.ClickException(
+                f'The interrupted replay was started with --shards={checkpoints[0].n_shards}, resume with it or pass --restart'
+            )
+        else:
+            print(f"XP/ResumeReplay: " + ', '.join(f"Shard={checkpoint.shard} at Transaction={checkpoint.last_transaction_id}" for checkpoint in checkpoints))
+        db.close()
+
+        time_start = time.monotonic()
+        if shards == 1:
+            n_written = replay_shard(shard=0, n_shards=1, batch_size=batch_size)
+        else:
+            with ProcessPoolExecutor(max_workers=shards, initializer=_init_worker) as executor:
+                n_written = sum(executor.map(replay_shard, range(shards), [shards] * shards, [batch_size] * shards))
+        print(f"XP/Replay: {n_written} XP transactions written in {time.monotonic() - time_start:.1f}s")
+
+        print(f"XP/FinishReplay")
+        db = SessionLocal()
+        finish_replay(db=db)
+        print("Completed!")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    backfill_xp()
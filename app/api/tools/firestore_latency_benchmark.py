@@ -0,0 +1,87 @@
+import os
+import statistics
+import time
+from datetime import datetime
+
+import click
+
+from app.api.firebase_custom_client import client_instance as fcc
+
+
+def save_message_legacy(user_id, conversation_id, message, sender, feed_collection=None):
+    """
+    The sequential writes of save_message before it was batched: two reads of the conversation,
+    its metadata, the message and the feed copy, one round trip each
+    """
+    current_ts = datetime.now().timestamp()
+    conversations_doc_ref = fcc.db.collection(f'conversations/user_{user_id}/user_conversations').document(conversation_id)
+    if not conversations_doc_ref.get().exists:
+        conversations_doc_ref.set({})
+    conversation_data = conversations_doc_ref.get().to_dict()
+    if 'display_name' not in conversation_data:
+        conversation_data['display_name'] = message
+    conversation_data['last_update'] = current_ts
+    if sender == 'system': conversation_data['unseen'] = True
+    conversations_doc_ref.set(conversation_data, merge=True)
+
+    message_data = {
+        'ts': current_ts,
+        'content': message,
+        'sender': sender,
+        'user': user_id,
+        'conversation_id': conversation_id
+    }
+    fcc.db.document(f'conversations/user_{user_id}/user_conversations/{conversation_id}/messages/{current_ts}').set(message_data)
+    if feed_collection is not None:
+        fcc.db.collection(feed_collection).document(str(current_ts)).set(message_data)
+
+
+def save_message_batched(user_id, conversation_id, message, sender, feed_collection=None):
+    fcc.save_message(message, conversation_id, user_id=user_id, sender=sender, feed_collection=feed_collection)
+
+
+def time_exchanges(save, user_id: int, n_conversations: int, n_exchanges: int):
+    """
+    Milliseconds per exchange (a user message and the AI reply, each copied to the feed)
+    """
+    timings = []
+    for conversation in range(n_conversations):
+        conversation_id = f'benchmark_{save.__name__}_{conversation}'
+        for _ in range(n_exchanges):
+            time_start = time.monotonic()
+            save(user_id, conversation_id, 'How is the market performing today?', user_id, feed_collection='benchmark_feed')
+            save(user_id, conversation_id, 'Bullish, mostly.', 'system', feed_collection='benchmark_feed')
+            timings.append((time.monotonic() - time_start) * 1000)
+    return timings
+
+
+def describe(timings: list):
+    p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+    return f'median {statistics.median(timings):.1f}ms, p95 {p95:.1f}ms'
+
+
+@click.command()
+@click.option('--conversations', default=20, help='Conversations per variant, the first exchange of each one is cold')
+@click.option('--exchanges', default=10, help='Exchanges per conversation')
+@click.option('--user-id', default=999999999, help='User the benchmark conversations are written under')
+def benchmark(conversations: int, exchanges: int, user_id: int):
+    """
+    Compare the latency of the sequential and the batched message writes.
+    Writes benchmark conversations, so it only runs against the Firestore emulator (FIRESTORE_EMULATOR_HOST), e.g.:
+
+    \b
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m app.api.tools.firestore_latency_benchmark
+    """
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        raise click.ClickException('Set FIRESTORE_EMULATOR_HOST, the benchmark only runs against the Firestore emulator')
+
+    for save in [save_message_legacy, save_message_batched]:
+        timings = time_exchanges(save=save, user_id=user_id, n_conversations=conversations, n_exchanges=exchanges)
+        cold = timings[::exchanges]
+        warm = [timing for i, timing in enumerate(timings) if i % exchanges]
+        print(f'{save.__name__}: first exchange {describe(cold)}, next exchanges {describe(warm or cold)}')
+
+
+if __name__ == "__main__":
+    benchmark()
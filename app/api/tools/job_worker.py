@@ -0,0 +1,71 @@
+import os
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.api import jobs
+from app.api.database import SessionLocal
+import app.api.constants as c
+
+is_stopping = False
+
+
+def handle_stop_signal(signum, frame):
+    global is_stopping
+    print(f'job worker: received signal {signum}, finishing running jobs')
+    is_stopping = True
+
+
+def run_job(job: dict):
+    db = SessionLocal()
+    try:
+        jobs.run_job(db=db, job=job)
+    finally:
+        db.close()
+
+
+def claim_jobs(job_type: str, worker_id: str, limit: int):
+    db = SessionLocal()
+    try:
+        return jobs.claim_jobs(db=db, job_type=job_type, worker_id=worker_id, limit=limit)
+    except Exception as e:
+        db.rollback()
+        print(f'job worker: could not claim {job_type} jobs', e)
+        return []
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    """
+    Process the job queue until SIGTERM/SIGINT.
+
+    Each job type has its own slots (its handler concurrency), so a backlog of one job type
+    never starves the others. Every job runs in its own thread with its own session.
+    """
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    running = {job_type: set() for job_type in jobs.JOB_HANDLERS}
+    max_workers = sum(handler['concurrency'] for handler in jobs.JOB_HANDLERS.values())
+    print(f'job worker {worker_id}: start with {max_workers} threads')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while not is_stopping:
+            n_claimed = 0
+            for job_type, handler in jobs.JOB_HANDLERS.items():
+                running[job_type] = {future for future in running[job_type] if not future.done()}
+                n_free_slots = handler['concurrency'] - len(running[job_type])
+                if n_free_slots <= 0:
+                    continue
+
+                for job in claim_jobs(job_type=job_type, worker_id=worker_id, limit=n_free_slots):
+                    running[job_type].add(executor.submit(run_job, job))
+                    n_claimed += 1
+
+            if n_claimed == 0:
+                time.sleep(c.JOB_WORKER_POLL_INTERVAL_SECONDS)
+
+    print(f'job worker {worker_id}: stopped')
@@ -1,30 +1,25 @@
-import logging
-import json
-import datetime
+import time
 
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-
-from app.api import crud
-from app.api.database import engine, SessionLocal
-from app.models import models
-import app.api.constants as c
-
-
-def get_all_users(db: Session) -> list:
-    """
-    Find all users 
-    """
-    return db.query(models.User).all()
+from app.api import portfolio_stats
+from app.api.database import SessionLocal
 
 
 if __name__ == "__main__":
     
     db = SessionLocal()
 
-
-    # Find eligible users and credit their portfolios
-    users = get_all_users(db=db)
-    for user in users:
-        for portfolio in user.portfolios:
-            crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio.id, refresh_timeout=0)
+    # Recompute the stats of all portfolios in one statement
+    time_start = time.monotonic()
+    n_refreshed = portfolio_stats.refresh_all_portfolio_stats(db=db)
+    print(f'refreshed {n_refreshed} portfolios in {time.monotonic() - time_start:.2f}s')
+
+    # Append the refreshed values to the hourly/daily history
+    time_start = time.monotonic()
+    n_written = portfolio_stats.record_value_history(db=db)
+    print(f'recorded {n_written} history rows in {time.monotonic() - time_start:.2f}s')
+
+    # Rank the refreshed portfolios by gain
+    time_start = time.monotonic()
+    n_ranked = portfolio_stats.refresh_gain_leaderboard(db=db)
+    print(f'ranked {n_ranked} portfolios in {time.monotonic() - time_start:.2f}s')
+    db.close()
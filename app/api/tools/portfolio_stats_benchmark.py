@@ -0,0 +1,68 @@
+import time
+
+import click
+from sqlalchemy import text
+
+from app.api import crud, portfolio_stats
+from app.api.database import SessionLocal, ENVIRONMENT
+from app.api.tools.query_plans import seed
+
+
+def time_per_portfolio_refresh(n_sample: int):
+    """
+    Time the per-portfolio refresh on a sample and extrapolate to all portfolios
+    """
+    db = SessionLocal()
+    portfolio_ids = [portfolio_id for (portfolio_id, ) in db.execute(text("SELECT id FROM portfolios ORDER BY random() LIMIT :n"), {'n': n_sample})]
+    time_start = time.monotonic()
+    for portfolio_id in portfolio_ids:
+        crud.refresh_portfolio_stats(db=db, portfolio_id=portfolio_id, refresh_timeout=0)
+    elapsed = time.monotonic() - time_start
+    db.close()
+    return elapsed / max(len(portfolio_ids), 1)
+
+
+def time_bulk_refresh(n_runs: int):
+    db = SessionLocal()
+    timings = []
+    for _ in range(n_runs):
+        time_start = time.monotonic()
+        portfolio_stats.refresh_all_portfolio_stats(db=db)
+        timings.append(time.monotonic() - time_start)
+    db.close()
+    return min(timings)
+
+
+@click.command()
+@click.option('--sizes', default='10000,100000', help='Comma separated numbers of portfolios to benchmark at')
+@click.option('--sample', default=500, help='Portfolios refreshed one by one to estimate the legacy loop')
+@click.option('--runs', default=3, help='Bulk refresh runs per size, the fastest is reported')
+def benchmark(sizes: str, sample: int, runs: int):
+    """
+    Compare the per-portfolio refresh loop with the bulk refresh.
+    Seeds users with one portfolio each into the configured (empty, non-production) database
+    """
+    if ENVIRONMENT == 'prod':
+        raise click.ClickException('Refusing to seed a production database')
+
+    for size in sorted(int(size) for size in sizes.split(',')):
+        db = SessionLocal()
+        n_portfolios = db.execute(text("SELECT COUNT(*) FROM portfolios")).scalar()
+        if n_portfolios < size:
+            print(f'seeding {size - n_portfolios} portfolios')
+            seed(db=db, n_users=size - n_portfolios)
+        db.execute(text('ANALYZE'))
+        db.commit()
+        db.close()
+
+        seconds_per_portfolio = time_per_portfolio_refresh(n_sample=sample)
+        bulk_seconds = time_bulk_refresh(n_runs=runs)
+        loop_seconds = seconds_per_portfolio * size
+        print(
+            f'{size} portfolios: per-portfolio loop ~{loop_seconds:.1f}s ({seconds_per_portfolio * 1000:.1f}ms each), '
+            f'bulk {bulk_seconds:.2f}s, {loop_seconds / bulk_seconds:.0f}x faster'
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
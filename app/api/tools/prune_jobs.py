@@ -0,0 +1,18 @@
+from app.api import jobs
+from app.api.database import SessionLocal
+
+
+if __name__ == "__main__":
+    """
+    Delete done and failed jobs older than JOB_RETENTION_DAYS, so the job queue does not grow forever
+    """
+    db = SessionLocal()
+    try:
+        n_deleted = jobs.prune_jobs(db=db)
+        print(f'{n_deleted} jobs pruned')
+    except Exception as e:
+        db.rollback()
+        print('job pruning failed', e)
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,271 @@
+import json
+import os
+import sys
+
+import click
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from app.api import crud, xp_counters, xp_rollup, portfolio_stats
+from app.api.database import engine, SessionLocal, ENVIRONMENT
+from app.api.notifications.campaigns import remind_invest_again
+from app.api.notifications.utils import push
+from app.api.tools import send_push, split_adjustment
+from app.models import models
+
+BASELINE_FILE = 'app/api/data/query_plans_baseline.json'
+
+# tables that grow with the number of users and must never be read with a sequential scan
+LARGE_TABLES = {
+    'users',
+    'accounts',
+    'portfolios',
+    'portfolio_stats',
+    'portfolio_gain_leaderboard',
+    'holdings',
+    'portfolio_transactions',
+    'portfolio_orders',
+    'xp_transactions',
+    'xp_counter_buckets',
+    'user_xp_daily',
+    'user_push_tokens',
+    'push_receipts',
+    'jobs',
+}
+
+# campaign and broadcast queries that read a whole table by design (they target every eligible user)
+FULL_SCAN_ALLOWED = {
+    'campaigns.remind_invest_again.get_user_tokens_with_old_holdings': {'holdings', 'portfolios', 'user_push_tokens', 'users'},
+    'notifications.push.get_push_tokens_by_weekly_bonus': {'portfolios', 'user_push_tokens'},
+    'notifications.push.get_recent_push_tokens': {'users', 'user_push_tokens'},
+    'tools.send_push.get_all_shareholders_tokens': {'holdings', 'portfolios'},
+}
+
+
+def seed(db: Session, n_users: int):
+    """
+    Add n_users to the database with a dataset shaped like production:
+    every user has a portfolio, a push token and an account, ~20 holdings,
+    ~100 transactions and ~50 XP credits spread over the last 90 days.
+    Instruments are created on the first call, so the function can be called again to grow the dataset
+    """
+    n_instruments = 2000
+    first_user_id = db.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM users")).scalar()
+    if db.execute(text("SELECT COUNT(*) FROM instruments")).scalar() == 0:
+        db.execute(text("INSERT INTO characters (id, category) VALUES (1, 'default') ON CONFLICT DO NOTHING"))
+        db.execute(text(f"""INSERT INTO instruments (type, name, symbol, status, is_well_known)
+            SELECT 'crypto', 'Token ' || i, 'TK' || i, CASE WHEN i % 50 = 0 THEN 'inactive' ELSE 'active' END, (i % 20 = 0)::int
+            FROM generate_series(1, {n_instruments}) i"""))
+        db.execute(text("""INSERT INTO instrument_kpi_latest_prices (instrument_id, price, change_perc_1d, change_abs_1d)
+            SELECT id, 1 + random() * 100, random() * 20 - 10, random() * 2 - 1 FROM instruments"""))
+
+    statements = [
+        f"""INSERT INTO users (xp_total, xp_current_week, xp_current_season, date_last_active)
+            SELECT (random() * 100000)::int, (random() * 5000)::int, (random() * 30000)::int, now() - random() * interval '60 days'
+            FROM generate_series(1, {n_users})""",
+        """INSERT INTO accounts (provider, user_id, ext_user_id)
+            SELECT 'apple', id, md5(id::text) FROM users WHERE id >= :first_user_id""",
+        """INSERT INTO user_push_tokens (provider, token, user_id, status, date_last_validated)
+            SELECT 'expo', 'ExponentPushToken[' || md5(id::text) || ']', id, 'active', now() FROM users WHERE id >= :first_user_id""",
+        """INSERT INTO portfolios (user_id, character_id, name, cash_balance, status, is_public, date_last_updated, date_last_claimed_weekly_reward)
+            SELECT id, 1, 'Player ' || id, 10000, 'active', (id % 10 <> 0)::int, now() - random() * interval '20 days', now() - random() * interval '14 days'
+            FROM users WHERE id >= :first_user_id""",
+        """INSERT INTO portfolio_stats (portfolio_id, total_net_worth, total_book_value, total_sales_value, total_gain)
+            SELECT id, 10000 + random() * 1000, random() * 5000, random() * 5000, random() * 2000 - 1000 FROM portfolios WHERE user_id >= :first_user_id""",
+        f"""INSERT INTO holdings (portfolio_id, instrument_id, quantity, average_price, date_last_updated)
+            SELECT p.id, 1 + (p.id * 31 + i * 97) % {n_instruments}, (random() * 10)::int, 1 + random() * 100, now() - random() * interval '60 days'
+            FROM portfolios p, generate_series(1, 20) i WHERE p.user_id >= :first_user_id""",
+        f"""INSERT INTO portfolio_transactions (portfolio_id, associated_instrument_id, quantity, value, ex_avg_price, transaction_type, status, message, date_executed)
+            SELECT p.id, 1 + (p.id * 31 + i * 97) % {n_instruments}, 1, random() * 100, random() * 100,
+                CASE WHEN i % 3 = 0 THEN 'sell' ELSE 'buy' END,
+                CASE WHEN i % 25 = 0 THEN 'pending' ELSE 'executed' END,
+                CASE WHEN i % 4 = 0 THEN 'to the moon' END,
+                now() - random() * interval '90 days'
+            FROM portfolios p, generate_series(1, 100) i WHERE p.user_id >= :first_user_id""",
+        """INSERT INTO xp_transactions (user_id, amount, reason, detail, date_credited)
+            SELECT u.id, 100, (ARRAY['BUY_ASSET', 'SELL_ASSET_AT_PROFIT', 'COLLECT_REWARD', 'FEED_MESSAGE'])[1 + i % 4], 'TX=' || i, now() - random() * interval '90 days'
+            FROM users u, generate_series(1, 50) i WHERE u.id >= :first_user_id""",
+    ]
+    for statement in statements:
+        db.execute(text(statement), {'first_user_id': first_user_id})
+    db.commit()
+    xp_counters.rebuild_counters(db=db)
+    xp_rollup.rebuild_rollup(db=db)
+    portfolio_stats.refresh_gain_leaderboard(db=db)
+
+
+def get_sample(db: Session):
+    """
+    Pick the ids used as query arguments: the busiest portfolio and its user and instrument
+    """
+    portfolio_id = db.execute(text("""
+        SELECT portfolio_id FROM portfolio_transactions
+        GROUP BY portfolio_id ORDER BY count(*) DESC LIMIT 1
+    """)).scalar()
+    portfolio = crud.get_portfolio_by_id(db=db, id=portfolio_id)
+    holding = db.query(models.Holding).filter(models.Holding.portfolio_id == portfolio_id).first()
+    transaction = db.query(models.PortfolioTransaction).filter(models.PortfolioTransaction.portfolio_id == portfolio_id).first()
+    account = db.query(models.Account).filter(models.Account.user_id == portfolio.user_id).first()
+    return {
+        'user_id': portfolio.user_id,
+        'portfolio_id': portfolio_id,
+        'instrument_id': holding.instrument_id,
+        'transaction_id': transaction.id,
+        'ext_user_id': account.ext_user_id,
+        'provider': account.provider,
+    }
+
+
+def get_scenarios(s: dict):
+    """
+    Read paths of the API, the notification campaigns and the tools.
+    Some of them write (e.g. refresh_portfolio_stats), see capture_statements
+    """
+    return {
+        'crud.get_instruments': lambda db: crud.get_instruments(db=db, q='tk1', sort='price_change_perc_desc', show_well_known_only=0, skip=0, limit=20),
+        'crud.get_instrument_bars': lambda db: crud.get_instrument_bars(db=db, instrument_id=s['instrument_id'], lookback_hours=24, bar_interval='1H'),
+        'crud.get_user_by_ext_user_id': lambda db: crud.get_user_by_ext_user_id(db=db, ext_user_id=s['ext_user_id'], provider=s['provider']),
+        'crud.get_account_by_user_id': lambda db: crud.get_account_by_user_id(db=db, user_id=s['user_id'], provider=s['provider']),
+        'crud.get_portfolios_by_user_id': lambda db: crud.get_portfolios_by_user_id(db=db, q=None, target_user_id=s['user_id'], requester_user_id=0, skip=0, limit=20),
+        'crud.count_user_portfolios': lambda db: crud.count_user_portfolios(db=db, user_id=s['user_id']),
+        'crud.get_portfolios_leaderboard': lambda db: crud.get_portfolios_leaderboard(db=db, q=None, skip=0, limit=20),
+        'crud.get_portfolios_leaderboard.page_100': lambda db: crud.get_portfolios_leaderboard(db=db, q=None, skip=2000, limit=20),
+        'crud.get_gain_leaderboard_entry_by_portfolio_id': lambda db: crud.get_gain_leaderboard_entry_by_portfolio_id(db=db, portfolio_id=s['portfolio_id']),
+        'crud.count_gain_leaderboard_entries': lambda db: crud.count_gain_leaderboard_entries(db=db),
+        'crud.get_xp_leaderboard.weekly': lambda db: crud.get_xp_leaderboard(db=db, q=None, skip=0, limit=20, timeframe='weekly'),
+        'crud.get_xp_leaderboard.season': lambda db: crud.get_xp_leaderboard(db=db, q=None, skip=0, limit=20, timeframe='season'),
+        'crud.get_holdings_by_portfolio_id': lambda db: crud.get_holdings_by_portfolio_id(db=db, portfolio_id=s['portfolio_id'], skip=0, limit=20, sort_by='date_last_updated', sort_order='desc', ignore_sold_off=True),
+        'crud.get_holding_by_id': lambda db: crud.get_holding_by_id(db=db, portfolio_id=s['portfolio_id'], instrument_id=s['instrument_id']),
+        'crud.get_transactions_by_portfolio_id': lambda db: crud.get_transactions_by_portfolio_id(db=db, portfolio_id=s['portfolio_id'], skip=0, limit=20),
+        'crud.get_transactions': lambda db: crud.get_transactions(db=db, filter='EXECUTED_TRADES', sort='DESC', skip=0, limit=20),
+        'crud.get_orders_by_portfolio_id': lambda db: crud.get_orders_by_portfolio_id(db=db, portfolio_id=s['portfolio_id'], status='open', skip=0, limit=20),
+        'crud.refresh_portfolio_stats': lambda db: crud.refresh_portfolio_stats(db=db, portfolio_id=s['portfolio_id'], refresh_timeout=0),
+        'crud.credit_xp_on_buy_if_eligible': lambda db: crud.credit_xp_on_buy_if_eligible(db=db, transaction_id=s['transaction_id']),
+        'crud.credit_xp_on_sell_if_eligible': lambda db: crud.credit_xp_on_sell_if_eligible(db=db, transaction_id=s['transaction_id']),
+        'crud.credit_xp_on_transaction_execute_if_eligible': lambda db: crud.credit_xp_on_transaction_execute_if_eligible(db=db, transaction_id=s['transaction_id']),
+        'campaigns.remind_invest_again.get_user_tokens_with_old_holdings': lambda db: remind_invest_again.get_user_tokens_with_old_holdings(db=db),
+        'campaigns.remind_invest_again.get_relevant_old_holding_by_user_id': lambda db: remind_invest_again.get_relevant_old_holding_by_user_id(db=db, user_id=s['user_id']),
+        'notifications.push.get_push_tokens_by_weekly_bonus': lambda db: push.get_push_tokens_by_weekly_bonus(db=db),
+        'notifications.push.get_recent_push_tokens': lambda db: push.get_recent_push_tokens(db=db),
+        'notifications.push.get_recent_push_receipts': lambda db: push.get_recent_push_receipts(db=db),
+        'tools.send_push.get_all_shareholders_tokens': lambda db: send_push.get_all_shareholders_tokens(db=db, instrument_id=s['instrument_id']),
+        'tools.split_adjustment.find_eligible_holdings': lambda db: split_adjustment.find_eligible_holdings(db=db, instrument_id=s['instrument_id']),
+    }
+
+
+def capture_statements(scenario):
+    """
+    Run a scenario and return the SELECT statements it sent to the database.
+    The session commits into savepoints of an outer transaction that is rolled back,
+    so nothing the scenario writes is kept
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    connection = engine.connect()
+    outer_transaction = connection.begin()
+    db = Session(bind=connection, join_transaction_mode='create_savepoint')
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        scenario(db)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        db.close()
+        outer_transaction.rollback()
+        connection.close()
+    return statements
+
+
+def explain(statement: str, parameters):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0][0]['Plan']
+        connection.rollback()
+        return plan
+    finally:
+        connection.close()
+
+
+def iter_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from iter_nodes(child)
+
+
+def get_table_sizes(db: Session):
+    return {
+        relname: reltuples
+        for relname, reltuples in db.execute(text("""
+            SELECT relname, reltuples FROM pg_class
+            WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace
+        """))
+    }
+
+
+@click.command()
+@click.option('--seed-users', default=0, help='Seed an empty database with this many users before checking (never on prod)')
+@click.option('--min-rows', default=10000, help='Tables with fewer estimated rows are not considered large')
+@click.option('--cost-tolerance', default=0.5, help='Allowed relative cost increase over the baseline')
+@click.option('--update-baseline', is_flag=True, help=f'Write the current plan costs to {BASELINE_FILE}')
+def check_query_plans(seed_users: int, min_rows: int, cost_tolerance: float, update_baseline: bool):
+    """
+    EXPLAIN every query built by crud, the notification campaigns and the tools, and fail if
+    a query plans a sequential scan of a large table or its cost regressed against the baseline
+    """
+    db = SessionLocal()
+    if seed_users:
+        if ENVIRONMENT == 'prod':
+            raise click.ClickException('Refusing to seed a production database')
+        seed(db=db, n_users=seed_users)
+        db.execute(text('ANALYZE'))
+        db.commit()
+
+    table_sizes = get_table_sizes(db=db)
+    sample = get_sample(db=db)
+    db.close()
+
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    costs = {}
+    failures = []
+    for scenario_name, scenario in get_scenarios(sample).items():
+        for i, (statement, parameters) in enumerate(capture_statements(scenario)):
+            query_name = f'{scenario_name}#{i}'
+            plan = explain(statement, parameters)
+            costs[query_name] = plan['Total Cost']
+
+            for node in iter_nodes(plan):
+                relation = node.get('Relation Name')
+                if node['Node Type'] == 'Seq Scan' and relation in LARGE_TABLES and table_sizes.get(relation, 0) >= min_rows \
+                        and relation not in FULL_SCAN_ALLOWED.get(scenario_name, set()):
+                    failures.append(f'{query_name}: sequential scan on {relation} ({int(table_sizes[relation])} rows)')
+
+            baseline_cost = baseline.get(query_name)
+            if baseline_cost is not None and plan['Total Cost'] > baseline_cost * (1 + cost_tolerance):
+                failures.append(f"{query_name}: cost {plan['Total Cost']:.0f} regressed from {baseline_cost:.0f}")
+
+            print(f"{query_name}: cost {plan['Total Cost']:.0f}")
+
+    if update_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(costs, f, indent=4, sort_keys=True)
+        print(f'baseline written to {BASELINE_FILE}')
+
+    if failures:
+        print(f'\n{len(failures)} query plan check(s) failed:')
+        for failure in failures:
+            print(f'- {failure}')
+        sys.exit(1)
+    print(f'\n{len(costs)} queries checked, all plans OK')
+
+
+if __name__ == "__main__":
+    check_query_plans()
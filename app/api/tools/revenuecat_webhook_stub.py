@@ -0,0 +1,70 @@
+import os
+import time
+import uuid
+
+import click
+import requests
+
+import app.api.constants as c
+from app.api.entitlements import get_revcat_user_id
+
+EVENT_TYPES = [
+    'INITIAL_PURCHASE', 'RENEWAL', 'CANCELLATION', 'UNCANCELLATION', 'NON_RENEWING_PURCHASE',
+    'BILLING_ISSUE', 'PRODUCT_CHANGE', 'EXPIRATION', 'TRANSFER', 'TEST',
+]
+
+
+def build_event(event_type: str, revcat_user_id: str, expires_in_hours: float, grace_period_hours: float):
+    """
+    Webhook payload shaped like RevenueCat's, for the events the entitlement cache reads
+    """
+    now_ms = int(time.time() * 1000)
+    event = {
+        'id': str(uuid.uuid4()).upper(),
+        'type': event_type,
+        'event_timestamp_ms': now_ms,
+        'app_user_id': revcat_user_id,
+        'original_app_user_id': revcat_user_id,
+        'aliases': [revcat_user_id],
+        'entitlement_ids': [c.PREMIUM_ENTITLEMENT_ID],
+        'product_id': 'premium_monthly',
+        'period_type': 'NORMAL',
+        'store': 'APP_STORE',
+        'environment': 'SANDBOX',
+        'purchased_at_ms': now_ms,
+        'expiration_at_ms': now_ms + int(expires_in_hours * 3600 * 1000) if event_type != 'NON_RENEWING_PURCHASE' else None,
+    }
+    if event_type == 'BILLING_ISSUE':
+        event['grace_period_expiration_at_ms'] = event['expiration_at_ms'] + int(grace_period_hours * 3600 * 1000)
+    if event_type == 'TRANSFER':
+        event['transferred_from'] = [revcat_user_id]
+        event['transferred_to'] = [f'$RCAnonymousID:{uuid.uuid4().hex}']
+    if event_type == 'TEST':
+        event['entitlement_ids'] = None
+    return {'api_version': '1.0', 'event': event}
+
+
+@click.command()
+@click.option('--url', default='http://localhost:8000/webhooks/revenuecat', help='Webhook endpoint of a local API')
+@click.option('--auth', default=lambda: os.getenv('APP_REVCAT_WEBHOOK_AUTH', ''), help='Authorization header, APP_REVCAT_WEBHOOK_AUTH by default')
+@click.option('--user-id', type=int, required=True)
+@click.option('--secret-id', required=True)
+@click.option('--type', 'event_type', type=click.Choice(EVENT_TYPES), default='INITIAL_PURCHASE')
+@click.option('--expires-in-hours', default=24 * 30.0, help='Expiration of the entitlement, negative for the past')
+@click.option('--grace-period-hours', default=24 * 16.0, help='Grace period of BILLING_ISSUE events')
+def send_event(url: str, auth: str, user_id: int, secret_id: str, event_type: str, expires_in_hours: float, grace_period_hours: float):
+    """
+    Stand in for RevenueCat: post a webhook event for a user to a local API
+    """
+    payload = build_event(
+        event_type=event_type,
+        revcat_user_id=get_revcat_user_id(user_id, secret_id),
+        expires_in_hours=expires_in_hours,
+        grace_period_hours=grace_period_hours,
+    )
+    response = requests.post(url, json=payload, headers={'Authorization': auth}, timeout=c.REVCAT_TIMEOUT_SECONDS)
+    print(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    send_event()
@@ -1,45 +1,157 @@
 import os
-import logging
-import json
-import datetime
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy.exc import IntegrityError
+import click
+import httpx
+from sqlalchemy import and_, case, or_
 from sqlalchemy.orm import Session
 
-from app.api import crud
+from app.api import entitlements
 from app.api.database import engine, SessionLocal
 from app.models import models
-from app.api.tools.premium import validate_premium
 import app.api.constants as c
 
 
-def get_all_users(db: Session) -> list:
+def get_sync_candidates(db: Session, limit: int) -> list:
     """
-    Find all users 
+    Users whose premium status should be synced, most urgent first: premium users whose entitlement
+    expires soon, then recently active users, then the others. Within each group the users validated
+    the longest ago (or never) come first, so that successive runs rotate through the backlog.
+    Free users inactive for PREMIUM_SYNC_LAPSED_FREE_DAYS are skipped, a purchase would make them active again
     """
+    date_now = datetime.now(tz=timezone.utc)
+    priority = case(
+        (
+            and_(
+                models.User.is_premium == 1,
+                models.User.premium_expires_date <= date_now + timedelta(hours=c.PREMIUM_SYNC_EXPIRY_HORIZON_HOURS),
+            ),
+            0
+        ),
+        (models.User.date_last_active >= date_now - timedelta(days=c.PREMIUM_SYNC_ACTIVE_DAYS), 1),
+        else_=2
+    )
     return db \
-        .query(models.User) \
-        .order_by(models.User.id.asc()) \
+        .query(models.User.id, models.User.secret_id, models.User.is_premium) \
+        .filter(
+            or_(
+                models.User.is_premium == 1,
+                models.User.date_last_active >= date_now - timedelta(days=c.PREMIUM_SYNC_LAPSED_FREE_DAYS),
+            )
+        ) \
+        .order_by(priority, models.User.premium_date_validated.asc().nulls_first(), models.User.date_last_active.desc()) \
+        .limit(limit) \
         .all()
 
 
-if __name__ == "__main__":
-    
-    db = SessionLocal()
-    REVCAT_PUBLIC_API_KEY = os.getenv("REVCAT_PUBLIC_API_KEY", "nokey")
-
-    # Find eligible users and credit their portfolios
-    users = get_all_users(db=db)
-    for user in users:
-        is_premium = validate_premium(
-            user_id=user.id,
-            secret_id=user.secret_id,
-            revcat_public_api_key=REVCAT_PUBLIC_API_KEY,
-            should_update_user=False
+class RateLimiter:
+    """
+    Spaces out the start of requests to stay within a number of requests per minute
+    """
+
+    def __init__(self, requests_per_minute: int):
+        self.interval = 60 / requests_per_minute
+        self._next_start = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(self._next_start, now) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def back_off(self, seconds: float):
+        # RevenueCat asked to slow down: no request starts before the delay is over
+        self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+async def fetch_entitlement(client: httpx.AsyncClient, limiter: RateLimiter, semaphore: asyncio.Semaphore,
+                            user_id: int, secret_id: str, revcat_public_api_key: str, n_attempts: int = 2):
+    """
+    (user id, premium entitlement) from the RevenueCat API, the entitlement is None if it could not be fetched
+    """
+    url = f"{entitlements.REVCAT_SUBSCRIBERS_URL}/{entitlements.get_revcat_user_id(user_id, secret_id)}"
+    async with semaphore:
+        for attempt in range(n_attempts):
+            await limiter.wait()
+            try:
+                response = await client.get(url, headers=entitlements.get_revcat_headers(revcat_public_api_key))
+                if response.status_code == 429 and attempt + 1 < n_attempts:
+                    limiter.back_off(float(response.headers.get('Retry-After', 1)))
+                    continue
+                response.raise_for_status()
+                return user_id, entitlements.parse_subscriber(response.json())
+            except (httpx.HTTPError, ValueError, KeyError, AttributeError) as e:
+                print(f'premium sync: could not fetch user {user_id}: {e}')
+                return user_id, None
+    return user_id, None
+
+
+async def fetch_entitlements(candidates: list, revcat_public_api_key: str, concurrency: int, requests_per_minute: int):
+    limiter = RateLimiter(requests_per_minute=requests_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(
+        timeout=c.REVCAT_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+    ) as client:
+        return await asyncio.gather(*(
+            fetch_entitlement(
+                client=client, limiter=limiter, semaphore=semaphore,
+                user_id=user_id, secret_id=secret_id, revcat_public_api_key=revcat_public_api_key
             )
-        if user.is_premium != is_premium:
-            user.is_premium = int(is_premium)
-            print(user.id, is_premium)
-            db.merge(user)
-            db.commit()
+            for user_id, secret_id, _ in candidates
+        ))
+
+
+@click.command()
+@click.option('--concurrency', default=c.PREMIUM_SYNC_CONCURRENCY, help='RevenueCat requests in flight')
+@click.option('--requests-per-minute', default=c.PREMIUM_SYNC_REQUESTS_PER_MINUTE, help='Rate limit budget')
+@click.option('--max-minutes', default=120, help='Users beyond what the rate limit allows in this time are left to the next run')
+def sync_premium_status(concurrency: int, requests_per_minute: int, max_minutes: int):
+    """
+    Refresh the premium entitlement cache from RevenueCat, e.g. to backfill it or after missed webhook deliveries
+    """
+    revcat_public_api_key = os.getenv("REVCAT_PUBLIC_API_KEY", "nokey")
+    db = SessionLocal()
+    try:
+        time_start = time.monotonic()
+        # webhook events received during the sync are more recent and win over its results
+        date_validated = datetime.now(tz=timezone.utc)
+        candidates = get_sync_candidates(db=db, limit=requests_per_minute * max_minutes)
+        db.commit()
 
+        results = asyncio.run(fetch_entitlements(
+            candidates=candidates,
+            revcat_public_api_key=revcat_public_api_key,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute,
+        ))
+        fetch_seconds = time.monotonic() - time_start
+
+        was_premium = {user_id: bool(is_premium) for user_id, _, is_premium in candidates}
+        fetched = [(user_id, entitlement) for user_id, entitlement in results if entitlement is not None]
+        n_upgraded = sum(1 for user_id, entitlement in fetched if entitlement.is_premium and not was_premium[user_id])
+        n_downgraded = sum(1 for user_id, entitlement in fetched if not entitlement.is_premium and was_premium[user_id])
+
+        n_updated = entitlements.save_entitlements(db=db, entitlements=fetched, date_validated=date_validated)
+        db.commit()
+
+        duration = time.monotonic() - time_start
+        print(
+            f'premium sync: {len(candidates)} users, {len(fetched)} fetched, {len(candidates) - len(fetched)} failed, '
+            f'{n_upgraded} upgraded, {n_downgraded} downgraded, {n_updated} updated in {duration:.1f}s '
+            f'({len(candidates) / max(fetch_seconds, 1e-6):.1f} requests/s)'
+        )
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sync_premium_status()
@@ -0,0 +1,19 @@
+from app.api import xp_counters
+from app.api.database import SessionLocal
+
+
+if __name__ == "__main__":
+    """
+    Rebuild the rolling XP counters from portfolio_transactions and xp_transactions.
+    Fixes any drift (e.g. manual ledger edits) and drops expired buckets
+    """
+    db = SessionLocal()
+    try:
+        xp_counters.rebuild_counters(db=db)
+        print('xp counters rebuilt')
+    except Exception as e:
+        db.rollback()
+        print('xp counters rebuild failed', e)
+        raise
+    finally:
+        db.close()
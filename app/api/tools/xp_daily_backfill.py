@@ -0,0 +1,30 @@
+import time
+from datetime import date
+
+import click
+
+from app.api import xp_rollup
+from app.api.database import SessionLocal
+
+
+@click.command()
+@click.option('--date-from', default=None, help='Only rebuild from this UTC day on (YYYY-MM-DD), all history by default')
+def backfill_xp_daily(date_from: str):
+    """
+    Rebuild the user_xp_daily rollup from xp_transactions
+    """
+    db = SessionLocal()
+    try:
+        time_start = time.monotonic()
+        n_rows = xp_rollup.rebuild_rollup(db=db, date_from=date.fromisoformat(date_from) if date_from else None)
+        print(f'wrote {n_rows} daily rows in {time.monotonic() - time_start:.2f}s')
+    except Exception as e:
+        db.rollback()
+        print('xp daily rollup rebuild failed', e)
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    backfill_xp_daily()
@@ -1,10 +1,11 @@
 from datetime import datetime, timedelta, timezone
 
+import click
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, literal_column, select, union_all, update
 
-from app.api import crud
+from app.api import crud, xp_rollup, xp_epochs
 from app.api.database import engine, SessionLocal
 from app.models import models
 import app.api.constants as c
@@ -22,66 +23,166 @@ def get_weekly_reset_cutover() -> datetime:
 
 
 def soft_reset_weekly_xp(db: Session):
-    # set all weekly xp to 0 by default
+    # set the weekly xp of the current epoch to 0, users of previous epochs already read as 0
     db \
         .query(models.User) \
+        .filter(xp_epochs.get_current_epoch_filter(xp_epochs.WEEKLY)) \
         .update({
-            models.User.xp_current_week: 0
-        })
+            models.User.xp_current_week_value: 0
+        }, synchronize_session=False)
     
     # refresh virtual before committing
     db.flush()
 
 
 def get_weekly_xp_per_user(db: Session, date_reset_cutover: datetime):
-    return db \
-        .query(
-            models.XPTransaction.user_id,
-            func.sum(models.XPTransaction.amount)
+    # the cutover is a UTC midnight, so the week is a range of whole days of the rollup
+    return xp_rollup.get_xp_per_user(db=db, date_from=date_reset_cutover.date())
+
+
+def set_user_weekly_xp(db: Session, user_id: int, new_xp_current_week: int):
+    db \
+        .query(models.User) \
+        .filter(models.User.id == user_id) \
+        .update({
+            models.User.xp_current_week_value: new_xp_current_week,
+            models.User.xp_week_epoch: models.current_xp_epoch(xp_epochs.WEEKLY),
+        }, synchronize_session=False)
+
+
+def get_weekly_xp_targets(date_reset_cutover: datetime):
+    """
+    Weekly XP every user should have: the XP credited since the cutover, or 0 for users
+    with XP in the current week epoch but no credit since the cutover
+    """
+    credited = select(
+            models.UserXPDaily.user_id,
+            func.sum(models.UserXPDaily.amount).label('xp'),
         ) \
-        .filter(
-            models.XPTransaction.date_credited >= date_reset_cutover
+        .where(models.UserXPDaily.day >= date_reset_cutover.date()) \
+        .group_by(models.UserXPDaily.user_id)
+    current = select(
+            models.User.id,
+            literal_column('0'),
         ) \
-        .group_by(
-            models.XPTransaction.user_id
+        .where(xp_epochs.get_current_epoch_filter(xp_epochs.WEEKLY))
+    candidates = union_all(credited, current).subquery('candidates')
+
+    return select(
+            candidates.c.user_id,
+            func.sum(candidates.c.xp).label('xp'),
         ) \
+        .group_by(candidates.c.user_id) \
+        .subquery('targets')
+
+
+def get_weekly_xp_diff(db: Session, date_reset_cutover: datetime, limit: int = 20):
+    """
+    Users whose weekly XP differs from the recalculated one: (number of users, sum of differences,
+    [(user_id, current XP, recalculated XP)] of the largest differences)
+    """
+    targets = get_weekly_xp_targets(date_reset_cutover=date_reset_cutover)
+    difference = targets.c.xp - models.User.xp_current_week
+    diff = db \
+        .query(models.User.id, models.User.xp_current_week, targets.c.xp, difference.label('difference')) \
+        .join(targets, targets.c.user_id == models.User.id) \
+        .filter(models.User.xp_current_week != targets.c.xp) \
+        .subquery('diff')
+
+    n_users, xp_difference = db.query(func.count(), func.coalesce(func.sum(diff.c.difference), 0)).select_from(diff).one()
+    # the targets are sums of sums, which Postgres returns as numeric
+    xp_difference = int(xp_difference)
+    largest = db \
+        .query(diff.c.id, diff.c.xp_current_week, diff.c.xp) \
+        .order_by(func.abs(diff.c.difference).desc(), diff.c.id) \
+        .limit(limit) \
         .all()
+    return n_users, xp_difference, largest
 
 
-def set_user_weekly_xp(db: Session, user_id: int, new_xp_current_week: int):
-    user = crud.get_user_by_id(db=db, id=user_id)
-    user.xp_current_week = new_xp_current_week
-    db.merge(user)
+def count_missing_rollup_credits(db: Session, date_reset_cutover: datetime):
+    """
+    Number of XP transactions since the cutover missing from the daily rollup, e.g. credited
+    before the rollup was deployed. The ledger is counted first: credits committed meanwhile
+    are added to both in one transaction, so they cannot be reported as missing
+    """
+    n_transactions = db \
+        .query(func.count(models.XPTransaction.id)) \
+        .filter(
+            models.XPTransaction.user_id != None,
+            models.XPTransaction.date_credited >= date_reset_cutover,
+        ) \
+        .scalar()
+    n_rolled_up = db \
+        .query(func.coalesce(func.sum(models.UserXPDaily.n_credits), 0)) \
+        .filter(models.UserXPDaily.day >= date_reset_cutover.date()) \
+        .scalar()
+    return max(n_transactions - n_rolled_up, 0)
 
 
-def recalc_xp(db: Session) -> bool:
+def recalc_xp(db: Session, dry_run: bool = False):
     """
-    For all users, set current week's XP to 0 
+    Recalculate the current week's XP of all users from the daily rollup with a single
+    UPDATE users ... FROM (targets), which only writes the users whose XP differs.
+    With dry_run, report the differences and leave users untouched.
+    Refuses to run while the rollup misses credits of the week, which would lower users' XP.
+    Returns the number of users updated (or to update)
     """
 
     date_reset_cutover = get_weekly_reset_cutover()
 
     try:
-
-        soft_reset_weekly_xp(db=db)
-        weekly_xp_per_user = get_weekly_xp_per_user(db=db, date_reset_cutover=date_reset_cutover)
-
-        for user_xp in weekly_xp_per_user:
-            user_id, xp_current_week = user_xp
-            set_user_weekly_xp(
-                db=db,
-                user_id=user_id,
-                new_xp_current_week=xp_current_week
+        n_missing = count_missing_rollup_credits(db=db, date_reset_cutover=date_reset_cutover)
+        if n_missing:
+            db.rollback()
+            raise SnipsWeeklyXPResetError(
+                f'The daily XP rollup misses {n_missing} credits since {date_reset_cutover:%Y-%m-%d}, '
+                f'run python -m app.api.tools.xp_daily_backfill --date-from {date_reset_cutover:%Y-%m-%d} first'
             )
-            
+
+        n_users, xp_difference, largest = get_weekly_xp_diff(db=db, date_reset_cutover=date_reset_cutover)
+        print(f'{n_users} users to update, {xp_difference:+d} XP in total')
+        for user_id, xp_current_week, xp_recalculated in largest:
+            print(f'User={user_id}, XP_Current_Week={xp_current_week} -> {xp_recalculated}')
+
+        if dry_run:
+            db.rollback()
+            return n_users
+
+        targets = get_weekly_xp_targets(date_reset_cutover=date_reset_cutover)
+        n_updated = db.execute(
+            update(models.User)
+                .where(
+                    models.User.id == targets.c.user_id,
+                    models.User.xp_current_week != targets.c.xp,
+                )
+                .values({
+                    models.User.xp_current_week_value: targets.c.xp,
+                    models.User.xp_week_epoch: models.current_xp_epoch(xp_epochs.WEEKLY),
+                })
+                .execution_options(synchronize_session=False)
+        ).rowcount
         db.commit()
+        return n_updated
 
     except SQLAlchemyError as e:
         db.rollback()
         raise SnipsWeeklyXPResetError("Could not execute ad-hoc week XP reset")
-            
 
-if __name__ == "__main__":
+
+@click.command()
+@click.option('--dry-run', is_flag=True, help='Only report the users whose weekly XP would change')
+def main(dry_run: bool):
+    """
+    Recalculate the current week's XP of all users from the XP ledger rollup
+    """
     db = SessionLocal()
-    # recalc_xp(db=db)
+    try:
+        n_users = recalc_xp(db=db, dry_run=dry_run)
+        print(f'{n_users} users {"to update" if dry_run else "updated"}')
+    finally:
+        db.close()
+
 
+if __name__ == "__main__":
+    main()
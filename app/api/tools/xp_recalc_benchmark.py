@@ -0,0 +1,87 @@
+import time
+
+import click
+from sqlalchemy import text
+
+from app.api.database import SessionLocal, ENVIRONMENT
+from app.api.tools.query_plans import seed
+from app.api.tools.xp_onrestart_recalc import \
+    get_weekly_reset_cutover, \
+    get_weekly_xp_per_user, \
+    recalc_xp, \
+    set_user_weekly_xp, \
+    soft_reset_weekly_xp
+
+# query_plans.seed credits every user 50 times
+XP_TRANSACTIONS_PER_USER = 50
+
+
+def time_per_user_loop(n_sample: int):
+    """
+    Time the legacy soft reset + per-user UPDATE loop on a sample of users, extrapolated to all of them.
+    Changes are rolled back
+    """
+    db = SessionLocal()
+    weekly_xp_per_user = get_weekly_xp_per_user(db=db, date_reset_cutover=get_weekly_reset_cutover())
+    time_start = time.monotonic()
+    soft_reset_weekly_xp(db=db)
+    reset_seconds = time.monotonic() - time_start
+
+    sample = weekly_xp_per_user[:n_sample]
+    time_start = time.monotonic()
+    for user_id, xp_current_week in sample:
+        set_user_weekly_xp(db=db, user_id=user_id, new_xp_current_week=xp_current_week)
+    db.flush()
+    loop_seconds = (time.monotonic() - time_start) / max(len(sample), 1) * len(weekly_xp_per_user)
+    db.rollback()
+    db.close()
+    return reset_seconds + loop_seconds
+
+
+def time_set_based_recalc(n_runs: int):
+    db = SessionLocal()
+    timings = []
+    for _ in range(n_runs):
+        # start from stale values, so that every run rewrites the users credited this week
+        db.execute(text("UPDATE users SET xp_current_week = xp_current_week + 1"))
+        db.commit()
+        time_start = time.monotonic()
+        recalc_xp(db=db)
+        timings.append(time.monotonic() - time_start)
+    db.close()
+    return min(timings)
+
+
+@click.command()
+@click.option('--xp-transactions', default=1000000, help='Number of XP transactions to benchmark at')
+@click.option('--sample', default=2000, help='Users updated one by one to estimate the legacy loop')
+@click.option('--runs', default=3, help='Set-based recalculation runs, the fastest is reported')
+def benchmark(xp_transactions: int, sample: int, runs: int):
+    """
+    Compare the per-user weekly XP recalculation loop with the set-based UPDATE.
+    Seeds users into the configured (empty, non-production) database
+    """
+    if ENVIRONMENT == 'prod':
+        raise click.ClickException('Refusing to seed a production database')
+
+    db = SessionLocal()
+    n_transactions = db.execute(text("SELECT COUNT(*) FROM xp_transactions")).scalar()
+    if n_transactions < xp_transactions:
+        n_users = (xp_transactions - n_transactions) // XP_TRANSACTIONS_PER_USER
+        print(f'seeding {n_users} users')
+        seed(db=db, n_users=n_users)
+    db.execute(text('ANALYZE'))
+    db.commit()
+    n_transactions = db.execute(text("SELECT COUNT(*) FROM xp_transactions")).scalar()
+    db.close()
+
+    loop_seconds = time_per_user_loop(n_sample=sample)
+    set_based_seconds = time_set_based_recalc(n_runs=runs)
+    print(
+        f'{n_transactions} XP transactions: per-user loop ~{loop_seconds:.1f}s, '
+        f'set-based {set_based_seconds:.2f}s, {loop_seconds / set_based_seconds:.0f}x faster'
+    )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,9 +1,8 @@
-from datetime import datetime
-
+import click
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from app.api import crud
+from app.api import crud, xp_epochs
 from app.api.database import engine, SessionLocal
 from app.models import models
 import app.api.constants as c
@@ -12,49 +11,45 @@ from app.api.exceptions import SnipsWeeklyXPResetError
 
 def take_xp_snapshot(db: Session):
     """
-    todo: 
-    - update timeframe_label
-    - update timeframe
-    - set up cron
+    Archive the current week and season XP of every user, e.g. for a mid-season standings snapshot.
+    Returns the number of users archived per timeframe
     """
-    timeframe_label = '1W'  
-    date_as_of = datetime.now().strftime('%Y-%m-%d 00:00:00+00')
-    results = crud.get_xp_leaderboard(db=db, q=None, skip=0, limit=100, timeframe='season')
-    for portfolio in results:
-        xp_score = portfolio.user.xp_current_week
-        if xp_score == 0:
-            break
-        user_xp_snapshot = models.XPSnapshot(
-            user_id=portfolio.user.id,
-            timeframe=timeframe_label,
-            date_as_of=date_as_of,
-            xp_collected=xp_score,
-        )
-        db.merge(user_xp_snapshot)
     try:
+        n_users = {
+            timeframe: xp_epochs.snapshot_xp(db=db, timeframe=timeframe)
+            for timeframe in (xp_epochs.WEEKLY, xp_epochs.SEASON)
+        }
         db.commit()
-    except:
-        db.rollack()
+        return n_users
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise
 
 
 def reset_xp_current_season(db: Session) -> bool:
     """
-    For all users, set current week's XP to 0 
+    For all users, set current season's XP to 0 by starting a new season epoch,
+    and archive the season's final XP
     """
     try:
-        db \
-            .query(models.User) \
-            .update({
-                models.User.xp_current_season: 0
-            })
-
-        db.commit()
+        return xp_epochs.close_epoch(db=db, timeframe=xp_epochs.SEASON)
     except SQLAlchemyError as e:
         db.rollback()
         raise SnipsWeeklyXPResetError("Could not execute regular seasonly XP reset")
-            
 
-if __name__ == "__main__":
+
+@click.command()
+@click.option('--snapshot-only', is_flag=True, help='Archive the current XP without ending the season')
+def main(snapshot_only: bool):
     db = SessionLocal()
-    take_xp_snapshot(db=db)
-    reset_xp_current_season(db=db)
+    try:
+        if snapshot_only:
+            print(f'archived {take_xp_snapshot(db=db)} users')
+        else:
+            print(f'season ended, archived {reset_xp_current_season(db=db)} users')
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from app.api import crud
+from app.api import crud, xp_epochs
 from app.api.database import engine, SessionLocal
 from app.models import models
 import app.api.constants as c
@@ -10,16 +10,11 @@ from app.api.exceptions import SnipsWeeklyXPResetError
 
 def reset_xp_current_week(db: Session) -> bool:
     """
-    For all users, set current week's XP to 0 
+    For all users, set current week's XP to 0 by starting a new week epoch,
+    and archive the week's XP
     """
     try:
-        db \
-            .query(models.User) \
-            .update({
-                models.User.xp_current_week: 0
-            })
-
-        db.commit()
+        xp_epochs.close_epoch(db=db, timeframe=xp_epochs.WEEKLY)
     except SQLAlchemyError as e:
         db.rollback()
         raise SnipsWeeklyXPResetError("Could not execute regular weekly XP reset")
@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import func, literal, select, String, cast, distinct
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import app.api.constants as c
+from app.models import models
+
+SCOPE_USER = 'user'
+SCOPE_PORTFOLIO = 'portfolio'
+
+# first key of the advisory locks serialising counter writes with the rebuild of a scope id range
+SCOPE_LOCK_KEYS = {SCOPE_USER: 72801, SCOPE_PORTFOLIO: 72802}
+
+
+def get_bucket_start(date: datetime):
+    epoch = int(date.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % c.XP_COUNTER_BUCKET_SECONDS, tz=timezone.utc)
+
+
+def get_window_start():
+    """
+    Start of the rolling window, rounded down to a bucket boundary
+    """
+    return get_bucket_start(datetime.now(tz=timezone.utc) - timedelta(hours=c.XP_COUNTER_WINDOW_HOURS))
+
+
+def increment_counter(db: Session, scope: str, scope_id: int, counter: str, value: int = 1, member: str = '', date: Optional[datetime] = None):
+    """
+    Add to the counter bucket of a given date (now by default).
+    Does not commit: the counter is written in the caller's transaction
+    """
+    # held until the caller commits, so that a rebuild of this scope id range waits for the write
+    db.execute(select(func.pg_advisory_xact_lock_shared(
+        SCOPE_LOCK_KEYS[scope], scope_id // c.XP_COUNTER_REBUILD_RANGE_SIZE
+    )))
+    stmt = insert(models.XPCounterBucket).values(
+        scope=scope,
+        scope_id=scope_id,
+        counter=counter,
+        member=member,
+        bucket_start=get_bucket_start(date or datetime.now(tz=timezone.utc)),
+        value=value,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[
+            models.XPCounterBucket.scope,
+            models.XPCounterBucket.scope_id,
+            models.XPCounterBucket.counter,
+            models.XPCounterBucket.member,
+            models.XPCounterBucket.bucket_start,
+        ],
+        set_={'value': models.XPCounterBucket.value + stmt.excluded.value}
+    )
+    db.execute(stmt)
+
+
+def record_executed_transaction(db: Session, transaction: models.PortfolioTransaction):
+    if transaction.associated_instrument_id is None:
+        return
+
+    if transaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value:
+        increment_counter(
+            db=db,
+            scope=SCOPE_PORTFOLIO,
+            scope_id=transaction.portfolio_id,
+            counter=c.XP_COUNTER.BUY_INSTRUMENT,
+            member=str(transaction.associated_instrument_id),
+            date=transaction.date_executed,
+        )
+
+    if transaction.message is not None:
+        increment_counter(
+            db=db,
+            scope=SCOPE_PORTFOLIO,
+            scope_id=transaction.portfolio_id,
+            counter=c.XP_COUNTER.MESSAGE_TRANSACTION,
+            date=transaction.date_executed,
+        )
+
+
+def record_xp_credit(db: Session, user_id: int, xp_reason: str, xp_amount: int):
+    increment_counter(
+        db=db,
+        scope=SCOPE_USER,
+        scope_id=user_id,
+        counter=c.XP_COUNTER.XP_CREDITED,
+        member=xp_reason,
+        value=xp_amount,
+    )
+
+
+def get_counter_sum(db: Session, scope: str, scope_id: int, counter: str, member: Optional[str] = None):
+    """
+    Sum of a counter over the rolling window, optionally for a single set member
+    """
+    query = db \
+        .query(func.coalesce(func.sum(models.XPCounterBucket.value), 0)) \
+        .filter(
+            models.XPCounterBucket.scope == scope,
+            models.XPCounterBucket.scope_id == scope_id,
+            models.XPCounterBucket.counter == counter,
+            models.XPCounterBucket.bucket_start >= get_window_start(),
+        )
+    if member is not None:
+        query = query.filter(models.XPCounterBucket.member == member)
+    return query.scalar()
+
+
+def count_counter_members(db: Session, scope: str, scope_id: int, counter: str):
+    """
+    Number of distinct set members seen over the rolling window
+    """
+    return db \
+        .query(func.count(distinct(models.XPCounterBucket.member))) \
+        .filter(
+            models.XPCounterBucket.scope == scope,
+            models.XPCounterBucket.scope_id == scope_id,
+            models.XPCounterBucket.counter == counter,
+            models.XPCounterBucket.bucket_start >= get_window_start(),
+        ) \
+        .scalar()
+
+
+def _bucket(column):
+    return func.to_timestamp(
+        func.floor(func.extract('epoch', column) / c.XP_COUNTER_BUCKET_SECONDS) * c.XP_COUNTER_BUCKET_SECONDS
+    )
+
+
+def get_rebuild_selects(window_start: datetime):
+    """
+    SELECTs of the rebuilt buckets per scope, as (scope id column, select) pairs
+    """
+    executed_transactions = (
+        models.PortfolioTransaction.status == 'executed',
+        models.PortfolioTransaction.associated_instrument_id != None,
+        models.PortfolioTransaction.date_executed >= window_start,
+    )
+
+    buy_bucket = _bucket(models.PortfolioTransaction.date_executed).label('bucket_start')
+    buys = select(
+            literal(SCOPE_PORTFOLIO),
+            models.PortfolioTransaction.portfolio_id,
+            literal(c.XP_COUNTER.BUY_INSTRUMENT),
+            cast(models.PortfolioTransaction.associated_instrument_id, String),
+            buy_bucket,
+            func.count(),
+        ) \
+        .where(
+            *executed_transactions,
+            models.PortfolioTransaction.transaction_type == models.PortfolioTransactionTypeUserScope.BUY.value,
+        ) \
+        .group_by(models.PortfolioTransaction.portfolio_id, models.PortfolioTransaction.associated_instrument_id, buy_bucket)
+
+    message_bucket = _bucket(models.PortfolioTransaction.date_executed).label('bucket_start')
+    messages = select(
+            literal(SCOPE_PORTFOLIO),
+            models.PortfolioTransaction.portfolio_id,
+            literal(c.XP_COUNTER.MESSAGE_TRANSACTION),
+            literal(''),
+            message_bucket,
+            func.count(),
+        ) \
+        .where(
+            *executed_transactions,
+            models.PortfolioTransaction.message != None,
+        ) \
+        .group_by(models.PortfolioTransaction.portfolio_id, message_bucket)
+
+    xp_bucket = _bucket(models.XPTransaction.date_credited).label('bucket_start')
+    xp_credits = select(
+            literal(SCOPE_USER),
+            models.XPTransaction.user_id,
+            literal(c.XP_COUNTER.XP_CREDITED),
+            models.XPTransaction.reason,
+            xp_bucket,
+            func.sum(models.XPTransaction.amount),
+        ) \
+        .where(
+            models.XPTransaction.user_id != None,
+            models.XPTransaction.date_credited >= window_start,
+        ) \
+        .group_by(models.XPTransaction.user_id, models.XPTransaction.reason, xp_bucket)
+
+    return {
+        SCOPE_PORTFOLIO: [
+            (models.PortfolioTransaction.portfolio_id, buys),
+            (models.PortfolioTransaction.portfolio_id, messages),
+        ],
+        SCOPE_USER: [
+            (models.XPTransaction.user_id, xp_credits),
+        ],
+    }
+
+
+def rebuild_counters(db: Session):
+    """
+    Rebuild all counters of the rolling window from portfolio_transactions and xp_transactions.
+
+    Scope ids are rebuilt in ranges of XP_COUNTER_REBUILD_RANGE_SIZE, one short transaction each.
+    A range is locked against counter writes (see increment_counter) only while it is rebuilt,
+    so trades and XP credits of that range wait for a moment and then increment the rebuilt counters.
+    Buckets outside the window are dropped. Returns the number of ranges rebuilt
+    """
+    window_start = get_window_start()
+    columns = ['scope', 'scope_id', 'counter', 'member', 'bucket_start', 'value']
+    max_scope_ids = {
+        SCOPE_PORTFOLIO: db.query(func.max(models.Portfolio.id)).scalar() or 0,
+        SCOPE_USER: db.query(func.max(models.User.id)).scalar() or 0,
+    }
+    max_bucket_scope_ids = dict(
+        db.query(models.XPCounterBucket.scope, func.max(models.XPCounterBucket.scope_id))
+            .group_by(models.XPCounterBucket.scope)
+            .all()
+    )
+    db.commit()
+
+    n_ranges = 0
+    for scope, selects in get_rebuild_selects(window_start=window_start).items():
+        max_scope_id = max(max_scope_ids[scope], max_bucket_scope_ids.get(scope) or 0)
+        for range_key in range(max_scope_id // c.XP_COUNTER_REBUILD_RANGE_SIZE + 1):
+            range_start = range_key * c.XP_COUNTER_REBUILD_RANGE_SIZE
+            range_end = range_start + c.XP_COUNTER_REBUILD_RANGE_SIZE
+
+            db.execute(select(func.pg_advisory_xact_lock(SCOPE_LOCK_KEYS[scope], range_key)))
+            db.query(models.XPCounterBucket) \
+                .filter(
+                    models.XPCounterBucket.scope == scope,
+                    models.XPCounterBucket.scope_id >= range_start,
+                    models.XPCounterBucket.scope_id < range_end,
+                ) \
+                .delete(synchronize_session=False)
+            for scope_id_column, rebuild_select in selects:
+                db.execute(
+                    insert(models.XPCounterBucket).from_select(
+                        columns,
+                        rebuild_select.where(scope_id_column >= range_start, scope_id_column < range_end)
+                    )
+                )
+            db.commit()
+            n_ranges += 1
+
+    # expired buckets are never written again
+    db.query(models.XPCounterBucket) \
+        .filter(models.XPCounterBucket.bucket_start < window_start) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return n_ranges
@@ -0,0 +1,123 @@
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from sqlalchemy import case, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.models import models
+
+WEEKLY = 'weekly'
+SEASON = 'season'
+
+# timeframe -> (value column, epoch column) of users
+EPOCH_COLUMNS = {
+    WEEKLY: (models.User.xp_current_week_value, models.User.xp_week_epoch),
+    SEASON: (models.User.xp_current_season_value, models.User.xp_season_epoch),
+}
+
+# timeframe -> xp_snapshot.timeframe
+SNAPSHOT_TIMEFRAMES = {
+    WEEKLY: '1W',
+    SEASON: 'season',
+}
+
+
+def get_current_epoch(db: Session, timeframe: str):
+    return db.query(models.current_xp_epoch(timeframe)).scalar()
+
+
+def start_new_epoch(db: Session, timeframe: str):
+    """
+    Reset the XP of a timeframe for all users by starting a new epoch: a single-row update.
+    Does not commit. Returns the new epoch and its start date
+    """
+    stmt = insert(models.XPEpoch).values(timeframe=timeframe, epoch=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.XPEpoch.timeframe],
+        set_={
+            'epoch': models.XPEpoch.epoch + 1,
+            'date_started': stmt.excluded.date_started,
+        }
+    )
+    return db.execute(stmt.returning(models.XPEpoch.epoch, models.XPEpoch.date_started)).one()
+
+
+def snapshot_xp(db: Session, timeframe: str, epoch: Optional[int] = None, date_as_of: Optional[datetime] = None):
+    """
+    Copy the XP of every user with XP in an epoch of a timeframe (the current one by default)
+    into xp_snapshot with a single INSERT ... SELECT. The statement reads a consistent view of users
+    without locking them, so it runs alongside XP credits. Taking a snapshot again overwrites it.
+    Does not commit. Returns the number of users archived
+    """
+    value_column, epoch_column = EPOCH_COLUMNS[timeframe]
+    if epoch is None:
+        epoch = get_current_epoch(db=db, timeframe=timeframe)
+    if date_as_of is None:
+        date_as_of = datetime.now(tz=timezone.utc)
+
+    users = select(
+            models.User.id,
+            literal(SNAPSHOT_TIMEFRAMES[timeframe]),
+            literal(date_as_of),
+            value_column,
+        ) \
+        .where(
+            epoch_column == epoch,
+            value_column > 0,
+        )
+    stmt = insert(models.XPSnapshot).from_select(['user_id', 'timeframe', 'date_as_of', 'xp_collected'], users)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.XPSnapshot.user_id, models.XPSnapshot.timeframe, models.XPSnapshot.date_as_of],
+        set_={'xp_collected': stmt.excluded.xp_collected}
+    )
+    return db.execute(stmt).rowcount
+
+
+def close_epoch(db: Session, timeframe: str):
+    """
+    Start a new epoch of a timeframe and archive the final XP of the previous one, as of the new epoch's start.
+    Starting the epoch waits for the credits holding the epoch row (see lock_current_epochs), so once it is
+    committed no credit can still add to the previous epoch, and a single snapshot is final.
+    Commits. Returns the number of users archived
+    """
+    epoch, date_started = start_new_epoch(db=db, timeframe=timeframe)
+    db.commit()
+    n_users = snapshot_xp(db=db, timeframe=timeframe, epoch=epoch - 1, date_as_of=date_started)
+    db.commit()
+    return n_users
+
+
+def lock_current_epochs(db: Session, timeframes: Iterable[str] = (WEEKLY, SEASON)):
+    """
+    Read the epoch rows of the timeframes FOR SHARE until the end of the transaction, before an UPDATE
+    built with get_increment_values: the credits run alongside each other, and start_new_epoch waits for them
+    """
+    db.execute(
+        select(models.XPEpoch.epoch)
+            .where(models.XPEpoch.timeframe.in_(timeframes))
+            .order_by(models.XPEpoch.timeframe)
+            .with_for_update(read=True)
+    )
+
+
+def get_increment_values(amount, timeframes: Iterable[str] = (WEEKLY, SEASON)):
+    """
+    Values of an UPDATE of users that adds `amount` to the XP of the current epoch of each timeframe.
+    A value of a previous epoch is replaced, as it reads as 0
+    """
+    values = {}
+    for timeframe in timeframes:
+        value_column, epoch_column = EPOCH_COLUMNS[timeframe]
+        current_epoch = models.current_xp_epoch(timeframe)
+        values[value_column] = case((epoch_column == current_epoch, value_column + amount), else_=amount)
+        values[epoch_column] = current_epoch
+    return values
+
+
+def get_current_epoch_filter(timeframe: str):
+    """
+    Filter on users with XP in the current epoch, served by the (epoch, value) index
+    """
+    _, epoch_column = EPOCH_COLUMNS[timeframe]
+    return epoch_column == models.current_xp_epoch(timeframe)
@@ -0,0 +1,97 @@
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import func, select, text, values, column, cast, Date, Integer, String
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.models import models
+
+
+def _utc_day(column):
+    return cast(func.timezone('UTC', column), Date)
+
+
+def record_xp_credits(db: Session, transactions: List[dict]):
+    """
+    Add XP transactions ({'user_id', 'amount', 'reason'} dicts) to the daily rollup of the current UTC day.
+    Does not commit: the rollup is written in the caller's transaction, whose now() is the credit date
+    """
+    totals = {}
+    for transaction in transactions:
+        key = (transaction['user_id'], transaction['reason'])
+        amount, n_credits = totals.get(key, (0, 0))
+        totals[key] = (amount + transaction['amount'], n_credits + 1)
+    if not totals:
+        return
+
+    credits = values(
+        column('user_id', Integer),
+        column('reason', String),
+        column('amount', Integer),
+        column('n_credits', Integer),
+        name='credits'
+    ).data([(user_id, reason, amount, n_credits) for (user_id, reason), (amount, n_credits) in sorted(totals.items())])
+
+    stmt = insert(models.UserXPDaily).from_select(
+        ['user_id', 'day', 'reason', 'amount', 'n_credits'],
+        select(credits.c.user_id, _utc_day(func.now()), credits.c.reason, credits.c.amount, credits.c.n_credits)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.UserXPDaily.user_id, models.UserXPDaily.day, models.UserXPDaily.reason],
+        set_={
+            'amount': models.UserXPDaily.amount + stmt.excluded.amount,
+            'n_credits': models.UserXPDaily.n_credits + stmt.excluded.n_credits,
+        }
+    )
+    db.execute(stmt)
+
+
+def get_xp_per_user(db: Session, date_from: Optional[date] = None, user_id: Optional[int] = None):
+    """
+    [(user_id, xp)] credited since a UTC day (all time by default), optionally for a single user
+    """
+    query = db \
+        .query(models.UserXPDaily.user_id, func.sum(models.UserXPDaily.amount)) \
+        .group_by(models.UserXPDaily.user_id)
+    if date_from is not None:
+        query = query.filter(models.UserXPDaily.day >= date_from)
+    if user_id is not None:
+        query = query.filter(models.UserXPDaily.user_id == user_id)
+    return query.all()
+
+
+def rebuild_rollup(db: Session, date_from: Optional[date] = None):
+    """
+    Rebuild the daily rollup from xp_transactions, all of it or from a UTC day on, and commit.
+
+    The table is locked against writes for the duration of the rebuild, so XP credits
+    committed meanwhile wait and then add to the rebuilt rows.
+    Returns the number of rows written
+    """
+    db.execute(text('LOCK TABLE user_xp_daily IN EXCLUSIVE MODE'))
+
+    query = db.query(models.UserXPDaily)
+    if date_from is not None:
+        query = query.filter(models.UserXPDaily.day >= date_from)
+    query.delete(synchronize_session=False)
+
+    day = _utc_day(models.XPTransaction.date_credited).label('day')
+    rollup = select(
+            models.XPTransaction.user_id,
+            day,
+            models.XPTransaction.reason,
+            func.sum(models.XPTransaction.amount),
+            func.count(),
+        ) \
+        .where(models.XPTransaction.user_id != None) \
+        .group_by(models.XPTransaction.user_id, day, models.XPTransaction.reason)
+    if date_from is not None:
+        # compare the timestamp itself, so the date_credited index can be used
+        rollup = rollup.where(models.XPTransaction.date_credited >= func.timezone('UTC', cast(date_from, Date)))
+
+    n_rows = db.execute(
+        insert(models.UserXPDaily).from_select(['user_id', 'day', 'reason', 'amount', 'n_credits'], rollup)
+    ).rowcount
+    db.commit()
+    return n_rows
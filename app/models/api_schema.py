@@ -193,6 +193,7 @@ class PortfolioStats(BaseModel):
     portfolio_id: int
     total_net_worth: Optional[float]
     total_book_value: Optional[float]
+    total_sales_value: Optional[float]
     total_gain: Optional[float]
     date_last_updated: datetime
 
@@ -200,6 +201,16 @@ class PortfolioStats(BaseModel):
         orm_mode = True
 
 
+class PortfolioValueHistoryBar(BaseModel):
+    timeframe: str
+    total_net_worth: float
+    total_gain: float
+    date_as_of: datetime
+
+    class Config:
+        orm_mode = True
+
+
 class XPTransaction(BaseModel):
     id: int
     user_id: int
@@ -239,6 +250,30 @@ class PortfolioUserView(PortfolioView):
     class Config:
         orm_mode = True
 
+class LeaderboardEntry(BaseModel):
+    rank: int
+    portfolio: PortfolioUserView
+
+
+class LeaderboardNeighbourhood(BaseModel):
+    timeframe: str
+    rank: Optional[int]
+    n_ranked: int
+    entries: List[LeaderboardEntry]
+
+
+class XPSnapshotEntry(BaseModel):
+    rank: int
+    xp_collected: int
+    portfolio: PortfolioUserView
+
+
+class XPSnapshotLeaderboard(BaseModel):
+    timeframe: str
+    date_as_of: datetime
+    entries: List[XPSnapshotEntry]
+
+
 class PortfolioCreate(PortfolioBase):
     class Config:
         orm_mode = True
@@ -269,6 +304,29 @@ class PortfolioTransactionDetailed(PortfolioTransaction):
         orm_mode = True
 
 
+class PortfolioOrder(BaseModel):
+    id: int
+    portfolio_id: int
+    instrument_id: int
+    order_type: str
+    side: str
+    quantity: float
+    trigger_price: float
+    trigger_direction: str
+    status: str
+    message: Optional[str]
+    detail: Optional[str]
+    transaction_id: Optional[int]
+    execution_price: Optional[float]
+
+    date_created: datetime
+    date_last_updated: datetime
+    date_executed: Optional[datetime]
+
+    class Config:
+        orm_mode = True
+
+
 class Holding(BaseModel):
     portfolio_id: int
     instrument_id: int
@@ -276,6 +334,11 @@ class Holding(BaseModel):
     average_price: float
 
     instrument: Instrument
+
+    current_price: Optional[float]
+    market_value: Optional[float]
+    unrealized_pnl: Optional[float]
+    unrealized_pnl_perc: Optional[float]
     
     date_created: datetime
     date_last_updated: datetime
@@ -470,6 +533,23 @@ class LessonSubmissionResult(BaseModel):
     class Config:
         orm_mode = True
 
+class RevenueCatEvent(BaseModel):
+    type: str
+    event_timestamp_ms: int
+    app_user_id: Optional[str]
+    aliases: List[str] = []
+    entitlement_ids: Optional[List[str]]
+    expiration_at_ms: Optional[int]
+    grace_period_expiration_at_ms: Optional[int]
+    transferred_from: List[str] = []
+    transferred_to: List[str] = []
+
+
+class RevenueCatWebhook(BaseModel):
+    api_version: Optional[str]
+    event: RevenueCatEvent
+
+
 class RewardClaimResponse(BaseModel):
     total_claimed: int
     xp_earned: int
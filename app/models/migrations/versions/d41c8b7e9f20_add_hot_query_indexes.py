@@ -0,0 +1,45 @@
+"""add hot query indexes
+
+Revision ID: d41c8b7e9f20
+Revises: b3f7a9e2c614
+Create Date: 2024-09-16 11:27:53.480215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c8b7e9f20'
+down_revision = 'b3f7a9e2c614'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # the indexes are built without blocking writes to these busy tables, which cannot run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_xp_current_week', 'users', ['xp_current_week'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_users_xp_current_season', 'users', ['xp_current_season'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_users_xp_total', 'users', ['xp_total'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_portfolios_user_id', 'portfolios', ['user_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_holdings_instrument_id', 'holdings', ['instrument_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_portfolio_transactions_portfolio_id_status_date_executed', 'portfolio_transactions', ['portfolio_id', 'status', 'date_executed'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_portfolio_transactions_date_executed', 'portfolio_transactions', ['date_executed'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_user_push_tokens_user_id', 'user_push_tokens', ['user_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_xp_transactions_user_id_reason_date_credited', 'xp_transactions', ['user_id', 'reason', 'date_credited'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_xp_transactions_date_credited', 'xp_transactions', ['date_credited'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_xp_transactions_date_credited', table_name='xp_transactions', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_xp_transactions_user_id_reason_date_credited', table_name='xp_transactions', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_user_push_tokens_user_id', table_name='user_push_tokens', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_portfolio_transactions_date_executed', table_name='portfolio_transactions', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_portfolio_transactions_portfolio_id_status_date_executed', table_name='portfolio_transactions', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_holdings_instrument_id', table_name='holdings', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_portfolios_user_id', table_name='portfolios', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_xp_total', table_name='users', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_xp_current_season', table_name='users', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_xp_current_week', table_name='users', postgresql_concurrently=True, if_exists=True)
@@ -1,8 +1,10 @@
 from enum import Enum
 from sqlalchemy.orm import registry
 from sqlalchemy.orm import relationship
-from sqlalchemy import func
-from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime, Date, UniqueConstraint, ForeignKeyConstraint
+from sqlalchemy.orm import query_expression
+from sqlalchemy.orm import column_property
+from sqlalchemy import func, select, case
+from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime, Date, UniqueConstraint, ForeignKeyConstraint, Index, JSON
 
 # declarative base class
 mapper_registry = registry()
@@ -27,6 +29,43 @@ class PortfolioTransactionTypeAppScope(Enum):
     REWARD_WEEKLY = 'REWARD_WEEKLY'
     REWARD_DAILY = 'REWARD_DAILY'
 
+class PortfolioOrderType(Enum):
+    """
+    Resting order types that can be placed by a user.
+    Orders are executed by the matching engine once the latest price crosses the trigger price
+    """
+    LIMIT = 'limit'
+    STOP_LOSS = 'stop_loss'
+    TAKE_PROFIT = 'take_profit'
+
+class PortfolioOrderTriggerDirection(Enum):
+    """
+    Which side of the trigger price the latest price has to reach for an order to execute
+    """
+    BELOW = 'below'  # latest price <= trigger price
+    ABOVE = 'above'  # latest price >= trigger price
+
+
+class XPEpoch(Base):
+    """
+    Current epoch of the weekly and season XP counters.
+    A reset starts a new epoch instead of rewriting every user, see User.xp_current_week
+    """
+    __tablename__ = 'xp_epochs'
+    timeframe = Column(String, primary_key=True, comment='weekly or season')
+    epoch = Column(Integer, nullable=False, default=0, server_default='0')
+    date_started = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+def current_xp_epoch(timeframe: str):
+    """
+    Current epoch of a timeframe as a scalar subquery, 0 until the first reset
+    """
+    return func.coalesce(
+        select(XPEpoch.epoch).where(XPEpoch.timeframe == timeframe).scalar_subquery(),
+        0
+    )
+
 
 class User(Base):
     """
@@ -45,11 +84,21 @@ class User(Base):
     status = Column(String, nullable=False, default='active', server_default='active')
     secret_id = Column(String, nullable=False, default='user', server_default='user', comment='to be used by revenuecat')
     is_premium = Column(Integer, nullable=False, default=0, server_default="0") # 0: free, 1: premium
+    # cached RevenueCat entitlement, see app.api.entitlements
+    premium_expires_date = Column(DateTime(timezone=True), nullable=True, comment='end of the premium entitlement incl. grace period, null for lifetime')
+    premium_date_validated = Column(DateTime(timezone=True), nullable=True, comment='as of when the premium status is known from RevenueCat')
     credit_balance = Column(Integer, nullable=False, default=0, server_default="0")  # credits used for Snips AI
 
     xp_total = Column(Integer, nullable=False, default=0, server_default='0')  # total XP accumulated over lifetime
-    xp_current_week = Column(Integer, nullable=False, default=0, server_default='0')  # total XP accumulated in the current week
-    xp_current_season = Column(Integer, nullable=False, default=0, server_default='0')  # total XP accumulated in the current season
+    # weekly and season XP are stored with the epoch they were accumulated in, and read as 0 once the epoch is over
+    xp_current_week_value = Column('xp_current_week', Integer, nullable=False, default=0, server_default='0')  # total XP accumulated in the week xp_week_epoch
+    xp_week_epoch = Column(Integer, nullable=False, default=0, server_default='0')
+    xp_current_season_value = Column('xp_current_season', Integer, nullable=False, default=0, server_default='0')  # total XP accumulated in the season xp_season_epoch
+    xp_season_epoch = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # total XP accumulated in the current week/season (read-only)
+    xp_current_week = column_property(case((xp_week_epoch == current_xp_epoch('weekly'), xp_current_week_value), else_=0))
+    xp_current_season = column_property(case((xp_season_epoch == current_xp_epoch('season'), xp_current_season_value), else_=0))
 
     birth_year_estimated = Column(Integer, nullable=True)
     dream_statement = Column(String, nullable=True, comment='what is the dream of the user')
@@ -75,6 +124,13 @@ class User(Base):
     user_lessons = relationship('UserLesson', back_populates='user', cascade='all, delete')
     referrer = relationship('User', remote_side=[id])
 
+    __table_args__ = (
+        # XP leaderboards are sorted by each of the XP columns, weekly and season within the current epoch
+        Index('ix_users_xp_week_epoch_xp_current_week', 'xp_week_epoch', 'xp_current_week'),
+        Index('ix_users_xp_season_epoch_xp_current_season', 'xp_season_epoch', 'xp_current_season'),
+        Index('ix_users_xp_total', 'xp_total'),
+    )
+
 
 class Account(Base):
     """
@@ -139,21 +195,59 @@ class Portfolio(Base):
     
     holdings = relationship('Holding', back_populates='portfolio', cascade='all, delete')
     portfolio_transactions = relationship('PortfolioTransaction', back_populates='portfolio', cascade='all, delete')
+    portfolio_orders = relationship('PortfolioOrder', back_populates='portfolio', cascade='all, delete')
     stats = relationship('PortfolioStats', backref='portfolio', uselist=False, cascade='all, delete')
 
+    __table_args__ = (
+        Index('ix_portfolios_user_id', 'user_id'),
+    )
+
 class PortfolioStats(Base):
     """
     (Relatively) frequently updated statistics for a portfolio.
+    total_book_value and total_sales_value are running totals maintained on trade execution,
+    the market value dependent figures are recomputed on refresh.
     """
     __tablename__ = 'portfolio_stats'
     portfolio_id = Column(Integer, ForeignKey('portfolios.id'), primary_key=True)
     total_net_worth = Column(Float, nullable=True, default=None)     # total net worth including cash and holdings
     total_book_value = Column(Float, nullable=True, default=None)    # how much a user spent on stocks
+    total_sales_value = Column(Float, nullable=True, default=None)   # how much a user received from selling stocks
     total_gain = Column(Float, nullable=True, default=None)          # profits and losses
 
     date_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
 
 
+class PortfolioGainLeaderboard(Base):
+    """
+    Ranked gain leaderboard of public active portfolios, recomputed after the bulk stats refresh.
+    Pages are served by rank ranges on the primary key
+    """
+    __tablename__ = 'portfolio_gain_leaderboard'
+    rank = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id', ondelete='CASCADE'), nullable=False, unique=True)
+    total_gain = Column(Float, nullable=False)
+    gain_perc = Column(Float, nullable=True, comment='gain relative to the book value, in percent')
+
+    date_as_of = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    portfolio = relationship('Portfolio')
+
+
+class PortfolioValueHistory(Base):
+    """
+    Append-only history of portfolio value for charts, one narrow row per portfolio and period.
+    Written in bulk by the stats refresh: the value as of the start of each hour/day
+    """
+    __tablename__ = 'portfolio_value_history'
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id', ondelete='CASCADE'), primary_key=True)
+    timeframe = Column(String, primary_key=True, comment='1H or 1D')
+    date_as_of = Column(DateTime(timezone=True), primary_key=True, comment='start of the hour/day')
+
+    total_net_worth = Column(Float, nullable=False)
+    total_gain = Column(Float, nullable=False)
+
+
 class Holding(Base):
     """
     Holdings represent the distribution of assets/instruments in a portfolio.
@@ -170,6 +264,17 @@ class Holding(Base):
     portfolio = relationship('Portfolio', back_populates='holdings')
     instrument = relationship('Instrument', back_populates='holdings')
 
+    # valuation at the latest price, only loaded by queries that join the latest prices
+    current_price = query_expression()
+    market_value = query_expression()
+    unrealized_pnl = query_expression()
+    unrealized_pnl_perc = query_expression()
+
+    __table_args__ = (
+        # the primary key only serves lookups by portfolio
+        Index('ix_holdings_instrument_id', 'instrument_id'),
+    )
+
 
 class PortfolioTransaction(Base):
     """
@@ -192,6 +297,52 @@ class PortfolioTransaction(Base):
     portfolio = relationship('Portfolio', back_populates='portfolio_transactions')
     instrument = relationship('Instrument', back_populates='portfolio_transactions')
 
+    __table_args__ = (
+        Index('ix_portfolio_transactions_portfolio_id_status_date_executed', 'portfolio_id', 'status', 'date_executed'),
+        # public feed of the latest trades
+        Index('ix_portfolio_transactions_date_executed', 'date_executed'),
+    )
+
+
+class PortfolioOrder(Base):
+    """
+    Resting orders (limit, stop-loss, take-profit) waiting for the price to cross the trigger price.
+    Once triggered, an order is filled at the latest price with a regular portfolio transaction.
+    """
+    __tablename__ = 'portfolio_orders'
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id'), nullable=False)
+    instrument_id = Column(Integer, ForeignKey('instruments.id'), nullable=False)
+    order_type = Column(String, nullable=False, comment='limit, stop_loss, take_profit')
+    side = Column(String, nullable=False, comment='buy, sell')
+    quantity = Column(Float, nullable=False)
+    trigger_price = Column(Float, nullable=False)
+    trigger_direction = Column(String, nullable=False, comment='below, above: derived from order type and side')
+    status = Column(String, nullable=False, default='open', server_default='open')  # open, executed, cancelled, failed
+    message = Column(String, nullable=True, default=None, comment='Message/comment left by the user')
+    detail = Column(String, nullable=True, default=None, comment='Reason why the order failed')
+
+    transaction_id = Column(Integer, ForeignKey('portfolio_transactions.id'), nullable=True, default=None, comment='Transaction that filled the order')
+    execution_price = Column(Float, nullable=True, default=None)
+
+    date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    date_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+    date_executed = Column(DateTime(timezone=True), nullable=True, server_default=None)
+
+    portfolio = relationship('Portfolio', back_populates='portfolio_orders')
+    instrument = relationship('Instrument', back_populates='portfolio_orders')
+    transaction = relationship('PortfolioTransaction')
+
+    __table_args__ = (
+        # the matching engine range-scans open orders by instrument and trigger price on every price tick
+        Index(
+            'ix_portfolio_orders_open_trigger',
+            'instrument_id', 'trigger_direction', 'trigger_price',
+            postgresql_where=(status == 'open')
+        ),
+        Index('ix_portfolio_orders_portfolio_id_status', 'portfolio_id', 'status'),
+    )
+
 
 class Achievement(Base):
     """
@@ -258,6 +409,7 @@ class Instrument(Base):
 
     holdings = relationship('Holding', back_populates='instrument', cascade='all, delete')
     portfolio_transactions = relationship('PortfolioTransaction', back_populates='instrument', cascade='all, delete')
+    portfolio_orders = relationship('PortfolioOrder', back_populates='instrument', cascade='all, delete')
     instrument_collection_memberships = relationship('InstrumentCollectionMembership', back_populates='instrument', cascade='all, delete')
 
     # Universal KPIs for any instrument
@@ -443,6 +595,10 @@ class UserPushToken(Base):
 
     user = relationship('User', back_populates='user_push_tokens')
 
+    __table_args__ = (
+        Index('ix_user_push_tokens_user_id', 'user_id'),
+    )
+
 
 class PushReceipt(Base):
     __tablename__ = 'push_receipts'
@@ -518,10 +674,16 @@ class XPTransaction(Base):
 
     user = relationship('User', back_populates='xp_transactions')
 
+    __table_args__ = (
+        Index('ix_xp_transactions_user_id_reason_date_credited', 'user_id', 'reason', 'date_credited'),
+        # weekly/season resets and snapshots aggregate XP credited since a date
+        Index('ix_xp_transactions_date_credited', 'date_credited'),
+    )
+
 
 class XPSnapshot(Base):
     """
-    Snapshot of Top 100 players by XP in each competition period
+    Snapshot of the XP of every player with XP in a competition period, see xp_epochs.snapshot_xp
     """
     __tablename__ = 'xp_snapshot'
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
@@ -532,6 +694,63 @@ class XPSnapshot(Base):
 
     user = relationship('User', back_populates='xp_snapshot')
 
+    __table_args__ = (
+        # historical leaderboards read one snapshot in XP order
+        Index('ix_xp_snapshot_timeframe_date_as_of_xp_collected', 'timeframe', 'date_as_of', 'xp_collected'),
+    )
+
+
+class XPCounterBucket(Base):
+    """
+    Time-bucketed counters used to enforce the rolling 24h XP limits without scanning the ledgers.
+    Maintained in the same transaction as the trade or XP credit, rebuilt by tools.xp_counters_reconcile
+    """
+    __tablename__ = 'xp_counter_buckets'
+    scope = Column(String, primary_key=True, comment='user or portfolio')
+    scope_id = Column(Integer, primary_key=True, comment='User or portfolio id')
+    counter = Column(String, primary_key=True, comment='Counter identifier, see constants.XP_COUNTER')
+    member = Column(String, primary_key=True, server_default='', comment='Set member, e.g. instrument id or XP reason')
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)
+
+    value = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # expired buckets are pruned by date
+        Index('ix_xp_counter_buckets_bucket_start', 'bucket_start'),
+    )
+
+
+class UserXPDaily(Base):
+    """
+    Daily rollup of the XP ledger per user and reason (UTC days).
+    Maintained in the same transaction as the XP credit, rebuilt by tools.xp_daily_backfill
+    """
+    __tablename__ = 'user_xp_daily'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    reason = Column(String, primary_key=True, comment='Reason identifier')
+
+    amount = Column(Integer, nullable=False, default=0, server_default='0', comment='XP credited on the day for the reason')
+    n_credits = Column(Integer, nullable=False, default=0, server_default='0', comment='Number of XP transactions')
+
+    __table_args__ = (
+        # weekly/season sums across users are read by day range
+        Index('ix_user_xp_daily_day', 'day'),
+    )
+
+
+class XPReplayCheckpoint(Base):
+    """
+    Progress of a shard of the XP replay (tools.backfill_xp), written in the same transaction as its credits
+    """
+    __tablename__ = 'xp_replay_checkpoints'
+    shard = Column(Integer, primary_key=True)
+    n_shards = Column(Integer, nullable=False, comment='Number of shards the replay was started with')
+    last_transaction_id = Column(Integer, nullable=False, default=0, server_default='0', comment='Last portfolio transaction replayed')
+    n_credits = Column(Integer, nullable=False, default=0, server_default='0', comment='XP transactions written so far')
+
+    date_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+
 
 # Snips Learn
 class Skill(Base):
@@ -613,4 +832,36 @@ class LessonSkill(Base):
     date_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
 
     skill = relationship('Skill', back_populates='lesson_skills')
-    lesson = relationship('Lesson', back_populates='lesson_skills')
\ No newline at end of file
+    lesson = relationship('Lesson', back_populates='lesson_skills')
+
+# Background jobs
+class Job(Base):
+    """
+    Durable queue of side effects (XP credits, stats refresh) processed by the job worker.
+    Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so a job is delivered at least once.
+    """
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    job_type = Column(String, nullable=False, comment='Handler identifier, e.g. xp.transaction_executed')
+    payload = Column(JSON, nullable=False, default=dict, comment='Keyword arguments passed to the handler')
+    dedup_key = Column(String, nullable=True, default=None, comment='At most one queued job per key')
+    status = Column(String, nullable=False, default='queued', server_default='queued')  # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    max_attempts = Column(Integer, nullable=False, default=5, server_default='5')
+    last_error = Column(String, nullable=True, default=None)
+    locked_by = Column(String, nullable=True, default=None, comment='Worker that claimed the job')
+
+    run_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), comment='Job is not claimed before this time')
+    locked_until = Column(DateTime(timezone=True), nullable=True, default=None, comment='Lease expiry, the job is reclaimed afterwards')
+    date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    date_last_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+    date_completed = Column(DateTime(timezone=True), nullable=True, default=None)
+
+    __table_args__ = (
+        # workers poll queued jobs by type in run_after order
+        Index('ix_jobs_queued', 'job_type', 'run_after', postgresql_where=(status == 'queued')),
+        # expired leases of crashed workers are reclaimed
+        Index('ix_jobs_running', 'job_type', 'locked_until', postgresql_where=(status == 'running')),
+        # a job that is already running may have one follow-up queued with the same key
+        Index('ux_jobs_dedup_key', 'dedup_key', unique=True, postgresql_where=(status == 'queued')),
+    )
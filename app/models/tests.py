@@ -4,7 +4,7 @@ from sqlalchemy import create_engine, select
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from models import Base, Character, Portfolio, User, Account
+from models import Base, Character, Portfolio, User, Account, current_xp_epoch
 
 
 # class TestQuery(unittest.TestCase):
@@ -101,7 +101,8 @@ print(user1.portfolios[0].name)
 print("XP test start")
 print("Add XP (+1)")
 user1.xp_total = User.xp_total + 1
-user1.xp_current_week = User.xp_total + 1
+user1.xp_current_week_value = User.xp_total + 1
+user1.xp_week_epoch = current_xp_epoch('weekly')
 session.merge(user1)
 session.commit()
 
@@ -111,7 +112,8 @@ for user in users:
 
 print("Add XP again (+1)")
 user1.xp_total = User.xp_total + 1
-user1.xp_current_week = User.xp_total + 1
+user1.xp_current_week_value = User.xp_total + 1
+user1.xp_week_epoch = current_xp_epoch('weekly')
 session.merge(user1)
 session.commit()
 